@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark for check_balance.py page parsing: parse + extract time per
+# provider on saved pages (check_balance/fixtures), compared with the old approach
+# (a parse per XPath query, XPath compiled on every call). No network access.
+# Dialog payments table is also parsed on synthetic pages with many rows: the
+# streaming parser against a full tree with XPath queries, time and peak memory.
+#   benchmarks/bench_check_balance.py -n 200 -r 10000 50000
+
+import os
+import sys
+import argparse
+import json
+import timeit
+import tracemalloc
+import types
+
+import benchmark_utils
+
+sys.path.insert(0, os.path.join(benchmark_utils.REPO_DIR, "check_balance"))
+import check_balance  # noqa: E402
+import http_fixtures  # noqa: E402
+import lxml.etree  # noqa: E402
+
+# Tree-based extraction the payments table used before it was streamed
+PAYMENTS_XPATHS = {
+    "payments": "/html/body/div/main/div[2]/table[1]/tr",
+    "todays_withdrawal": (
+        "/html/body/div/main/div[2]/table[1]/tr[td[1][text() = $today] and td[2][text() = $withdrawal_amount]]"
+    ),
+    "last_withdrawal": '/html/body/div/main/div[2]/table[1]/tr[td[2][starts-with(text(),"-")]]/td[2]',
+}
+# Pages are fed to the streaming parser in pieces of this size, same as from network
+CHUNK_SIZE = 65536
+
+PAGE_FIXTURES = {
+    "https://stats.tis-dialog.ru/index.php?phnumber={login}": "dialog_main.html",
+    "https://stats.tis-dialog.ru/index.php?mod=payments": "dialog_payments.html",
+    "https://stat.sovatelecom.ru/main.htms": "sovatel_main.html",
+}
+
+
+def get_page_extractors(provider):
+    for url_template, extractors in provider.pages:
+        yield url_template, PAYMENTS_XPATHS if callable(extractors) else extractors
+
+
+def extract_values(provider, pages, variables):
+    values = {}
+    for url_template, extractors in get_page_extractors(provider):
+        values.update(check_balance.extract_page_values(pages[url_template], extractors, variables))
+    return values
+
+
+def extract_values_per_query(provider, pages, variables):
+    # Old approach: every query parses the page again and compiles the expression
+    values = {}
+    for url_template, extractors in get_page_extractors(provider):
+        for name, expression in extractors.items():
+            values[name] = lxml.etree.HTML(pages[url_template]).xpath(expression, **variables)
+    return values
+
+
+def make_payments_page(rows, today):
+    # Newest first: today's withdrawal, then a payment and a withdrawal per month
+    # going back in time
+    lines = [
+        "<html><body><div><main><div>menu</div><div><table>",
+        "<tr><th>Дата</th><th>Сумма</th><th>Описание</th></tr>",
+        f"<tr><td>{today}</td><td>-455,00</td><td>Абонентская плата за месяц</td></tr>",
+    ]
+    for i in range(rows - 1):
+        amount, description = ("+500,00", "Платёж через банк") if i % 2 == 0 else ("-455,00", "Абонентская плата")
+        lines.append(f"<tr><td>{(i // 2) % 28 + 1:02d}.{(i // 2) // 28 % 12 + 1:02d}.2000</td>"
+            f"<td>{amount}</td><td>{description}</td></tr>")
+    lines.append("</table></div></main></div></body></html>")
+    return "\n".join(lines)
+
+
+def parse_payments_stream(page, variables):
+    return check_balance.parse_payments(
+        (page[i : i + CHUNK_SIZE] for i in range(0, len(page), CHUNK_SIZE)), variables
+    )
+
+
+def parse_payments_tree(page, variables):
+    values = check_balance.extract_page_values(page, PAYMENTS_XPATHS, variables)
+    return {
+        "todays_withdrawal": bool(values["todays_withdrawal"]),
+        "last_withdrawal_amount": values["last_withdrawal"][0].text,
+    }
+
+
+def measure_peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_payments(args, variables):
+    results = {}
+    for rows in args.rows:
+        page = make_payments_page(rows, variables["today"])
+        assert parse_payments_stream(page, variables) == parse_payments_tree(page, variables)
+        results[f"payments_{rows}_rows"] = result = {}
+        for variant, parse_function in (("stream", parse_payments_stream), ("tree", parse_payments_tree)):
+            # Large pages take milliseconds, not microseconds, time is per run anyway
+            iterations = max(1, args.iterations // 20)
+            result[f"{variant}_ms"] = round(
+                timeit.timeit(lambda: parse_function(page, variables), number=iterations) / iterations * 1e3, 3
+            )
+            # lxml tree memory is allocated outside of Python and is not seen by
+            # tracemalloc, element proxies and strings are
+            result[f"{variant}_peak_kb"] = round(measure_peak_memory(parse_function, page, variables) / 1024, 1)
+    return results
+
+
+def main(args):
+    check_balance.options = types.SimpleNamespace(verbose=False)
+    variables = check_balance.get_xpath_variables(
+        types.SimpleNamespace(login="0000000", withdrawal_amount=455)
+    )
+    pages = {
+        url: http_fixtures.render_fixture(http_fixtures.FIXTURES_DIR, fixture, template=True)
+        for url, fixture in PAGE_FIXTURES.items()
+    }
+
+    results = {}
+    for name, provider in check_balance.PROVIDERS.items():
+        results[name] = {}
+        for variant, extract_function in (
+            ("single_parse_us", extract_values),
+            ("parse_per_query_us", extract_values_per_query),
+        ):
+            results[name][variant] = round(
+                timeit.timeit(lambda: extract_function(provider, pages, variables), number=args.iterations)
+                / args.iterations * 1e6,
+                2,
+            )
+    results.update(benchmark_payments(args, variables))
+
+    for name, result in results.items():
+        print(f"{name}:")
+        for key, value in result.items():
+            print(f"    {key}: {value}")
+    if args.json_output:
+        with open(args.json_output, "w") as json_f:
+            json.dump(results, json_f, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark check_balance.py page parsing")
+    parser.add_argument(
+        "-n", "--iterations", dest="iterations", type=int, default=200,
+        help="Number of parse + extract runs per provider (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-r", "--rows", dest="rows", type=int, nargs="+", default=[10000, 50000],
+        help="Row counts of synthetic payments pages (default: %(default)s)",
+    )
+    parser.add_argument("-j", "--json", dest="json_output", default=None, help="Write results to a JSON file")
+
+    main(parser.parse_args())
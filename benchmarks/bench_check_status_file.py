@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark for check_status_file.py: per-invocation wall time, interpreter
+# import time and in-process timestamp parsing time.
+# Compares current working tree with a git revision:
+#   benchmarks/bench_check_status_file.py --baseline-rev HEAD~1
+
+import os
+import sys
+import argparse
+import datetime
+import json
+import shutil
+import statistics
+import subprocess
+import tempfile
+import timeit
+
+import benchmark_utils
+
+PLUGIN_PATH = "check_status_file/check_status_file.py"
+
+
+def benchmark_plugin(plugin_path, status_file_name, iterations):
+    command = [plugin_path, status_file_name]
+    wall_times, _ = benchmark_utils.get_wall_times(command, iterations)
+    result = {
+        "wall_time_median_ms": round(statistics.median(wall_times) * 1000, 2),
+        "wall_time_min_ms": round(min(wall_times) * 1000, 2),
+    }
+    result.update(benchmark_utils.get_import_time_summary(command))
+    return result
+
+
+def benchmark_parsing(plugin_dir, iterations):
+    sys.path.insert(0, plugin_dir)
+    try:
+        import check_status_file
+        import dateutil.parser
+
+        timestamp = datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
+        results = {}
+        for name, parse_function in (
+            ("dateutil_parse_us", dateutil.parser.parse),
+            ("parse_timestamp_us", getattr(check_status_file, "parse_timestamp", None)),
+        ):
+            if parse_function is not None:
+                results[name] = round(
+                    timeit.timeit(lambda: parse_function(timestamp), number=iterations) / iterations * 1e6, 2
+                )
+        return results
+    finally:
+        sys.path.remove(plugin_dir)
+        sys.modules.pop("check_status_file", None)
+
+
+def main(args):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        status_file_name = os.path.join(temp_dir, "status")
+        with open(status_file_name, "w") as status_f:
+            # Same format as 'date -Iseconds'
+            timestamp = datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
+            status_f.write(f"{timestamp};OK;benchmark\n")
+
+        variants = {"current": os.path.join(benchmark_utils.REPO_DIR, PLUGIN_PATH)}
+        if args.baseline_rev:
+            baseline_path = os.path.join(temp_dir, "baseline", "check_status_file.py")
+            os.makedirs(os.path.dirname(baseline_path))
+            with open(baseline_path, "w") as baseline_f:
+                baseline_f.write(
+                    subprocess.check_output(
+                        ["git", "show", f"{args.baseline_rev}:{PLUGIN_PATH}"],
+                        cwd=benchmark_utils.REPO_DIR,
+                        encoding="utf-8",
+                    )
+                )
+            variants = {args.baseline_rev: baseline_path, **variants}
+
+        results = {}
+        for name, plugin_path in variants.items():
+            results[name] = benchmark_plugin(plugin_path, status_file_name, args.iterations)
+            results[name].update(benchmark_parsing(os.path.dirname(plugin_path), args.parse_iterations))
+
+        for name, result in results.items():
+            print(f"{name}:")
+            for key, value in result.items():
+                print(f"    {key}: {value}")
+        if args.json_output:
+            with open(args.json_output, "w") as json_f:
+                json.dump(results, json_f, indent=4)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark check_status_file.py")
+    parser.add_argument(
+        "-b", "--baseline-rev", dest="baseline_rev", default=None, help="Git revision to compare with"
+    )
+    parser.add_argument(
+        "-n", "--iterations", dest="iterations", type=int, default=20,
+        help="Number of plugin invocations (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-p", "--parse-iterations", dest="parse_iterations", type=int, default=10000,
+        help="Number of in-process timestamp parsing calls (default: %(default)d)",
+    )
+    parser.add_argument("-j", "--json", dest="json_output", default=None, help="Write results to a JSON file")
+
+    main(parser.parse_args())
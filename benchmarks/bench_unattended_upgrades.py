@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark for unattended_upgrades.py configuration checks on a synthetic
+# apt.conf.d tree (see run_benchmarks.create_apt_config_tree): the single-pass
+# parser that reads every part once and merges them, compared with the old approach
+# (a file read and a regex search per checked setting, 50unattended-upgrades and
+# 20auto-upgrades only). No dpkg calls, checks only.
+#   benchmarks/bench_unattended_upgrades.py -n 500 -f 30 300
+
+import os
+import sys
+import argparse
+import json
+import re
+import shutil
+import tempfile
+import timeit
+
+import benchmark_utils
+import run_benchmarks
+
+sys.path.insert(0, os.path.join(benchmark_utils.REPO_DIR, "check_ubuntu_unattended_upgrades"))
+import unattended_upgrades  # noqa: E402
+
+# Settings the old version searched for, one file read per regex
+ORIGIN_REGEXES = [
+    r"^\s*" + re.escape('"${distro_id}:${distro_codename}-security";'),
+    r"^\s*" + re.escape('"${distro_id}:${distro_codename}-updates";'),
+]
+PERIODIC_REGEXES = [
+    re.escape('APT::Periodic::Unattended-Upgrade "') + r"(\d+)" + re.escape('";'),
+    r'APT::Periodic::Update-Package-Lists "(\d+)";',
+    r'APT::Periodic::Download-Upgradeable-Packages "(\d+)";',
+    r'APT::Periodic::AutocleanInterval "(\d+)";',
+]
+
+
+def search_file(file_name, regex):
+    with open(file_name, "r") as config_f:
+        return re.search(regex, config_f.read(), flags=re.MULTILINE)
+
+
+def check_per_regex(parts_dir):
+    for regex in ORIGIN_REGEXES:
+        if not search_file(os.path.join(parts_dir, "50unattended-upgrades"), regex):
+            return None
+    for regex in PERIODIC_REGEXES:
+        match = search_file(os.path.join(parts_dir, "20auto-upgrades"), regex)
+        if not match or not int(match.group(1)):
+            return None
+        if regex == PERIODIC_REGEXES[0]:
+            unattended_upgrade_period = int(match.group(1))
+    return unattended_upgrade_period
+
+
+def check_single_pass(parts_dir):
+    exit_code, message = unattended_upgrades.check_config(unattended_upgrades.read_apt_config(parts_dir), parts_dir)
+    return message if exit_code == unattended_upgrades.OK else None
+
+
+def main(args):
+    results = {}
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for filler_files_count in args.filler_files:
+            parts_dir = run_benchmarks.create_apt_config_tree(
+                os.path.join(temp_dir, str(filler_files_count)), filler_files_count
+            )
+            assert check_single_pass(parts_dir) == check_per_regex(parts_dir) == 1
+            results[f"apt_tree_{filler_files_count}_fillers"] = result = {}
+            for variant, check_function in (("single_pass_us", check_single_pass), ("per_regex_us", check_per_regex)):
+                result[variant] = round(
+                    timeit.timeit(lambda: check_function(parts_dir), number=args.iterations) / args.iterations * 1e6,
+                    2,
+                )
+    finally:
+        shutil.rmtree(temp_dir)
+
+    for name, result in results.items():
+        print(f"{name}:")
+        for key, value in result.items():
+            print(f"    {key}: {value}")
+    if args.json_output:
+        with open(args.json_output, "w") as json_f:
+            json.dump(results, json_f, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark unattended_upgrades.py configuration checks")
+    parser.add_argument(
+        "-n", "--iterations", dest="iterations", type=int, default=500,
+        help="Number of check runs per tree (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-f", "--filler-files", dest="filler_files", type=int, nargs="+", default=[0, 30, 300],
+        help="Numbers of filler parts with unrelated settings in the tree (default: %(default)s)",
+    )
+    parser.add_argument("-j", "--json", dest="json_output", default=None, help="Write results to a JSON file")
+
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+import os
+import sys
+import statistics
+import subprocess
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_import_time(command, env=None):
+    # -X importtime writes "import time: self [us] | cumulative | imported package"
+    # lines to stderr. Top-level imports are the ones without leading spaces in the
+    # package column
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime"] + command,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        env=env,
+    ).stderr
+    total_us = 0
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        total_us += int(self_us)
+        if not module[1:].startswith(" "):
+            modules[module.strip()] = int(cumulative_us)
+    return total_us, modules
+
+
+def get_import_time_summary(command, env=None, top_count=5):
+    total_us, modules = get_import_time(command, env=env)
+    return {
+        "import_time_total_ms": round(total_us / 1000, 2),
+        "import_time_top_modules_ms": {
+            module: round(cumulative_us / 1000, 2)
+            for module, cumulative_us in sorted(modules.items(), key=lambda x: x[1], reverse=True)[:top_count]
+        },
+    }
+
+
+def get_wall_times(command, iterations, env=None):
+    wall_times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        completed_proc = subprocess.run(
+            [sys.executable] + command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env
+        )
+        wall_times.append(time.perf_counter() - start)
+    return wall_times, completed_proc
+
+
+def get_wall_time_summary(wall_times):
+    wall_times = sorted(wall_times)
+    return {
+        "median_ms": round(statistics.median(wall_times) * 1000, 2),
+        "min_ms": round(wall_times[0] * 1000, 2),
+        "p90_ms": round(wall_times[min(len(wall_times) - 1, int(len(wall_times) * 0.9))] * 1000, 2),
+    }
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO_DIR, encoding="utf-8", stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Benchmark suite for Python plugins: cold start (--help), -X importtime breakdown
+# and end-to-end latency of real checks against local stand-ins (fake seaf-cli and
+# dpkg, seaf-daemon RPC, replay server with ISP portal page fixtures, generated apt
+# config and status files).
+#
+# Results are written as JSON, compare two runs with:
+#   benchmarks/run_benchmarks.py -o new.json --compare old.json
+
+import os
+import sys
+import argparse
+import datetime
+import json
+import platform
+import shutil
+import tempfile
+
+import benchmark_utils
+
+sys.path.insert(0, os.path.join(benchmark_utils.REPO_DIR, "check_seafile_sync"))
+import seaf_daemon_standin  # noqa: E402
+
+sys.path.insert(0, os.path.join(benchmark_utils.REPO_DIR, "check_balance"))
+import http_fixtures  # noqa: E402
+
+STANDINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "standins")
+
+
+def plugin_path(relative_path):
+    return os.path.join(benchmark_utils.REPO_DIR, relative_path)
+
+
+def create_status_fleet(fleet_dir, fleet_size):
+    os.makedirs(fleet_dir)
+    # Same format as 'date -Iseconds'
+    timestamp = datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
+    for i in range(fleet_size):
+        with open(os.path.join(fleet_dir, f"status{i:05d}"), "w") as status_f:
+            status_f.write(f"{timestamp};OK;job {i} has finished successfully\n")
+    return os.path.join(fleet_dir, "status00000")
+
+
+def create_apt_config_tree(root_dir, filler_files_count=30):
+    # Files are typical for Ubuntu server, plus some filler files with unrelated settings
+    parts_dir = os.path.join(root_dir, "etc", "apt", "apt.conf.d")
+    os.makedirs(parts_dir)
+    parts = {
+        "20auto-upgrades": (
+            'APT::Periodic::Update-Package-Lists "1";\n'
+            'APT::Periodic::Unattended-Upgrade "1";\n'
+            'APT::Periodic::Download-Upgradeable-Packages "1";\n'
+            'APT::Periodic::AutocleanInterval "7";\n'
+        ),
+        "50unattended-upgrades": (
+            "// Automatically upgrade packages from these (origin:archive) pairs\n"
+            "Unattended-Upgrade::Allowed-Origins {\n"
+            '        "${distro_id}:${distro_codename}";\n'
+            '        "${distro_id}:${distro_codename}-security";\n'
+            '        "${distro_id}ESMApps:${distro_codename}-apps-security";\n'
+            '        "${distro_id}ESM:${distro_codename}-infra-security";\n'
+            '        "${distro_id}:${distro_codename}-updates";\n'
+            '//      "${distro_id}:${distro_codename}-proposed";\n'
+            "};\n"
+            "Unattended-Upgrade::Package-Blacklist {\n};\n"
+            '//Unattended-Upgrade::Automatic-Reboot "false";\n'
+        ),
+    }
+    for i in range(filler_files_count):
+        parts[f"{i + 60:02d}filler{i}"] = "".join(
+            f'Filler{i}::Option{j} "{j}";\n// comment line {j}\n' for j in range(20)
+        )
+    for name, contents in parts.items():
+        with open(os.path.join(parts_dir, name), "w") as part_f:
+            part_f.write(contents)
+    return parts_dir
+
+
+def create_accounts_file(file_name, accounts_count=12):
+    providers = ("dialog", "dialog-new", "sovatel")
+    with open(file_name, "w") as accounts_f:
+        json.dump(
+            [
+                {"login": f"{i:07d}", "password": "password", "provider": providers[i % len(providers)]}
+                for i in range(accounts_count)
+            ],
+            accounts_f,
+        )
+    return file_name
+
+
+def get_scenarios(temp_dir, args, seafile_conf_dir, replay_url):
+    status_file_name = create_status_fleet(os.path.join(temp_dir, "status"), args.fleet_size)
+    accounts_file_name = create_accounts_file(os.path.join(temp_dir, "accounts.json"))
+    apt_config_dir = create_apt_config_tree(os.path.join(temp_dir, "apt"))
+
+    status_plugin = plugin_path("check_status_file/check_status_file.py")
+    balance_plugin = plugin_path("check_balance/check_balance.py")
+    return {
+        # plugin name: (plugin path, {scenario name: command arguments})
+        "check_status_file": (
+            status_plugin,
+            {
+                "single": [status_file_name],
+                f"directory_{args.fleet_size}": ["-d", os.path.dirname(status_file_name)],
+            },
+        ),
+        "check_seafile_sync": (
+            plugin_path("check_seafile_sync/check_seafile_sync.py"),
+            # Default config directory doesn't exist in benchmark home, so 'status'
+            # measures seaf-cli fallback
+            {"status": [], "status_rpc": ["-C", seafile_conf_dir]},
+        ),
+        "check_balance": (
+            balance_plugin,
+            {
+                "dialog": ["0000000", "password", "-p", "dialog", "--base-url", replay_url],
+                "dialog-new": ["0000000", "password", "-p", "dialog-new", "--base-url", replay_url],
+                "sovatel": ["0000000", "password", "-p", "sovatel", "--base-url", replay_url],
+                # Logs in on the first iteration only
+                "dialog-new-session-cache": [
+                    "0000000", "password", "-p", "dialog-new", "-s", "--base-url", replay_url
+                ],
+                "accounts_12": ["-A", accounts_file_name, "--base-url", replay_url],
+                # Served from result cache after the first iteration
+                "dialog-new-result-cache": [
+                    "0000000", "password", "-p", "dialog-new", "-t", "3600", "--base-url", replay_url
+                ],
+            },
+        ),
+        "check_expiry_date": (
+            plugin_path("check_balance/check_expiry_date.py"),
+            {"pureservers": ["user@example.com", "password", "-p", "pureservers", "--base-url", replay_url]},
+        ),
+        "unattended_upgrades": (
+            plugin_path("check_ubuntu_unattended_upgrades/unattended_upgrades.py"),
+            {"apt_tree": ["-d", apt_config_dir]},
+        ),
+        "zabbix_item_wrapper": (
+            plugin_path("tools/zabbix_item_wrapper.py"),
+            {"check_status_file": [sys.executable, status_plugin, status_file_name]},
+        ),
+    }
+
+
+def run_benchmarks(args):
+    temp_dir = tempfile.mkdtemp()
+    server, replay_url = http_fixtures.start_replay_server()
+    seafile_conf_dir = os.path.join(temp_dir, "ccnet")
+    seaf_daemon = seaf_daemon_standin.start_standin(
+        seafile_conf_dir,
+        [{"name": f"library{i:04d}", "state": "synchronized"} for i in range(args.seafile_libraries)],
+    )
+    try:
+        env = dict(os.environ)
+        env.update(
+            {
+                "PATH": STANDINS_DIR + os.pathsep + env.get("PATH", ""),
+                "BENCH_SEAFILE_LIBRARIES": str(args.seafile_libraries),
+                # Plugins that keep state in home directory (seafile) don't touch the real one
+                "HOME": os.path.join(temp_dir, "home"),
+            }
+        )
+
+        results = {}
+        for plugin_name, (plugin, scenarios) in get_scenarios(temp_dir, args, seafile_conf_dir, replay_url).items():
+            if args.plugins and plugin_name not in args.plugins:
+                continue
+            print(f"Benchmarking {plugin_name}", file=sys.stderr)
+            startup_times, _ = benchmark_utils.get_wall_times([plugin, "--help"], args.iterations, env=env)
+            plugin_results = {"startup": benchmark_utils.get_wall_time_summary(startup_times)}
+            first_scenario = next(iter(scenarios.values()))
+            plugin_results.update(benchmark_utils.get_import_time_summary([plugin] + first_scenario, env=env))
+            plugin_results["scenarios"] = {}
+            for scenario_name, scenario_args in scenarios.items():
+                wall_times, completed_proc = benchmark_utils.get_wall_times(
+                    [plugin] + scenario_args, args.iterations, env=env
+                )
+                scenario_results = benchmark_utils.get_wall_time_summary(wall_times)
+                scenario_results["exit_code"] = completed_proc.returncode
+                output_lines = completed_proc.stdout.decode("utf-8", errors="replace").splitlines()
+                scenario_results["output"] = output_lines[0] if output_lines else ""
+                plugin_results["scenarios"][scenario_name] = scenario_results
+            results[plugin_name] = plugin_results
+
+        return {
+            "revision": benchmark_utils.get_git_revision(),
+            "python": platform.python_version(),
+            "timestamp": datetime.datetime.now().astimezone().replace(microsecond=0).isoformat(),
+            "iterations": args.iterations,
+            "plugins": results,
+        }
+    finally:
+        server.shutdown()
+        seaf_daemon.shutdown()
+        seaf_daemon.server_close()
+        shutil.rmtree(temp_dir)
+
+
+def print_comparison(old_results, new_results):
+    def format_delta(old_value, new_value):
+        if old_value is None:
+            return f"{'-':>10} {new_value:>10.2f}"
+        return f"{old_value:>10.2f} {new_value:>10.2f} {(new_value - old_value) / old_value * 100:>+8.1f}%"
+
+    print(f"{'':<45} {old_results.get('revision') or 'old':>10.10} {new_results.get('revision') or 'new':>10.10}")
+    for plugin_name, plugin_results in new_results["plugins"].items():
+        old_plugin_results = old_results["plugins"].get(plugin_name, {})
+        rows = [
+            ("startup median, ms", old_plugin_results.get("startup", {}).get("median_ms"),
+                plugin_results["startup"]["median_ms"]),
+            ("import time, ms", old_plugin_results.get("import_time_total_ms"),
+                plugin_results["import_time_total_ms"]),
+        ]
+        for scenario_name, scenario_results in plugin_results["scenarios"].items():
+            old_scenario_results = old_plugin_results.get("scenarios", {}).get(scenario_name, {})
+            rows.append(
+                (f"{scenario_name} median, ms", old_scenario_results.get("median_ms"), scenario_results["median_ms"])
+            )
+        for row_name, old_value, new_value in rows:
+            print(f"{plugin_name + ' ' + row_name:<45} {format_delta(old_value, new_value)}")
+
+
+def main(args):
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as output_f:
+            json.dump(results, output_f, indent=4, ensure_ascii=False)
+    else:
+        print(json.dumps(results, indent=4, ensure_ascii=False))
+    if args.compare:
+        with open(args.compare) as compare_f:
+            print_comparison(json.load(compare_f), results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark suite for Python plugins")
+    parser.add_argument("plugins", nargs="*", help="Plugins to benchmark (default: all)")
+    parser.add_argument(
+        "-n", "--iterations", dest="iterations", type=int, default=10,
+        help="Number of invocations per scenario (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-f", "--fleet-size", dest="fleet_size", type=int, default=1000,
+        help="Number of generated status files (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-s", "--seafile-libraries", dest="seafile_libraries", type=int, default=20,
+        help="Number of libraries reported by fake seaf-cli and seaf-daemon (default: %(default)d)",
+    )
+    parser.add_argument("-o", "--output", dest="output", default=None, help="Write JSON results to a file")
+    parser.add_argument("-c", "--compare", dest="compare", default=None, help="JSON results to compare with")
+
+    main(parser.parse_args())
@@ -0,0 +1,71 @@
+import os
+import sys
+import subprocess
+import unittest
+
+import benchmark_utils
+
+# Import time of a plugin module (cumulative, with everything it imports at module
+# level), milliseconds. Measured with -X importtime, the best of ATTEMPTS runs.
+# Interpreter startup itself is not included. Values are a few times what the
+# plugins take on a developer machine: a failure means a heavy import has moved
+# back to module level, not noise. STARTUP_BUDGET_FACTOR environment variable
+# scales all budgets for slow machines
+STARTUP_BUDGETS_MS = {
+    "check_balance/check_balance.py": 50,
+    "check_balance/check_expiry_date.py": 50,
+    "check_status_file/check_status_file.py": 40,
+    "check_seafile_sync/check_seafile_sync.py": 60,
+    "check_ubuntu_unattended_upgrades/unattended_upgrades.py": 40,
+    # Zabbix runs it on every poll of an item
+    "tools/zabbix_item_wrapper.py": 60,
+}
+# Imported only by the code paths that need them
+DEFERRED_MODULES = {
+    "check_balance/check_balance.py": ["requests", "lxml", "dateutil", "http_fixtures", "subprocess"],
+    "check_balance/check_expiry_date.py": ["requests", "playwright", "http_fixtures", "concurrent.futures"],
+    "tools/zabbix_item_wrapper.py": ["concurrent.futures", "socket"],
+}
+ATTEMPTS = 3
+
+
+def get_plugin_env(plugin):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(benchmark_utils.REPO_DIR, os.path.dirname(plugin))
+    return env
+
+
+def get_module_name(plugin):
+    return os.path.splitext(os.path.basename(plugin))[0]
+
+
+class startup_budget_FunctionalTests(unittest.TestCase):
+    def test_import_time(self):
+        """Should import every plugin module within its startup budget"""
+        factor = float(os.environ.get("STARTUP_BUDGET_FACTOR", "1"))
+        for plugin, budget_ms in STARTUP_BUDGETS_MS.items():
+            module_name = get_module_name(plugin)
+            import_times_ms = []
+            for _ in range(ATTEMPTS):
+                _, modules = benchmark_utils.get_import_time(
+                    ["-c", f"import {module_name}"], env=get_plugin_env(plugin)
+                )
+                import_times_ms.append(modules[module_name] / 1000)
+            with self.subTest(plugin=plugin):
+                self.assertLessEqual(
+                    min(import_times_ms), budget_ms * factor,
+                    f"{plugin} import takes {min(import_times_ms):.1f}ms, budget is {budget_ms * factor:.1f}ms",
+                )
+
+    def test_deferred_imports(self):
+        """Should not import heavy modules at module level"""
+        for plugin, deferred_modules in DEFERRED_MODULES.items():
+            loaded_modules = subprocess.run(
+                [sys.executable, "-c", f"import sys, {get_module_name(plugin)}; print(' '.join(sys.modules))"],
+                stdout=subprocess.PIPE,
+                encoding="utf-8",
+                env=get_plugin_env(plugin),
+                check=True,
+            ).stdout.split()
+            with self.subTest(plugin=plugin):
+                self.assertEqual([x for x in deferred_modules if x in loaded_modules], [])
@@ -3,15 +3,21 @@
 
 import os
 import sys
-import requests
 import datetime
-import dateutil.relativedelta
-import dateutil.tz
 import time
 import argparse
+import codecs
+import fcntl
+import functools
+import json
 import locale
+import threading
 import traceback
-import lxml.etree
+import types
+
+# requests, lxml, dateutil and http_fixtures are imported where they are used:
+# --help, argument errors and result cache hits don't pay for them. Startup time
+# is checked by benchmarks/test_startup_budget.py
 
 # Nagios status codes
 STATUS_UNKNOWN = -1
@@ -24,12 +30,42 @@ STATUS_NAMES = {
     STATUS_CRITICAL: "CRITICAL",
     STATUS_UNKNOWN: "UNKNOWN",
 }
+# From best to worst, for worst-of results of many accounts
+STATUS_SEVERITY = [STATUS_OK, STATUS_WARNING, STATUS_UNKNOWN, STATUS_CRITICAL]
+# Status names in check_status_file.py status files
+STATUS_FILE_NAMES = {
+    STATUS_OK: "OK",
+    STATUS_WARNING: "WARNING",
+    STATUS_CRITICAL: "CRITICAL",
+    STATUS_UNKNOWN: "ERROR",
+}
 
-locale.setlocale(locale.LC_ALL, "")
+CACHE_DIR = "~/.cache/cheretbe/nagios-plugins"
 
 options = None
 
 
+# Options that can be set per account in an accounts file: (JSON value types,
+# description for errors). Others (jobs, status_dir, etc.) apply to the whole run
+ACCOUNT_OPTIONS = {
+    "name": ((str,), "a string"),
+    "login": ((str,), "a string"),
+    "password": ((str,), "a string"),
+    "provider": ((str,), "a string"),
+    "warning_threshold": ((int,), "an integer"),
+    "critical_threshold": ((int,), "an integer"),
+    "withdrawal_day": ((int,), "an integer"),
+    "withdrawal_amount": ((int,), "an integer"),
+    "session_cache": ((str, type(None)), "a string or null"),
+    "cache_ttl": ((int, type(None)), "an integer or null"),
+    "cache_max_age": ((int,), "an integer"),
+}
+
+
+class AccountsFileError(Exception):
+    pass
+
+
 def print_with_timestamp(msg):
     print("{} {}".format(datetime.datetime.now().strftime("%x %X"), msg))
 
@@ -48,98 +84,197 @@ def check_http_reply(reply):
         )
 
 
-def get_next_withdrawal_date():
+def get_next_withdrawal_date(options):
     if datetime.date.today().day >= options.withdrawal_day:
         month_offset = 1
     else:
         month_offset = 0
+    import dateutil.relativedelta
+
     return datetime.date.today() + dateutil.relativedelta.relativedelta(
         months=month_offset, day=options.withdrawal_day
     )
 
 
-def do_check_balance():
-    session = requests.session()
-    if options.provider in ["dialog", "dialog-new"]:
-        check_http_reply(session.get("https://stats.tis-dialog.ru/"))
-        post_data = {"login": options.login, "passv": options.password}
-        check_http_reply(
-            session.post("https://stats.tis-dialog.ru/index.php", data=post_data)
-        )
-        response = session.get(
-            "https://stats.tis-dialog.ru/index.php?phnumber={}".format(options.login)
-        )
-        check_http_reply(response)
-        # Fix encoding
-        response.encoding = response.apparent_encoding
-        # Easy way to find xpath is to save reply as html, open in Chrome and
-        # use "Inspect" > right click "Copy" > "Copy XPath"
-        balance_str = (
-            lxml.etree.HTML(response.text)
-            .xpath("/html/body/div/main/div[2]/table[1]/tr[4]/td[2]")[0]
-            .text
-        )
-        print_verbose("Balance as string: {}".format(balance_str))
-        balance = float(balance_str.replace(" руб.", "").replace(",", "."))
-        if options.provider == "dialog-new":
-            response = session.get("https://stats.tis-dialog.ru/index.php?mod=payments")
-            check_http_reply(response)
-            response.encoding = response.apparent_encoding
-            if options.verbose:
-                print_verbose("Deposits and withdrawals:")
-                for table_row in lxml.etree.HTML(response.text).xpath(
-                    "/html/body/div/main/div[2]/table[1]/tr"
-                ):
-                    print("    " + "; ".join(i.text for i in table_row.getchildren()))
-            # import ipdb
-            # ipdb.set_trace()
-            todays_withdrawal_entry = lxml.etree.HTML(response.text).xpath(
-                '/html/body/div/main/div[2]/table[1]/tr[td[1][text() = "{}"] and td[2][text() = "{}"]]'.format(
-                    # "07.07.2023",
-                    # .today()?
-                    datetime.datetime.now().strftime("%d.%m.%Y"),
-                    "-{},00".format(
-                        "{:,d}".format(options.withdrawal_amount).replace(",", " ")
-                    ),
-                )
-            )
-            todays_withdrawal = len(todays_withdrawal_entry) != 0
-            last_withdrawal_amount = (
-                lxml.etree.HTML(response.text)
-                .xpath(
-                    '/html/body/div/main/div[2]/table[1]/tr[td[2][starts-with(text(),"-")]]/td[2]'
-                )[0]
-                .text
-            )
-            print_verbose(f"Last withdrawal amount: {last_withdrawal_amount}")
-        session.get("https://stats.tis-dialog.ru/index.php?mod=exit")
-    else:
-        check_http_reply(session.get("https://stat.sovatelecom.ru/"))
-        post_data = {
-            "LOGIN": options.login,
-            "PASSWD": options.password,
-            "URL": "stat.sovatelecom.ru",
-            "domain": "",
-            "subm": "Вход",
+def get_session_cache_file_name(options, host):
+    if options.session_cache:
+        return os.path.expanduser(options.session_cache)
+    # One file per account, dialog and dialog-new share it
+    return os.path.join(
+        os.path.expanduser(CACHE_DIR),
+        "check_balance_{}_{}.json".format(host, options.login.replace(os.sep, "_")),
+    )
+
+
+def get_session_cookies(session):
+    return [
+        {
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "expires": cookie.expires,
+            "secure": cookie.secure,
         }
-        check_http_reply(
-            session.post("https://stat.sovatelecom.ru/login_user.htms", data=post_data)
-        )
-        response = session.get("https://stat.sovatelecom.ru/main.htms")
+        for cookie in session.cookies
+    ]
+
+
+def load_session_cookies(session, cookie_file_name):
+    # Returns loaded cookies (empty list if there is no cache or it is damaged,
+    # the file is overwritten after a fresh login then)
+    try:
+        with open(cookie_file_name) as cookie_f:
+            cookies = json.load(cookie_f)
+        for cookie in cookies:
+            session.cookies.set(**cookie)
+    except FileNotFoundError:
+        return []
+    except (ValueError, TypeError) as e:
+        print_verbose("Ignoring damaged cookie file '{}': {}".format(cookie_file_name, e))
+        session.cookies.clear()
+        return []
+    session.cookies.clear_expired_cookies()
+    print_verbose("Loaded {} cookie(s) from '{}'".format(len(cookies), cookie_file_name))
+    return cookies
+
+
+def save_session_cookies(session, cookie_file_name):
+    # Cookies are credentials: the file is created with 0600 permissions
+    os.makedirs(os.path.dirname(cookie_file_name), mode=0o700, exist_ok=True)
+    temp_file_name = "{}.{}.tmp".format(cookie_file_name, os.getpid())
+    cookie_fd = os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(cookie_fd, "w") as cookie_f:
+        json.dump(get_session_cookies(session), cookie_f)
+    os.replace(temp_file_name, cookie_file_name)
+    print_verbose("Saved session cookies to '{}'".format(cookie_file_name))
+
+
+def is_login_page(response, password_field):
+    # An expired session gets the login form instead of the requested page
+    return 'name="{}"'.format(password_field) in response.text
+
+
+def get_page(session, url, login, options, password_field, session_cached):
+    # Logs in first unless a cached session is used. If the cached session has
+    # expired, logs in and requests the page again
+    if not session_cached:
+        login(session, options)
+    response = session.get(url)
+    check_http_reply(response)
+    if session_cached and is_login_page(response, password_field):
+        print_verbose("Cached session has expired, logging in")
+        login(session, options)
+        response = session.get(url)
         check_http_reply(response)
-        balance_str = (
-            lxml.etree.HTML(response.text)
-            .xpath(
-                '//*[@id="onyma_stat_main_fin"]/table[1]/tr[2]/td[1]/table[2]/tr[1]/td[1]/table[1]/tr[last()]/td[2]'
-            )[0]
-            .text
+    return response
+
+
+def login_dialog(session, options):
+    check_http_reply(session.get("https://stats.tis-dialog.ru/"))
+    post_data = {"login": options.login, "passv": options.password}
+    check_http_reply(
+        session.post("https://stats.tis-dialog.ru/index.php", data=post_data)
+    )
+
+
+def login_sovatel(session, options):
+    check_http_reply(session.get("https://stat.sovatelecom.ru/"))
+    post_data = {
+        "LOGIN": options.login,
+        "PASSWD": options.password,
+        "URL": "stat.sovatelecom.ru",
+        "domain": "",
+        "subm": "Вход",
+    }
+    check_http_reply(
+        session.post("https://stat.sovatelecom.ru/login_user.htms", data=post_data)
+    )
+
+
+def format_amount(amount):
+    # Amount as shown on dialog payments page: "-1 234,00"
+    return "-{},00".format("{:,d}".format(amount).replace(",", " "))
+
+
+def get_xpath_variables(options):
+    # Available in page URL templates as {name} and in XPath expressions as $name
+    return {
+        "login": options.login,
+        "today": datetime.datetime.now().strftime("%d.%m.%Y"),
+        "withdrawal_amount": format_amount(options.withdrawal_amount),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def compile_xpath(expression):
+    import lxml.etree
+
+    return lxml.etree.XPath(expression)
+
+
+def extract_page_values(page_text, extractors, variables):
+    # Parses the page once and evaluates all extractors on the same tree. XPath
+    # expressions are compiled on first use and reused by later pages and accounts.
+    # Returns {name: XPath result}
+    import lxml.etree
+
+    document = lxml.etree.HTML(page_text)
+    return {name: compile_xpath(expression)(document, **variables) for name, expression in extractors.items()}
+
+
+def get_balance_thresholds_status(options, balance):
+    if balance < options.critical_threshold:
+        return (
+            STATUS_CRITICAL,
+            "Balance {} is less than critical threshold of {}".format(
+                balance, options.critical_threshold
+            ),
         )
-        print_verbose("Balance as string: {}".format(balance_str))
-        balance = float(
-            balance_str.replace("Остаток\xa0:\xa0", "")
-            .replace(" RUB", "")
-            .replace(",", "")
+    elif balance < options.warning_threshold:
+        return (
+            STATUS_WARNING,
+            "Balance {} is less than warning threshold of {}".format(
+                balance, options.warning_threshold
+            ),
         )
+    else:
+        return (STATUS_OK, "Balance is {}".format(balance))
+
+
+def get_balance_status(options, data):
+    return get_balance_thresholds_status(options, data["balance"]) + ({"balance": data["balance"]},)
+
+
+def get_dialog_balance(values):
+    balance_str = values["balance"][0].text
+    print_verbose("Balance as string: {}".format(balance_str))
+    balance = float(balance_str.replace(" руб.", "").replace(",", "."))
+    print_verbose("Balance: {}".format(balance))
+    return balance
+
+
+def get_dialog_data(options, values):
+    return {"balance": get_dialog_balance(values)}
+
+
+def get_dialog_new_data(options, values):
+    balance = get_dialog_balance(values)
+    last_withdrawal_amount = values["last_withdrawal_amount"]
+    if last_withdrawal_amount is None:
+        raise Exception("No withdrawals found on payments page")
+    print_verbose(f"Last withdrawal amount: {last_withdrawal_amount}")
+    return {
+        "balance": balance,
+        # Date is kept instead of a flag, so cached data is still correct the next day
+        "withdrawal_date": datetime.date.today().isoformat() if values["todays_withdrawal"] else None,
+        "last_withdrawal_amount": last_withdrawal_amount,
+    }
+
+
+def get_dialog_new_status(options, data):
+    balance = data["balance"]
+    todays_withdrawal = data["withdrawal_date"] == datetime.date.today().isoformat()
 
     # # DEBUG
     # balance = 5.57
@@ -147,58 +282,530 @@ def do_check_balance():
     # # todays_withdrawal = False
     # todays_withdrawal = True
 
-    print_verbose("Balance: {}".format(balance))
+    return get_withdrawal_status(options, balance, todays_withdrawal, data["last_withdrawal_amount"]) + (
+        {"balance": balance},
+    )
 
-    if options.provider == "dialog-new":
-        next_withdrawal_date = get_next_withdrawal_date()
-        if datetime.datetime.today().day == options.withdrawal_day:
-            if not todays_withdrawal:
-                next_withdrawal_date = datetime.datetime.today().date()
-        if balance < 0:
+
+def get_withdrawal_status(options, balance, todays_withdrawal, last_withdrawal_amount):
+    next_withdrawal_date = get_next_withdrawal_date(options)
+    if datetime.datetime.today().day == options.withdrawal_day:
+        if not todays_withdrawal:
             next_withdrawal_date = datetime.datetime.today().date()
-        days_until_withdrawal = (next_withdrawal_date - datetime.date.today()).days
-
-        status_text = "Balance: {}, next withdrawal: {} (in {} day(s)), account: {}, amount: {}".format(
-            balance,
-            next_withdrawal_date,
-            days_until_withdrawal,
-            options.login,
-            options.withdrawal_amount,
-        )
-        expected_withdrawal_amount = "-{},00".format(
-            "{:,d}".format(options.withdrawal_amount).replace(",", " ")
+    if balance < 0:
+        next_withdrawal_date = datetime.datetime.today().date()
+    days_until_withdrawal = (next_withdrawal_date - datetime.date.today()).days
+
+    status_text = "Balance: {}, next withdrawal: {} (in {} day(s)), account: {}, amount: {}".format(
+        balance,
+        next_withdrawal_date,
+        days_until_withdrawal,
+        options.login,
+        options.withdrawal_amount,
+    )
+    if last_withdrawal_amount != format_amount(options.withdrawal_amount):
+        return (
+            STATUS_CRITICAL,
+            f"Unexpected withdrawal of {last_withdrawal_amount}. {status_text}",
         )
-        if last_withdrawal_amount != expected_withdrawal_amount:
-            return (
-                STATUS_CRITICAL,
-                f"Unexpected withdrawal of {last_withdrawal_amount}. {status_text}",
-            )
-        if balance < options.withdrawal_amount:
-            if days_until_withdrawal < options.critical_threshold:
-                return (STATUS_CRITICAL, status_text)
-            elif days_until_withdrawal < options.warning_threshold:
-                return (STATUS_WARNING, status_text)
-            else:
-                return (STATUS_OK, status_text)
+    if balance < options.withdrawal_amount:
+        if days_until_withdrawal < options.critical_threshold:
+            return (STATUS_CRITICAL, status_text)
+        elif days_until_withdrawal < options.warning_threshold:
+            return (STATUS_WARNING, status_text)
         else:
             return (STATUS_OK, status_text)
     else:
-        if balance < options.critical_threshold:
-            return (
-                STATUS_CRITICAL,
-                "Balance {} is less than critical threshold of {}".format(
-                    balance, options.critical_threshold
-                ),
-            )
-        elif balance < options.warning_threshold:
-            return (
-                STATUS_WARNING,
-                "Balance {} is less than warning threshold of {}".format(
-                    balance, options.warning_threshold
-                ),
+        return (STATUS_OK, status_text)
+
+
+def get_sovatel_data(options, values):
+    balance_str = values["balance"][0].text
+    print_verbose("Balance as string: {}".format(balance_str))
+    balance = float(
+        balance_str.replace("Остаток\xa0:\xa0", "")
+        .replace(" RUB", "")
+        .replace(",", "")
+    )
+    print_verbose("Balance: {}".format(balance))
+    return {"balance": balance}
+
+
+class PaymentsTableTarget:
+    """lxml parser target for dialog payments table (/html/body/div/main/div[2]/table[1]/tr)
+
+    No tree is built: cell texts of the current row are the only data kept. Rows are
+    newest first, so after the first withdrawal and a row older than today nothing
+    else can change the result and 'done' is set
+    """
+
+    TABLE_PATH = (("html", None), ("body", None), ("div", None), ("main", None), ("div", 2), ("table", 1))
+
+    def __init__(self, today, withdrawal_amount, print_rows=False):
+        self.today = today
+        self.today_date = datetime.datetime.strptime(today, "%d.%m.%Y").date()
+        self.withdrawal_amount = withdrawal_amount
+        self.print_rows = print_rows
+        # Open elements: [tag, index among siblings with the same tag, {child tag: count}]
+        self.stack = []
+        self.row = None
+        self.cell = None
+        self.todays_withdrawal = False
+        self.last_withdrawal_amount = None
+        self.done = False
+
+    def in_table(self):
+        if len(self.stack) != len(self.TABLE_PATH):
+            return False
+        for (tag, index, _), (path_tag, path_index) in zip(self.stack, self.TABLE_PATH):
+            if (tag != path_tag) or (path_index not in (None, index)):
+                return False
+        return True
+
+    def start(self, tag, attrib):
+        if self.stack:
+            child_counts = self.stack[-1][2]
+            child_counts[tag] = child_counts.get(tag, 0) + 1
+            index = child_counts[tag]
+        else:
+            index = 1
+        if (tag == "tr") and self.in_table():
+            self.row = []
+        elif (self.row is not None) and (self.cell is None) and (tag in ("td", "th")):
+            self.cell = []
+        self.stack.append([tag, index, {}])
+
+    def end(self, tag):
+        self.stack.pop()
+        if (self.cell is not None) and (tag in ("td", "th")):
+            self.row.append("".join(self.cell))
+            self.cell = None
+        elif (self.row is not None) and (tag == "tr"):
+            self.process_row(self.row)
+            self.row = None
+
+    def data(self, data):
+        # Only text directly in a cell, same as element.text
+        if (self.cell is not None) and (self.stack[-1][0] in ("td", "th")):
+            self.cell.append(data)
+
+    def close(self):
+        return self
+
+    def process_row(self, row):
+        if self.print_rows:
+            print("    " + "; ".join(row))
+        if (len(row) < 2) or self.done:
+            return
+        if (row[0] == self.today) and (row[1] == self.withdrawal_amount):
+            self.todays_withdrawal = True
+        if (self.last_withdrawal_amount is None) and row[1].startswith("-"):
+            self.last_withdrawal_amount = row[1]
+        if (self.last_withdrawal_amount is not None) and not self.print_rows:
+            try:
+                row_date = datetime.datetime.strptime(row[0], "%d.%m.%Y").date()
+            except ValueError:
+                return
+            if self.todays_withdrawal or (row_date < self.today_date):
+                self.done = True
+
+
+def parse_payments(chunks, variables, print_rows=False):
+    # chunks: iterable of page text pieces. Stops consuming them as soon as the
+    # result is known (all rows are read if they are printed)
+    import lxml.etree
+
+    target = PaymentsTableTarget(variables["today"], variables["withdrawal_amount"], print_rows)
+    parser = lxml.etree.HTMLParser(target=target)
+    for chunk in chunks:
+        parser.feed(chunk)
+        if target.done:
+            break
+    parser.close()
+    return {"todays_withdrawal": target.todays_withdrawal, "last_withdrawal_amount": target.last_withdrawal_amount}
+
+
+def iter_response_text(response, chunk_size=65536):
+    # Decoded response body pieces. Without charset in HTTP headers encoding is
+    # detected on the first piece, not on the whole page as response.apparent_encoding does
+    decoder = None
+    for chunk in response.iter_content(chunk_size):
+        if decoder is None:
+            encoding = response.encoding if "charset" in response.headers.get("Content-Type", "") else None
+            if encoding is None:
+                # chardet or charset_normalizer, whichever requests uses for
+                # response.apparent_encoding
+                from requests.compat import chardet
+
+                encoding = chardet.detect(chunk)["encoding"] or "utf-8"
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        yield decoder.decode(chunk)
+    if decoder is not None:
+        yield decoder.decode(b"", final=True)
+
+
+def extract_payments(options, response, variables):
+    if options.verbose:
+        print_verbose("Deposits and withdrawals:")
+    try:
+        return parse_payments(iter_response_text(response), variables, print_rows=options.verbose)
+    finally:
+        # The rest of the page is not downloaded
+        response.close()
+
+
+PROVIDERS = {}
+
+
+def register_provider(
+    name, host, login, password_field, pages, get_data, get_status, logout_url=None, fix_encoding=False
+):
+    # pages: sequence of (URL template, {value name: XPath expression}). Pages are
+    #     requested in order, the first one with login if needed. Instead of XPath
+    #     dictionary a page can have a function extract(options, response, variables)
+    #     returning {value name: value}, the response is streamed then
+    # get_data(options, {value name: XPath result}) returns JSON-serializable data
+    #     (it is what the result cache keeps)
+    # get_status(options, data) returns (status, text, {perfdata label: value})
+    # fix_encoding: detect page encoding instead of trusting HTTP headers
+    PROVIDERS[name] = types.SimpleNamespace(
+        name=name,
+        host=host,
+        login=login,
+        password_field=password_field,
+        pages=pages,
+        get_data=get_data,
+        get_status=get_status,
+        logout_url=logout_url,
+        fix_encoding=fix_encoding,
+    )
+
+
+# Easy way to find xpath is to save reply as html, open in Chrome and
+# use "Inspect" > right click "Copy" > "Copy XPath"
+DIALOG_MAIN_PAGE = (
+    "https://stats.tis-dialog.ru/index.php?phnumber={login}",
+    {"balance": "/html/body/div/main/div[2]/table[1]/tr[4]/td[2]"},
+)
+# Payments history of old accounts is years long, it is parsed as a stream
+DIALOG_PAYMENTS_PAGE = ("https://stats.tis-dialog.ru/index.php?mod=payments", extract_payments)
+SOVATEL_MAIN_PAGE = (
+    "https://stat.sovatelecom.ru/main.htms",
+    {
+        "balance": (
+            '//*[@id="onyma_stat_main_fin"]/table[1]/tr[2]/td[1]/table[2]/tr[1]/td[1]/table[1]/tr[last()]/td[2]'
+        )
+    },
+)
+
+register_provider(
+    "dialog",
+    host="stats.tis-dialog.ru",
+    login=login_dialog,
+    password_field="passv",
+    pages=(DIALOG_MAIN_PAGE,),
+    get_data=get_dialog_data,
+    get_status=get_balance_status,
+    logout_url="https://stats.tis-dialog.ru/index.php?mod=exit",
+    fix_encoding=True,
+)
+register_provider(
+    "dialog-new",
+    host="stats.tis-dialog.ru",
+    login=login_dialog,
+    password_field="passv",
+    pages=(DIALOG_MAIN_PAGE, DIALOG_PAYMENTS_PAGE),
+    get_data=get_dialog_new_data,
+    get_status=get_dialog_new_status,
+    logout_url="https://stats.tis-dialog.ru/index.php?mod=exit",
+    fix_encoding=True,
+)
+register_provider(
+    "sovatel",
+    host="stat.sovatelecom.ru",
+    login=login_sovatel,
+    password_field="PASSWD",
+    pages=(SOVATEL_MAIN_PAGE,),
+    get_data=get_sovatel_data,
+    get_status=get_balance_status,
+)
+
+
+def fetch_balance_data(options, adapters=None):
+    # adapters: {host: requests.adapters.HTTPAdapter} shared by concurrent checks,
+    # so connections (and TLS sessions) to the same host are reused
+    provider = PROVIDERS[options.provider]
+    if (options.base_url is None) and (options.recorder is None):
+        # http_fixtures pulls in http.server, production checks don't need it
+        import requests
+
+        session = requests.session()
+    else:
+        import http_fixtures
+
+        session = http_fixtures.create_session(options.base_url, options.recorder)
+    if (adapters is not None) and not options.base_url:
+        session.mount("https://{}/".format(provider.host), adapters[provider.host])
+    cached_cookies = []
+    if options.session_cache is not None:
+        cookie_file_name = get_session_cache_file_name(options, provider.host)
+        cached_cookies = load_session_cookies(session, cookie_file_name)
+
+    variables = get_xpath_variables(options)
+    values = {}
+    for i, (url_template, extractors) in enumerate(provider.pages):
+        url = url_template.format(**variables)
+        if i == 0:
+            response = get_page(
+                session, url, provider.login, options, provider.password_field, bool(cached_cookies)
             )
         else:
-            return (STATUS_OK, "Balance is {}".format(balance))
+            response = session.get(url, stream=callable(extractors))
+            check_http_reply(response)
+        if callable(extractors):
+            values.update(extractors(options, response, variables))
+            continue
+        if provider.fix_encoding:
+            response.encoding = response.apparent_encoding
+        values.update(extract_page_values(response.text, extractors, variables))
+
+    # Logging out would invalidate the cached session
+    if (provider.logout_url is not None) and (options.session_cache is None):
+        session.get(provider.logout_url)
+    if (options.session_cache is not None) and (get_session_cookies(session) != cached_cookies):
+        save_session_cookies(session, cookie_file_name)
+
+    return provider.get_data(options, values)
+
+
+def get_result_cache_file_name(options):
+    return os.path.join(
+        os.path.expanduser(CACHE_DIR),
+        "check_balance_result_{}_{}.json".format(options.provider, options.login.replace(os.sep, "_")),
+    )
+
+
+def load_cached_data(cache_file_name):
+    # Returns (fetch time, data) or (None, None) if there is no usable cache
+    try:
+        with open(cache_file_name) as cache_f:
+            cache = json.load(cache_f)
+        return cache["fetched_at"], cache["data"]
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+
+def save_cached_data(cache_file_name, data):
+    os.makedirs(os.path.dirname(cache_file_name), mode=0o700, exist_ok=True)
+    temp_file_name = "{}.{}.{}.tmp".format(cache_file_name, os.getpid(), threading.get_ident())
+    cache_fd = os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(cache_fd, "w") as cache_f:
+        json.dump({"fetched_at": time.time(), "data": data}, cache_f)
+    os.replace(temp_file_name, cache_file_name)
+
+
+background_refresh_lock = threading.Lock()
+background_refresh_started = False
+
+
+def start_background_refresh():
+    # Same command line with --refresh-cache, detached from Nagios: the current
+    # check returns cached data right away. Started once per run, it refreshes
+    # every stale account
+    global background_refresh_started
+    with background_refresh_lock:
+        if background_refresh_started:
+            return
+        background_refresh_started = True
+    print_verbose("Cached data is stale, starting background refresh")
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--refresh-cache"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def refresh_cached_data(options, adapters, cache_file_name, wait):
+    # Fetches data under the account's lock, so concurrent checks don't all hit the
+    # portal. Returns (data, age), or (None, None) if the lock is busy and wait is False
+    os.makedirs(os.path.dirname(cache_file_name), mode=0o700, exist_ok=True)
+    with open(cache_file_name + ".lock", "a") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None, None
+        # Data could have been refreshed while we were waiting for the lock
+        fetched_at, data = load_cached_data(cache_file_name)
+        if data is not None:
+            age = max(0, int(time.time() - fetched_at))
+            if age < options.cache_ttl:
+                return data, age
+        data = fetch_balance_data(options, adapters)
+        save_cached_data(cache_file_name, data)
+        return data, 0
+
+
+def get_balance_data(options, adapters=None):
+    # Returns (data, data age in seconds or None if result cache is disabled).
+    # Cached data younger than TTL is used as is. Stale data (older than TTL, but
+    # younger than max age) is used too and is refreshed in background. Expired data
+    # is refreshed right away, by one caller at a time
+    if options.cache_ttl is None:
+        return fetch_balance_data(options, adapters), None
+    cache_file_name = get_result_cache_file_name(options)
+    fetched_at, data = load_cached_data(cache_file_name)
+    if data is not None:
+        age = max(0, int(time.time() - fetched_at))
+        if age < options.cache_ttl:
+            return data, age
+        if age < max(options.cache_max_age, options.cache_ttl):
+            if options.refresh_cache:
+                # Background refresh: skip the account if another refresh is running
+                refreshed_data, refreshed_age = refresh_cached_data(options, adapters, cache_file_name, False)
+                if refreshed_data is None:
+                    return data, age
+                return refreshed_data, refreshed_age
+            start_background_refresh()
+            return data, age
+    return refresh_cached_data(options, adapters, cache_file_name, True)
+
+
+def do_check_balance(options, adapters=None):
+    data, age = get_balance_data(options, adapters)
+    check_status, check_message, perfdata = PROVIDERS[options.provider].get_status(options, data)
+    if age is not None:
+        check_message += " (data age: {}s)".format(age)
+        perfdata["cache_age"] = "{}s".format(age)
+    return check_status, check_message, perfdata
+
+
+def apply_provider_defaults(options):
+    # For dialog-new thresholds are days until withdrawal, not balance
+    if options.provider == "dialog-new":
+        if options.warning_threshold == 200:
+            options.warning_threshold = 10
+        if options.critical_threshold == 100:
+            options.critical_threshold = 5
+
+
+def load_accounts(accounts_file_name, defaults):
+    # JSON list of accounts: [{"login": "...", "password": "...", "provider": "dialog",
+    # "name": "office"}, ...]. Options from ACCOUNT_OPTIONS (warning_threshold,
+    # withdrawal_amount, etc.) can be set per account, command line values are defaults
+    # Raises AccountsFileError if the file is not valid, before any account is checked
+    try:
+        with open(accounts_file_name, encoding="utf-8") as accounts_f:
+            accounts = json.load(accounts_f)
+    except (OSError, ValueError) as e:
+        raise AccountsFileError("Can't read accounts file '{}': {}".format(accounts_file_name, e))
+    if not isinstance(accounts, list):
+        raise AccountsFileError("Accounts file '{}' must contain a list of accounts".format(accounts_file_name))
+    accounts_options = []
+    for i, account in enumerate(accounts, 1):
+        if not isinstance(account, dict):
+            raise AccountsFileError("Account #{} is not an object".format(i))
+        for key in ("login", "password"):
+            if not isinstance(account.get(key), str) or not account[key]:
+                raise AccountsFileError("Account #{}: '{}' is missing".format(i, key))
+        unknown_keys = sorted(set(account) - set(ACCOUNT_OPTIONS))
+        if unknown_keys:
+            raise AccountsFileError("Account #{}: unknown option(s) {}".format(i, ", ".join(unknown_keys)))
+        for key, value in account.items():
+            value_types, description = ACCOUNT_OPTIONS[key]
+            # JSON true/false are bool, which is an int subclass
+            if isinstance(value, bool) or not isinstance(value, value_types):
+                raise AccountsFileError("Account #{}: '{}' must be {}, not {}".format(
+                    i, key, description, json.dumps(value)))
+        account_options = argparse.Namespace(**vars(defaults))
+        # Explicit cookie file name can't be shared by accounts
+        if account_options.session_cache is not None:
+            account_options.session_cache = ""
+        for key, value in account.items():
+            setattr(account_options, key, value)
+        if account_options.provider not in PROVIDERS:
+            raise AccountsFileError("Account #{}: unknown provider '{}' (valid providers: {})".format(
+                i, account_options.provider, ", ".join(PROVIDERS)))
+        if not getattr(account_options, "name", None):
+            account_options.name = "{}_{}".format(account_options.provider, account_options.login)
+        # Names are status file names
+        if account_options.name in [x.name for x in accounts_options]:
+            raise AccountsFileError("Account #{}: duplicate name '{}'".format(i, account_options.name))
+        apply_provider_defaults(account_options)
+        accounts_options.append(account_options)
+    return accounts_options
+
+
+def check_account(account_options, adapters, semaphores):
+    # Returns (status, text, perfdata). A failed account doesn't fail the others
+    try:
+        with semaphores[PROVIDERS[account_options.provider].host]:
+            print_verbose("Checking balance for user {} on {}".format(
+                account_options.login, account_options.provider))
+            return do_check_balance(account_options, adapters)
+    except Exception as e:
+        if account_options.verbose:
+            print(traceback.format_exc())
+        return (STATUS_CRITICAL, "Unhandled exception: {}".format(e), {})
+
+
+def check_accounts(accounts_options, jobs, provider_concurrency):
+    # Returns [(account options, (status, text, perfdata))] in accounts file order
+    import concurrent.futures
+    import requests.adapters
+
+    hosts = set(PROVIDERS[x.provider].host for x in accounts_options)
+    adapters = {
+        host: requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=provider_concurrency)
+        for host in hosts
+    }
+    semaphores = {host: threading.BoundedSemaphore(provider_concurrency) for host in hosts}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(check_account, x, adapters, semaphores) for x in accounts_options]
+        return [(x, future.result()) for x, future in zip(accounts_options, futures)]
+
+
+def get_worst_status(status_codes):
+    worst_status = STATUS_OK
+    for status_code in status_codes:
+        if STATUS_SEVERITY.index(status_code) > STATUS_SEVERITY.index(worst_status):
+            worst_status = status_code
+    return worst_status
+
+
+def write_account_status_file(status_dir, account_name, status, text):
+    # Same format as check_status_file.py reads: <timestamp>;<status>;<text>
+    status_text = text.replace(";", ",").replace("\n", " ")
+    timestamp = datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
+    status_file_name = os.path.join(status_dir, account_name.replace(os.sep, "_"))
+    temp_file_name = os.path.join(status_dir, ".{}.{}.tmp".format(os.path.basename(status_file_name), os.getpid()))
+    with open(temp_file_name, "w", encoding="utf-8") as status_f:
+        status_f.write("{};{};{}\n".format(timestamp, STATUS_FILE_NAMES[status], status_text))
+    os.replace(temp_file_name, status_file_name)
+
+
+def print_accounts_status(results):
+    exit_code = get_worst_status([result[0] for _, result in results])
+    counts = dict((status_code, 0) for status_code in STATUS_SEVERITY)
+    perfdata = []
+    for account_options, (status, _, account_perfdata) in results:
+        counts[status] += 1
+        for label, value in account_perfdata.items():
+            perfdata.append("'{} {}'={}".format(account_options.name.replace("'", "''"), label, value))
+    # Summary line with perfdata, non-OK accounts are listed in the long output
+    summary = "{} - {} account(s): {} critical, {} warning, {} unknown, {} ok".format(
+        STATUS_NAMES[exit_code], len(results), counts[STATUS_CRITICAL], counts[STATUS_WARNING],
+        counts[STATUS_UNKNOWN], counts[STATUS_OK])
+    if perfdata:
+        summary += " | " + " ".join(perfdata)
+    print(summary)
+    for account_options, (status, text, _) in results:
+        if status != STATUS_OK:
+            print("{}: {}".format(account_options.name, text))
+    return exit_code
 
 
 def main():
@@ -207,14 +814,14 @@ def main():
         parser = argparse.ArgumentParser(
             description="Custom script to check balance and write status to a file"
         )
-        parser.add_argument("login", help="User name")
-        parser.add_argument("password", help="password")
+        parser.add_argument("login", nargs="?", help="User name")
+        parser.add_argument("password", nargs="?", help="password")
         parser.add_argument(
             "-p",
             "--provider",
             dest="provider",
             default="dialog",
-            choices=["dialog", "dialog-new", "sovatel"],
+            choices=list(PROVIDERS),
             help="ISP type (default: %(default)s)",
         )
         parser.add_argument(
@@ -249,6 +856,82 @@ def main():
             default=455,
             help="Amount of monthly withdrawal (dialog-new only, default: %(default)d)",
         )
+        parser.add_argument(
+            "-s",
+            "--session-cache",
+            dest="session_cache",
+            nargs="?",
+            const="",
+            default=None,
+            help=(
+                "Keep session cookies between runs and log in only when the session has expired. "
+                "Optional value is cookie file name (default: {}/check_balance_<host>_<login>.json)".format(
+                    CACHE_DIR
+                )
+            ),
+        )
+        parser.add_argument(
+            "-t",
+            "--cache-ttl",
+            dest="cache_ttl",
+            type=int,
+            default=None,
+            help="Reuse checked data for this many seconds (result cache is disabled by default)",
+        )
+        parser.add_argument(
+            "-m",
+            "--cache-max-age",
+            dest="cache_max_age",
+            type=int,
+            default=86400,
+            help=(
+                "Data older than TTL, but younger than this many seconds is still used and is "
+                "refreshed in background (default: %(default)d)"
+            ),
+        )
+        parser.add_argument("--refresh-cache", dest="refresh_cache", action="store_true", help=argparse.SUPPRESS)
+        parser.add_argument(
+            "-A",
+            "--accounts-file",
+            dest="accounts_file",
+            default=None,
+            help="Check all accounts from a JSON file concurrently instead of a single login/password",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            dest="jobs",
+            type=int,
+            default=8,
+            help="Number of accounts checked at the same time (accounts file only, default: %(default)d)",
+        )
+        parser.add_argument(
+            "-P",
+            "--provider-concurrency",
+            dest="provider_concurrency",
+            type=int,
+            default=2,
+            help="Maximum concurrent checks per provider site (accounts file only, default: %(default)d)",
+        )
+        parser.add_argument(
+            "-o",
+            "--status-dir",
+            dest="status_dir",
+            default=None,
+            help="Also write a check_status_file.py status file per account to this directory (accounts file only)",
+        )
+        parser.add_argument(
+            "--base-url",
+            dest="base_url",
+            default=None,
+            help="Send requests to a replay server (http_fixtures.py) instead of the portal, e.g. http://127.0.0.1:8080",
+        )
+        parser.add_argument(
+            "--record",
+            dest="record_dir",
+            default=None,
+            help="Save responses with credentials scrubbed to a fixtures directory for http_fixtures.py replay",
+        )
         parser.add_argument(
             "-v",
             "--verbose",
@@ -260,23 +943,64 @@ def main():
 
         global options
         options = parser.parse_args()
+        if options.verbose:
+            # Timestamps of verbose messages in local format
+            locale.setlocale(locale.LC_ALL, "")
+        options.recorder = None
+        if options.record_dir is not None:
+            import http_fixtures
+
+            options.recorder = http_fixtures.Recorder(
+                options.record_dir,
+                [(options.login, http_fixtures.SCRUBBED_LOGIN), (options.password, http_fixtures.SCRUBBED_PASSWORD)],
+                options.base_url,
+            )
         if options.warning_threshold < options.critical_threshold:
             exit_code = STATUS_UNKNOWN
             print("Error: warning threshold cannot be less than critical")
 
-        if options.provider == "dialog-new":
-            if options.warning_threshold == 200:
-                options.warning_threshold = 10
-            if options.critical_threshold == 100:
-                options.critical_threshold = 5
+        if options.accounts_file is not None:
+            try:
+                accounts_options = load_accounts(options.accounts_file, options)
+            except AccountsFileError as e:
+                print("Error: {}".format(e))
+                return STATUS_UNKNOWN
+            # Checked before any account is, a status file can't be written otherwise
+            if options.status_dir is not None:
+                try:
+                    os.makedirs(options.status_dir, exist_ok=True)
+                    if not os.access(options.status_dir, os.W_OK | os.X_OK):
+                        raise PermissionError("permission denied")
+                except OSError as e:
+                    print("Error: Can't write to status directory '{}': {}".format(options.status_dir, e))
+                    return STATUS_UNKNOWN
+            if options.recorder is not None:
+                import http_fixtures
+
+                for account_options in accounts_options:
+                    options.recorder.add_secret(account_options.login, http_fixtures.SCRUBBED_LOGIN)
+                    options.recorder.add_secret(account_options.password, http_fixtures.SCRUBBED_PASSWORD)
+            results = check_accounts(accounts_options, options.jobs, options.provider_concurrency)
+            if options.status_dir is not None:
+                for account_options, (status, text, _) in results:
+                    write_account_status_file(options.status_dir, account_options.name, status, text)
+            exit_code = print_accounts_status(results)
+            print_verbose(f"Status: {STATUS_NAMES[exit_code]}")
+            return exit_code
+
+        if (options.login is None) or (options.password is None):
+            parser.error("login and password are required unless --accounts-file is used")
+        apply_provider_defaults(options)
 
         print_verbose(
             "Checking balance for user {} on {}".format(options.login, options.provider)
         )
 
-        check_status, check_message = do_check_balance()
+        check_status, check_message, perfdata = do_check_balance(options)
         exit_code = check_status
         print_verbose(f"Status: {STATUS_NAMES[check_status]}")
+        if options.cache_ttl is not None:
+            check_message += " | " + " ".join("{}={}".format(label, value) for label, value in perfdata.items())
         print(check_message)
 
     except Exception as e:
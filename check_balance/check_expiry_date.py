@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 
+import os
 import argparse
 import sys
+import contextlib
+import functools
 import datetime
 import traceback
 import locale
-import requests
 import json
+import time
 import types
 
+# requests, playwright and http_fixtures are imported where they are used. Startup
+# time is checked by benchmarks/test_startup_budget.py
+
 # Nagios status codes
 STATUS_UNKNOWN = -1
 STATUS_OK = 0
@@ -21,7 +27,14 @@ STATUS_NAMES = {
     STATUS_UNKNOWN: "UNKNOWN",
 }
 
-locale.setlocale(locale.LC_ALL, "")
+PURESERVERS_API_URL = "https://api.rifty.org"
+PURESERVERS_SERVICE_TYPES = ["vps"]
+CACHE_DIR = "~/.cache/cheretbe/nagios-plugins"
+# 62yun pages don't need these to log in and list servers. Stylesheets are still
+# loaded: visibility checks depend on them
+BLOCKED_RESOURCE_TYPES = ("image", "media", "font")
+# How long to wait for the logged in page when a saved session is used
+SESSION_CHECK_TIMEOUT_MS = 5000
 
 
 def print_with_timestamp(msg):
@@ -42,25 +55,238 @@ def check_http_reply(reply):
         )
 
 
+def get_pureservers_page(session, auth_session, service_type, page):
+    response = session.get(
+        f"{PURESERVERS_API_URL}/services/list",
+        params={"page": page, "getPages": "true", "type": service_type},
+        headers={"session": auth_session},
+    )
+    check_http_reply(response)
+    return response.json()
+
+
+def get_pureservers_services(session, auth_session, service_types, jobs):
+    # Returns service list of every type, in the order of service_types and then
+    # in the order of the API pages. Page count of a type is known from its first
+    # page, the rest are requested concurrently
+    import concurrent.futures
+
+    pages = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        first_pages = {
+            service_type: executor.submit(get_pureservers_page, session, auth_session, service_type, 0)
+            for service_type in service_types
+        }
+        other_pages = {}
+        for service_type, future in first_pages.items():
+            pages[(service_type, 0)] = future.result()
+            # Not taken from a recorded reply. Without the page count the check
+            # would report the first page only, so it fails instead
+            page_count = pages[(service_type, 0)].get("pages")
+            if not isinstance(page_count, int):
+                raise Exception(
+                    "Page count ('pages') is missing from '{}' service list reply: {!r}".format(
+                        service_type, page_count
+                    )
+                )
+            for page in range(1, page_count):
+                other_pages[(service_type, page)] = executor.submit(
+                    get_pureservers_page, session, auth_session, service_type, page
+                )
+        for key, future in other_pages.items():
+            pages[key] = future.result()
+
+    services = []
+    for service_type in service_types:
+        page = 0
+        while (service_type, page) in pages:
+            services.extend(pages[(service_type, page)]["list"])
+            page += 1
+    return services
+
+
+@contextlib.contextmanager
+def timed_phase(timings, name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[name] = time.monotonic() - start
+
+
+def get_storage_state_file_name(args):
+    if args.session_cache:
+        return os.path.expanduser(args.session_cache)
+    return os.path.join(
+        os.path.expanduser(CACHE_DIR),
+        "check_expiry_date_{}_{}.json".format(args.provider, args.login.replace(os.sep, "_")),
+    )
+
+
+def save_storage_state(storage_state, state_file_name):
+    # Session cookies are credentials: the file is created with 0600 permissions
+    os.makedirs(os.path.dirname(state_file_name), mode=0o700, exist_ok=True)
+    temp_file_name = "{}.{}.tmp".format(state_file_name, os.getpid())
+    state_fd = os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(state_fd, "w") as state_f:
+        json.dump(storage_state, state_f)
+    os.replace(temp_file_name, state_file_name)
+
+
+def block_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
+
+
+def replay_request(session, route):
+    # --base-url: browser requests are sent through the requests session to the
+    # replay server. Playwright can't redirect an https request to plain http itself
+    import http_fixtures
+
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+        return
+    response = session.request(route.request.method, route.request.url, data=route.request.post_data_buffer)
+    route.fulfill(
+        status=response.status_code,
+        headers={
+            name: value for name, value in response.headers.items() if name.lower() not in http_fixtures.SKIPPED_HEADERS
+        },
+        body=response.content,
+    )
+
+
+def is_62yun_logged_in(page):
+    import playwright.sync_api
+
+    try:
+        playwright.sync_api.expect(page.get_by_text("Мои серверы")).to_be_visible(timeout=SESSION_CHECK_TIMEOUT_MS)
+    except AssertionError:
+        return False
+    return True
+
+
+def login_62yun(page, args):
+    import playwright.sync_api
+
+    page.locator(".header__container_user_button-group_button").click()
+    page.locator(".modal-auth-email").fill(args.login)
+    page.locator(".modal-auth-password").fill(args.password)
+
+    page.get_by_role("button", name="Войти по email").click()
+    # https://playwright.dev/python/docs/api/class-frame#frame-wait-for-url
+    playwright.sync_api.expect(page.get_by_text("Мои серверы")).to_be_visible()
+
+
+def parse_62yun_server_card(card_text):
+    # Expected data:
+    # IP:193.17.183.102\nvpn-es\n19.01.2025\netc..
+    service_data = card_text.split("\n")
+    day, month, year = service_data[2].split(".")
+    return service_data[1], service_data[0], datetime.date(year=int(year), month=int(month), day=int(day))
+
+
+def get_62yun_services(session, args, timings):
+    # Returns [(name, "IP:<address>", expiry date)] from server cards of web UI.
+    # timings: phase name -> seconds, filled in even if the check fails
+    import playwright.sync_api
+
+    state_file_name = get_storage_state_file_name(args) if args.session_cache is not None else None
+    services = []
+    p = browser = context = None
+    try:
+        with timed_phase(timings, "browser"):
+            p = playwright.sync_api.sync_playwright().start()
+            if args.browser_ws_endpoint:
+                # Long-lived server started with 'playwright launch-server'
+                browser = p.chromium.connect(args.browser_ws_endpoint)
+            else:
+                browser = p.chromium.launch()
+            session_cached = (state_file_name is not None) and os.path.exists(state_file_name)
+            context = browser.new_context(storage_state=state_file_name if session_cached else None)
+            context.route("**/*", functools.partial(replay_request, session) if args.base_url else block_resources)
+            page = context.new_page()
+
+        with timed_phase(timings, "login"):
+            page.goto("https://62yun.ru/")
+            if session_cached and is_62yun_logged_in(page):
+                print_verbose(args.verbose, "Using saved session from '{}'".format(state_file_name))
+            else:
+                login_62yun(page, args)
+                if state_file_name is not None:
+                    save_storage_state(context.storage_state(), state_file_name)
+                    print_verbose(args.verbose, "Saved session to '{}'".format(state_file_name))
+
+        with timed_phase(timings, "scrape"):
+            page.get_by_text("Мои серверы").click()
+            playwright.sync_api.expect(page.locator(".myservers__servers-group")).to_be_visible()
+
+            service_data_locator = page.locator(".myservers__server").filter(has_not_text="Заказать Сервер")
+            for i in range(service_data_locator.count()):
+                services.append(parse_62yun_server_card(service_data_locator.nth(i).inner_text()))
+
+        # Logging out would invalidate the saved session
+        if state_file_name is None:
+            with timed_phase(timings, "logout"):
+                page.locator(".header__container_user_button-group > div:nth-child(2)").click()
+                playwright.sync_api.expect(page.get_by_role("button", name="Выйти из аккаунта")).to_be_visible()
+                page.get_by_role("button", name="Выйти из аккаунта").click()
+    finally:
+        with timed_phase(timings, "teardown"):
+            if context is not None:
+                context.close()
+            if browser is not None:
+                # Disconnects from a browser server without stopping it
+                browser.close()
+            if p is not None:
+                p.stop()
+    return services
+
+
+def format_timings_perfdata(timings):
+    return " ".join("'{}'={:.3f}s;;;0".format(name, seconds) for name, seconds in timings.items())
+
+
 def get_expiry_dates(args):
-    result = types.SimpleNamespace(services=[], status_string="")
+    result = types.SimpleNamespace(services=[], status_string="", perfdata="")
+
+    if (args.base_url is None) and (args.record_dir is None):
+        # http_fixtures pulls in http.server, production checks don't need it
+        import requests
 
-    session = requests.session()
+        session = requests.session()
+    else:
+        import http_fixtures
+
+        recorder = None
+        if args.record_dir is not None:
+            recorder = http_fixtures.Recorder(
+                args.record_dir,
+                [(args.login, http_fixtures.SCRUBBED_LOGIN), (args.password, http_fixtures.SCRUBBED_PASSWORD)],
+                args.base_url,
+            )
+        session = http_fixtures.create_session(args.base_url, recorder)
 
     if args.provider == "pureservers":
+        import requests.adapters
+
+        # Page requests share one connection pool, big enough for all workers
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.jobs)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
         post_data = json.dumps({"email": args.login, "password": args.password})
         login_response = session.post(
-            "https://api.rifty.org/auth/login",
+            f"{PURESERVERS_API_URL}/auth/login",
             headers={"Content-Type": "application/json"},
             data=post_data,
         )
         check_http_reply(login_response)
-        server_list_response = session.get(
-            "https://api.rifty.org/services/list?page=0&getPages=true&type=vps",
-            headers={"session": login_response.headers["session"]},
-        )
-        check_http_reply(server_list_response)
-        for server in server_list_response.json()["list"]:
+        service_types = args.service_types or PURESERVERS_SERVICE_TYPES
+        for server in get_pureservers_services(
+            session, login_response.headers["session"], service_types, args.jobs
+        ):
             service_obj = types.SimpleNamespace()
             # [!] 'expireDate' is in milliseconds, dividing it by 1000
             service_obj.expires_at = datetime.date.fromtimestamp(server["expireDate"] / 1000)
@@ -75,56 +301,34 @@ def get_expiry_dates(args):
             print_verbose(verbose=args.verbose, verbose_msg=service_obj)
 
     elif args.provider == "62yun":
-        import playwright.sync_api
-
-        p = playwright.sync_api.sync_playwright().start()
-        browser = p.chromium.launch()
-        page = browser.new_page()
-        page.goto("https://62yun.ru/")
-
-        page.locator(".header__container_user_button-group_button").click()
-        page.locator(".modal-auth-email").fill(args.login)
-        page.locator(".modal-auth-password").fill(args.password)
-
-        page.get_by_role("button", name="Войти по email").click()
-        # https://playwright.dev/python/docs/api/class-frame#frame-wait-for-url
-        playwright.sync_api.expect(page.get_by_text("Мои серверы")).to_be_visible()
-
-        page.get_by_text("Мои серверы").click()
-        playwright.sync_api.expect(page.locator(".myservers__servers-group")).to_be_visible()
-
-        service_data_locator = page.locator(".myservers__server").filter(has_not_text="Заказать Сервер")
-        for i in range(service_data_locator.count()):
-            # Expected data:
-            # IP:193.17.183.102\nvpn-es\n19.01.2025\netc..
-            service_data = service_data_locator.nth(i).inner_text().split("\n")
-            service_expiry_data = service_data[2].split(".")
-
+        timings = {}
+        try:
+            services_data = get_62yun_services(session, args, timings)
+        finally:
+            print_verbose(args.verbose, "Phase timings: {}".format(
+                ", ".join("{} {:.3f}s".format(name, seconds) for name, seconds in timings.items())))
+        result.perfdata = format_timings_perfdata(timings)
+        for name, ip, expires_at in services_data:
             service_obj = types.SimpleNamespace()
-            service_obj.expires_at = datetime.date(
-                year=int(service_expiry_data[2]),
-                month=int(service_expiry_data[1]),
-                day=int(service_expiry_data[0]),
-            )
+            service_obj.expires_at = expires_at
             service_obj.days_left = (service_obj.expires_at - datetime.date.today()).days
             service_obj.description = "{id} ({ip}): {date} ({days} day(s))".format(
-                id=service_data[1],
-                ip=service_data[0],
+                id=name,
+                ip=ip,
                 date=service_obj.expires_at.strftime("%Y-%m-%d"),
                 days=service_obj.days_left,
             )
             result.services.append(service_obj)
             print_verbose(verbose=args.verbose, verbose_msg=service_obj)
 
-        page.locator(".header__container_user_button-group > div:nth-child(2)").click()
-        playwright.sync_api.expect(page.get_by_role("button", name="Выйти из аккаунта")).to_be_visible()
-        page.get_by_role("button", name="Выйти из аккаунта").click()
-
     result.status_string = "; ".join(x.description for x in result.services)
     return result
 
 
 def main(args):
+    if args.verbose:
+        # Timestamps of verbose messages in local format
+        locale.setlocale(locale.LC_ALL, "")
     check_status = STATUS_OK
     if args.warning_threshold < args.critical_threshold:
         check_status = STATUS_UNKNOWN
@@ -162,9 +366,12 @@ def main(args):
         check_status = STATUS_WARNING
 
     if min_days_left < 0:
-        print(f"Expired {abs(min_days_left)} day(s) ago. {expiry_dates.status_string}")
+        status_text = f"Expired {abs(min_days_left)} day(s) ago. {expiry_dates.status_string}"
     else:
-        print(f"Expires in {min_days_left} day(s). {expiry_dates.status_string}")
+        status_text = f"Expires in {min_days_left} day(s). {expiry_dates.status_string}"
+    if expiry_dates.perfdata:
+        status_text += f" | {expiry_dates.perfdata}"
+    print(status_text)
     return check_status
 
 
@@ -203,6 +410,66 @@ if __name__ == "__main__":
             default=5,
             help="Minimal days to cause critical state (default: 5 days)",
         )
+        parser.add_argument(
+            "-t",
+            "--service-type",
+            dest="service_types",
+            action="append",
+            default=None,
+            help=(
+                "pureservers service type, can be used multiple times "
+                f"(default: {', '.join(PURESERVERS_SERVICE_TYPES)})"
+            ),
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            dest="jobs",
+            type=int,
+            default=4,
+            help="Maximum number of concurrent pureservers page requests (default: %(default)d)",
+        )
+        parser.add_argument(
+            "-s",
+            "--session-cache",
+            dest="session_cache",
+            nargs="?",
+            const="",
+            default=None,
+            help=(
+                "62yun: keep browser session between runs and log in only when it has expired. "
+                "Optional value is state file name (default: {}/check_expiry_date_62yun_<login>.json)".format(
+                    CACHE_DIR
+                )
+            ),
+        )
+        parser.add_argument(
+            "--browser-ws-endpoint",
+            dest="browser_ws_endpoint",
+            default=None,
+            help=(
+                "62yun: connect to a running browser server ('playwright launch-server') "
+                "instead of launching Chromium, e.g. ws://127.0.0.1:3000/<id>"
+            ),
+        )
+        parser.add_argument(
+            "--base-url",
+            dest="base_url",
+            default=None,
+            help=(
+                "Send requests to a replay server (http_fixtures.py) instead of the provider, "
+                "e.g. http://127.0.0.1:8080. 62yun browser pages are served from it too"
+            ),
+        )
+        parser.add_argument(
+            "--record",
+            dest="record_dir",
+            default=None,
+            help=(
+                "Save responses with credentials scrubbed to a fixtures directory "
+                "(pureservers only, 62yun browser traffic is not recorded)"
+            ),
+        )
         parser.add_argument(
             "-v",
             "--verbose",
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# HTTP record/replay harness for check_balance.py and check_expiry_date.py.
+#
+# Record: run a plugin with --record DIR against the real portal. Every response
+# (redirects included) is saved to DIR as a body file plus an entry in
+# DIR/manifest.json. Login and password are replaced with placeholders in URLs,
+# headers and bodies, session cookies and tokens are replaced too.
+#
+# Replay: serve DIR from a local HTTP stand-in and point a plugin to it with
+# --base-url. Requests are expected in the form http://127.0.0.1:<port>/<original
+# host>/<original path>, which is what --base-url produces:
+#   check_balance/http_fixtures.py replay check_balance/fixtures -p 8080
+#   check_balance/check_balance.py 0000000 password -p dialog --base-url http://127.0.0.1:8080
+#
+# Manifest entry:
+#   {"method": "GET", "host": "stats.tis-dialog.ru", "path": "/index.php",
+#    "query": {"mod": "payments"}, "status": 200, "headers": {"Content-Type": "...",
+#    "Set-Cookie": ["PHPSESSID=scrubbed-token; path=/"]},
+#    "body": "dialog_payments.html", "template": true, "source": "hand-written"}
+# "source" is "recorded" for responses saved by --record and "hand-written" for
+# fixtures made by hand (from the page structure seen in a browser), it is not used
+# on replay. "query": null matches any query string. Otherwise every listed parameter must be
+# present and, unless its value is null, equal. Optional "cookies" ({"PHPSESSID":
+# "expired-token"}) are matched against request cookies the same way, e.g. to serve
+# the login form to an expired session. The first matching entry is served.
+# Template bodies are string.Template files: $today is replaced with the current
+# date (dd.mm.yyyy), $expire_ms with a timestamp 30 days from now in milliseconds and
+# $expire_day with the same date as dd.mm.yyyy
+
+import os
+import re
+import argparse
+import datetime
+import http.cookies
+import http.server
+import json
+import string
+import threading
+import urllib.parse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+MANIFEST_FILE_NAME = "manifest.json"
+
+SCRUBBED_LOGIN = "scrubbed-login"
+SCRUBBED_PASSWORD = "scrubbed-password"
+SCRUBBED_TOKEN = "scrubbed-token"
+# Response headers that carry session tokens
+SECRET_HEADERS = ("set-cookie", "session", "authorization", "x-auth-token")
+# Response headers that describe the original transfer, not the content
+SKIPPED_HEADERS = ("content-length", "content-encoding", "transfer-encoding", "connection", "date", "server")
+
+
+def rewrite_url(url, base_url):
+    # https://host/path?query -> <base URL>/host/path?query
+    parts = urllib.parse.urlsplit(url)
+    return f"{base_url.rstrip('/')}/{parts.netloc}{parts.path or '/'}" + (f"?{parts.query}" if parts.query else "")
+
+
+def create_session(base_url=None, recorder=None):
+    # requests session that sends requests to a replay server (base_url) and/or
+    # records responses. Without options it is a plain requests session
+    import requests
+
+    session = requests.session()
+    if base_url:
+        original_request = session.request
+
+        def request(method, url, *args, **kwargs):
+            return original_request(method, rewrite_url(url, base_url), *args, **kwargs)
+
+        session.request = request
+    if recorder is not None:
+        session.hooks["response"].append(recorder.record_response)
+    return session
+
+
+class Recorder:
+    def __init__(self, fixtures_dir, secrets=(), base_url=None):
+        # secrets: (value, placeholder) pairs. base_url: recording through a replay
+        # server, original host and path are taken from the URL path
+        self.fixtures_dir = fixtures_dir
+        self.secrets = []
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.entries = []
+        self.lock = threading.Lock()
+        os.makedirs(fixtures_dir, exist_ok=True)
+        for value, placeholder in secrets:
+            self.add_secret(value, placeholder)
+
+    def add_secret(self, value, placeholder):
+        if not value:
+            return
+        with self.lock:
+            # Plain and URL-encoded forms, longest first so that a value isn't
+            # partially replaced by a shorter one
+            for form in set((value, urllib.parse.quote(value, safe=""), urllib.parse.quote_plus(value))):
+                self.secrets.append((form, placeholder))
+            self.secrets.sort(key=lambda x: len(x[0]), reverse=True)
+
+    def scrub(self, text):
+        for value, placeholder in self.secrets:
+            text = text.replace(value, placeholder)
+        return text
+
+    def get_original_url(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if self.base_url and url.startswith(self.base_url + "/"):
+            host, _, path = parts.path[len(urllib.parse.urlsplit(self.base_url).path) + 1:].partition("/")
+            return host, "/" + path, parts.query
+        return parts.netloc, parts.path or "/", parts.query
+
+    def scrub_headers(self, response):
+        scrubbed_headers = {}
+        for name, value in response.headers.items():
+            if name.lower() in SKIPPED_HEADERS:
+                continue
+            if name.lower() == "set-cookie":
+                # requests joins several Set-Cookie headers into one value, cookies are
+                # rebuilt from the response cookie jar instead. Value is a list then
+                value = [
+                    "{}={}; path={}".format(cookie.name, SCRUBBED_TOKEN, cookie.path) for cookie in response.cookies
+                ]
+            elif name.lower() in SECRET_HEADERS:
+                value = SCRUBBED_TOKEN
+            else:
+                value = self.scrub(value)
+            scrubbed_headers[name] = value
+        return scrubbed_headers
+
+    def record_response(self, response, *args, **kwargs):
+        # requests response hook
+        host, path, query_string = self.get_original_url(response.request.url)
+        query = None
+        if query_string:
+            query = {}
+            for name, value in urllib.parse.parse_qsl(query_string, keep_blank_values=True):
+                # Parameters with secrets match any value on replay
+                query[name] = value if self.scrub(value) == value else None
+        content_type = response.headers.get("Content-Type", "")
+        extension = ".json" if "json" in content_type else ".html" if "html" in content_type else ".txt"
+        with self.lock:
+            body_file_name = "{:03d}_{}{}{}".format(
+                len(self.entries), host, re.sub(r"[^0-9A-Za-z.-]+", "_", path).rstrip("_"), extension
+            )
+            with open(os.path.join(self.fixtures_dir, body_file_name), "w", encoding="utf-8") as body_f:
+                body_f.write(self.scrub(response.text))
+            self.entries.append(
+                {
+                    "method": response.request.method,
+                    "host": host,
+                    "path": path,
+                    "query": query,
+                    "status": response.status_code,
+                    "headers": self.scrub_headers(response),
+                    "body": body_file_name,
+                    "template": False,
+                    "source": "recorded",
+                }
+            )
+            # Manifest is rewritten after every response, so a failed run still
+            # leaves usable fixtures
+            with open(os.path.join(self.fixtures_dir, MANIFEST_FILE_NAME), "w", encoding="utf-8") as manifest_f:
+                json.dump(self.entries, manifest_f, indent=4, ensure_ascii=False)
+        return response
+
+
+def load_manifest(fixtures_dir):
+    with open(os.path.join(fixtures_dir, MANIFEST_FILE_NAME), encoding="utf-8") as manifest_f:
+        return json.load(manifest_f)
+
+
+def query_matches(entry_query, query):
+    if entry_query is None:
+        return True
+    for name, value in entry_query.items():
+        if name not in query:
+            return False
+        if (value is not None) and (value not in query[name]):
+            return False
+    return True
+
+
+def cookies_match(entry_cookies, cookies):
+    if entry_cookies is None:
+        return True
+    return query_matches(entry_cookies, {name: [value] for name, value in cookies.items()})
+
+
+def find_entry(entries, method, host, path, query, cookies=None):
+    for entry in entries:
+        if (
+            (entry["method"], entry["host"], entry["path"]) == (method, host, path)
+            and query_matches(entry["query"], query)
+            and cookies_match(entry.get("cookies"), cookies or {})
+        ):
+            return entry
+    return None
+
+
+def render_fixture(fixtures_dir, body_file_name, template=False):
+    with open(os.path.join(fixtures_dir, body_file_name), encoding="utf-8") as body_f:
+        body = body_f.read()
+    if not template:
+        return body
+    expire_at = datetime.datetime.now() + datetime.timedelta(days=30)
+    return string.Template(body).safe_substitute(
+        today=datetime.date.today().strftime("%d.%m.%Y"),
+        expire_ms=int(expire_at.timestamp() * 1000),
+        expire_day=expire_at.strftime("%d.%m.%Y"),
+    )
+
+
+class ReplayRequestHandler(http.server.BaseHTTPRequestHandler):
+    def handle_request(self):
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length:
+            self.rfile.read(content_length)
+        url = urllib.parse.urlsplit(self.path)
+        host, _, path = url.path.lstrip("/").partition("/")
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        with self.server.requests_lock:
+            self.server.requests.append((self.command, host, "/" + path, url.query))
+        cookies = {
+            name: morsel.value for name, morsel in http.cookies.SimpleCookie(self.headers.get("Cookie", "")).items()
+        }
+        entry = find_entry(self.server.entries, self.command, host, "/" + path, query, cookies)
+        if entry is None:
+            self.send_error(404, "No fixture for {} {}".format(self.command, self.path))
+            return
+
+        body = render_fixture(self.server.fixtures_dir, entry["body"], entry.get("template", False)).encode("utf-8")
+        self.send_response(entry.get("status", 200))
+        for name, value in entry.get("headers", {}).items():
+            if isinstance(value, list):
+                for item in value:
+                    self.send_header(name, item)
+                continue
+            if name.lower() == "location":
+                # Redirects stay on the replay server
+                location = urllib.parse.urlsplit(value)
+                if location.netloc:
+                    value = "/{}{}".format(location.netloc, location.path or "/") + (
+                        "?" + location.query if location.query else ""
+                    )
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def create_replay_server(fixtures_dir=FIXTURES_DIR, port=0, verbose=False):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), ReplayRequestHandler)
+    server.daemon_threads = True
+    server.fixtures_dir = fixtures_dir
+    server.entries = load_manifest(fixtures_dir)
+    server.verbose = verbose
+    # (method, host, path, query string) of every request, for tests
+    server.requests = []
+    server.requests_lock = threading.Lock()
+    return server
+
+
+def start_replay_server(fixtures_dir=FIXTURES_DIR, port=0):
+    # Serves in a background thread. Returns (server, base URL)
+    server = create_replay_server(fixtures_dir, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP fixture replay server for check_balance.py and check_expiry_date.py")
+    parser.add_argument("command", choices=["replay"], help="Command")
+    parser.add_argument(
+        "fixtures_dir", nargs="?", default=FIXTURES_DIR, help="Fixtures directory (default: %(default)s)"
+    )
+    parser.add_argument("-p", "--port", dest="port", type=int, default=8080, help="Port (default: %(default)d)")
+    parser.add_argument(
+        "-v", "--verbose", dest="verbose", action="store_true", default=False, help="Log requests"
+    )
+    args = parser.parse_args()
+    server = create_replay_server(args.fixtures_dir, args.port, args.verbose)
+    print(f"Serving fixtures from {args.fixtures_dir} on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,360 @@
+import os
+import sys
+import json
+import mock
+import unittest
+import tempfile
+import shutil
+import fcntl
+import threading
+import time
+
+import check_balance
+import http_fixtures
+
+
+class check_balance_FunctionalTests(unittest.TestCase):
+    """Functional tests against portal page fixtures"""
+
+    def setUp(self):
+        self.server, self.base_url = http_fixtures.start_replay_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_check(self, *args):
+        with mock.patch.object(sys, "argv", ["check_balance.py", "--base-url", self.base_url] + list(args)), \
+                mock.patch("builtins.print") as print_mock:
+            exit_code = check_balance.main()
+        return exit_code, print_mock.call_args[0][0]
+
+    def test_providers(self):
+        """Should check balance of every provider"""
+        self.assertEqual(self.run_check("0000000", "password", "-p", "dialog"), (0, "Balance is 1234.56"))
+        self.assertEqual(self.run_check("0000000", "password", "-p", "sovatel"), (0, "Balance is 1234.56"))
+        self.assertEqual(self.run_check("0000000", "password", "-p", "sovatel", "-w", "2000", "-c", "1000"),
+            (1, "Balance 1234.56 is less than warning threshold of 2000"))
+        exit_code, status_text = self.run_check("0000000", "password", "-p", "dialog-new")
+        self.assertEqual(exit_code, 0)
+        self.assertTrue(status_text.startswith("Balance: 1234.56, next withdrawal: "))
+
+    def test_unexpected_withdrawal(self):
+        """Should report withdrawal of unexpected amount"""
+        exit_code, status_text = self.run_check("0000000", "password", "-p", "dialog-new", "-a", "525")
+        self.assertEqual(exit_code, 2)
+        self.assertTrue(status_text.startswith("Unexpected withdrawal of -455,00. "))
+
+
+class plain_session_FunctionalTests(unittest.TestCase):
+    def test_no_http_fixtures(self):
+        """Should use a plain requests session and not import http_fixtures without --base-url and --record"""
+        with mock.patch.dict(sys.modules, {"http_fixtures": None}), \
+                mock.patch("requests.session") as session_mock, \
+                mock.patch.object(sys, "argv", ["check_balance.py", "0000000", "password", "-p", "dialog"]), \
+                mock.patch("builtins.print") as print_mock:
+            session_mock.return_value.get.side_effect = Exception("Portal is not available")
+            session_mock.return_value.post.side_effect = Exception("Portal is not available")
+            check_balance.main()
+        session_mock.assert_called_once_with()
+        self.assertIn("Portal is not available", print_mock.call_args[0][0])
+
+
+class session_cache_FunctionalTests(unittest.TestCase):
+    """Session cookie cache against portal page fixtures"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cookie_file = os.path.join(self.test_dir, "cookies.json")
+        self.server, self.base_url = http_fixtures.start_replay_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir)
+
+    def run_check(self):
+        self.server.requests.clear()
+        with mock.patch.object(sys, "argv", ["check_balance.py", "0000000", "password", "-p", "dialog",
+                "--base-url", self.base_url, "-s", self.cookie_file]), \
+                mock.patch("builtins.print") as print_mock:
+            exit_code = check_balance.main()
+        logins = [x for x in self.server.requests if x[0] == "POST"]
+        return exit_code, print_mock.call_args[0][0], len(logins)
+
+    def test_session_reuse(self):
+        """Should log in once and reuse saved session cookies"""
+        self.assertEqual(self.run_check(), (0, "Balance is 1234.56", 1))
+        with open(self.cookie_file) as cookie_f:
+            self.assertEqual([x["name"] for x in json.load(cookie_f)], ["PHPSESSID"])
+        self.assertEqual(os.stat(self.cookie_file).st_mode & 0o777, 0o600)
+        self.assertEqual(self.run_check(), (0, "Balance is 1234.56", 0))
+        # Session is not logged out
+        self.assertNotIn("mod=exit", [x[3] for x in self.server.requests])
+
+    def test_expired_session(self):
+        """Should log in again and read the balance when the cached session gets the login form"""
+        self.assertEqual(self.run_check(), (0, "Balance is 1234.56", 1))
+        with open(self.cookie_file) as cookie_f:
+            cookies = json.load(cookie_f)
+        cookies[0]["value"] = "expired-token"
+        with open(self.cookie_file, "w") as cookie_f:
+            json.dump(cookies, cookie_f)
+
+        self.assertEqual(self.run_check(), (0, "Balance is 1234.56", 1))
+        # Login form instead of the main page, login, main page again
+        self.assertEqual([x[:3] for x in self.server.requests[:4]], [
+            ("GET", "stats.tis-dialog.ru", "/index.php"),
+            ("GET", "stats.tis-dialog.ru", "/"),
+            ("POST", "stats.tis-dialog.ru", "/index.php"),
+            ("GET", "stats.tis-dialog.ru", "/index.php"),
+        ])
+        with open(self.cookie_file) as cookie_f:
+            self.assertEqual([x["value"] for x in json.load(cookie_f)], ["scrubbed-token"])
+
+    def test_damaged_cookie_file(self):
+        """Should log in again if cookie file is damaged"""
+        for damaged_data in ('[{"name": "PHPSESSID", "val', '{"name": "PHPSESSID"}', '[{"unknown": 1}]'):
+            with open(self.cookie_file, "w") as cookie_f:
+                cookie_f.write(damaged_data)
+            self.assertEqual(self.run_check(), (0, "Balance is 1234.56", 1))
+            with open(self.cookie_file) as cookie_f:
+                self.assertEqual([x["name"] for x in json.load(cookie_f)], ["PHPSESSID"])
+
+
+class result_cache_FunctionalTests(unittest.TestCase):
+    """TTL result cache against portal page fixtures"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        patcher = mock.patch("check_balance.CACHE_DIR", self.test_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("check_balance.background_refresh_started", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache_file = os.path.join(self.test_dir, "check_balance_result_dialog_0000000.json")
+        self.server, self.base_url = http_fixtures.start_replay_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir)
+
+    def run_check(self, *args):
+        self.server.requests.clear()
+        with mock.patch.object(sys, "argv", ["check_balance.py", "0000000", "password", "-p", "dialog",
+                "--base-url", self.base_url, "-t", "600", "-m", "3600"] + list(args)), \
+                mock.patch("builtins.print") as print_mock:
+            exit_code = check_balance.main()
+        return exit_code, print_mock.call_args[0][0], len(self.server.requests)
+
+    def set_data_age(self, age, balance=1234.56):
+        with open(self.cache_file, "w") as cache_f:
+            json.dump({"fetched_at": time.time() - age, "data": {"balance": balance}}, cache_f)
+
+    def test_hit(self):
+        """Should fetch data once and reuse it within TTL"""
+        exit_code, status_text, requests_count = self.run_check()
+        self.assertEqual((exit_code, status_text),
+            (0, "Balance is 1234.56 (data age: 0s) | balance=1234.56 cache_age=0s"))
+        self.assertGreater(requests_count, 0)
+        self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+
+        self.set_data_age(100, balance=50)
+        self.assertEqual(self.run_check(),
+            (2, "Balance 50 is less than critical threshold of 100 (data age: 100s) | "
+                "balance=50 cache_age=100s", 0))
+
+    def test_stale(self):
+        """Should return stale data and start a single background refresh"""
+        self.set_data_age(1000)
+        with mock.patch("subprocess.Popen") as popen_mock:
+            self.assertEqual(self.run_check()[::2], (0, 0))
+            self.run_check()
+        popen_mock.assert_called_once()
+        self.assertEqual(popen_mock.call_args[0][0][-1], "--refresh-cache")
+        self.assertTrue(popen_mock.call_args[1]["start_new_session"])
+
+    def test_background_refresh(self):
+        """Should refresh stale data with --refresh-cache, unless another refresh holds the lock"""
+        self.set_data_age(1000, balance=50)
+        with open(self.cache_file + ".lock", "a") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            self.assertEqual(self.run_check("--refresh-cache")[::2], (2, 0))
+        exit_code, status_text, requests_count = self.run_check("--refresh-cache")
+        self.assertEqual(exit_code, 0)
+        self.assertIn("(data age: 0s)", status_text)
+        self.assertGreater(requests_count, 0)
+
+    def test_expired(self):
+        """Should fetch expired data right away, once for concurrent checks"""
+        self.set_data_age(4000, balance=50)
+        self.assertEqual(self.run_check()[0:2],
+            (0, "Balance is 1234.56 (data age: 0s) | balance=1234.56 cache_age=0s"))
+
+        # A concurrent check is fetching: wait for it and use its data
+        self.set_data_age(4000, balance=50)
+        results = []
+        with open(self.cache_file + ".lock", "a") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            check_thread = threading.Thread(target=lambda: results.append(self.run_check()))
+            check_thread.start()
+            time.sleep(0.2)
+            self.assertEqual(results, [])
+            self.set_data_age(0, balance=150)
+        check_thread.join()
+        self.assertEqual(results[0][0], 1)
+        self.assertEqual(results[0][2], 0)
+
+
+class accounts_FunctionalTests(unittest.TestCase):
+    """Accounts file mode against portal page fixtures"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.accounts_file = os.path.join(self.test_dir, "accounts.json")
+        self.status_dir = os.path.join(self.test_dir, "status")
+        os.mkdir(self.status_dir)
+        self.server, self.base_url = http_fixtures.start_replay_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir)
+
+    def run_check(self, accounts, *args):
+        with open(self.accounts_file, "w") as accounts_f:
+            json.dump(accounts, accounts_f)
+        with mock.patch.object(sys, "argv", ["check_balance.py", "-A", self.accounts_file,
+                "--base-url", self.base_url] + list(args)), \
+                mock.patch("builtins.print") as print_mock:
+            exit_code = check_balance.main()
+        return exit_code, [x[0][0] for x in print_mock.call_args_list]
+
+    def test_mixed_statuses(self):
+        """Should report worst status, list non-OK accounts and write status files"""
+        exit_code, output = self.run_check([
+            {"login": "0000001", "password": "password", "provider": "dialog", "name": "home"},
+            {"login": "0000002", "password": "password", "provider": "sovatel",
+                "warning_threshold": 2000, "critical_threshold": 1000},
+            {"login": "0000003", "password": "password", "provider": "dialog-new", "name": "office",
+                "withdrawal_amount": 525},
+        ], "-o", self.status_dir)
+        self.assertEqual(exit_code, check_balance.STATUS_CRITICAL)
+        self.assertEqual(output[0], "CRITICAL - 3 account(s): 1 critical, 1 warning, 0 unknown, 1 ok | "
+            "'home balance'=1234.56 'sovatel_0000002 balance'=1234.56 'office balance'=1234.56")
+        self.assertEqual(output[1], "sovatel_0000002: Balance 1234.56 is less than warning threshold of 2000")
+        self.assertTrue(output[2].startswith("office: Unexpected withdrawal of -455,00. "))
+        self.assertEqual(len(output), 3)
+
+        self.assertEqual(sorted(os.listdir(self.status_dir)), ["home", "office", "sovatel_0000002"])
+        with open(os.path.join(self.status_dir, "home")) as status_f:
+            self.assertRegex(status_f.read(), r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d[+-]\d\d:\d\d;OK;Balance is 1234.56\n$")
+        with open(os.path.join(self.status_dir, "office")) as status_f:
+            # Semicolons would break status file format
+            status_line = status_f.read()
+        self.assertEqual(status_line.split(";")[1], "CRITICAL")
+        self.assertEqual(status_line.count(";"), 2)
+
+    def test_invalid_accounts(self):
+        """Should report invalid accounts file as UNKNOWN without checking any account"""
+        account = {"login": "0000001", "password": "password", "provider": "dialog"}
+        for accounts, error in (
+            ([account, dict(account, provider="unknown")],
+                "Error: Account #2: unknown provider 'unknown' (valid providers: dialog, dialog-new, sovatel)"),
+            ([dict(account, password="")], "Error: Account #1: 'password' is missing"),
+            ([dict(account, warning=1)], "Error: Account #1: unknown option(s) warning"),
+            ([dict(account, jobs=4, status_dir="/tmp")], "Error: Account #1: unknown option(s) jobs, status_dir"),
+            ([dict(account, warning_threshold="100")], "Error: Account #1: 'warning_threshold' must be an integer, not \"100\""),
+            ([dict(account, cache_ttl=True)], "Error: Account #1: 'cache_ttl' must be an integer or null, not true"),
+            ([dict(account, name=1)], "Error: Account #1: 'name' must be a string, not 1"),
+            ([account, account], "Error: Account #2: duplicate name 'dialog_0000001'"),
+            ({"accounts": [account]},
+                "Error: Accounts file '{}' must contain a list of accounts".format(self.accounts_file)),
+        ):
+            self.server.requests.clear()
+            self.assertEqual(self.run_check(accounts), (check_balance.STATUS_UNKNOWN, [error]))
+            self.assertEqual(self.server.requests, [])
+
+
+    def test_status_dir(self):
+        """Should create missing status directory and report UNKNOWN before checking accounts if it can't"""
+        accounts = [{"login": "0000001", "password": "password", "provider": "dialog", "name": "home"}]
+        status_dir = os.path.join(self.status_dir, "balance")
+        self.assertEqual(self.run_check(accounts, "-o", status_dir)[0], check_balance.STATUS_OK)
+        self.assertEqual(os.listdir(status_dir), ["home"])
+
+        status_dir = os.path.join(self.accounts_file, "balance")
+        self.server.requests.clear()
+        exit_code, output = self.run_check(accounts, "-o", status_dir)
+        self.assertEqual(exit_code, check_balance.STATUS_UNKNOWN)
+        self.assertEqual(len(output), 1)
+        self.assertTrue(output[0].startswith("Error: Can't write to status directory '{}': ".format(status_dir)))
+        self.assertEqual(self.server.requests, [])
+
+
+    def test_no_perfdata(self):
+        """Should leave out the perfdata separator when no account has perfdata"""
+        accounts = [{"login": "0000001", "password": "password", "provider": "dialog", "name": "home"}]
+        with mock.patch("check_balance.do_check_balance", return_value=(check_balance.STATUS_UNKNOWN, "No data", {})):
+            self.assertEqual(self.run_check(accounts), (check_balance.STATUS_UNKNOWN, [
+                "UNKNOWN - 1 account(s): 0 critical, 0 warning, 1 unknown, 0 ok", "home: No data"]))
+
+
+class payments_parser_FunctionalTests(unittest.TestCase):
+    """Streaming parser of dialog payments table"""
+
+    VARIABLES = {"today": "15.03.2024", "withdrawal_amount": "-455,00"}
+
+    def make_page(self, rows):
+        return "".join(
+            ["<html><body><div><main><div>menu</div><div><table><tr><th>Date</th><th>Amount</th></tr>"]
+            + ["<tr><td>{}</td><td>{}</td><td>Description</td></tr>".format(*row) for row in rows]
+            + ["</table><table><tr><td>15.03.2024</td><td>-1,00</td></tr></table></div></main></div></body></html>"]
+        )
+
+    def chunks(self, page, consumed):
+        for i in range(0, len(page), 100):
+            consumed.append(i)
+            yield page[i : i + 100]
+
+    def test_early_stop(self):
+        """Should stop reading the page once both values are known"""
+        page = self.make_page(
+            [("15.03.2024", "+500,00"), ("15.03.2024", "-455,00")] + [("01.03.2024", "-455,00")] * 1000
+        )
+        consumed = []
+        self.assertEqual(
+            check_balance.parse_payments(self.chunks(page, consumed), self.VARIABLES),
+            {"todays_withdrawal": True, "last_withdrawal_amount": "-455,00"},
+        )
+        self.assertLess(len(consumed), 5)
+
+    def test_no_todays_withdrawal(self):
+        """Should find last withdrawal when there is none today"""
+        page = self.make_page([("15.03.2024", "+500,00"), ("14.03.2024", "+500,00"), ("01.03.2024", "-1 455,00")])
+        self.assertEqual(
+            check_balance.parse_payments(self.chunks(page, []), self.VARIABLES),
+            {"todays_withdrawal": False, "last_withdrawal_amount": "-1 455,00"},
+        )
+        self.assertEqual(
+            check_balance.parse_payments(self.chunks(self.make_page([]), []), self.VARIABLES),
+            {"todays_withdrawal": False, "last_withdrawal_amount": None},
+        )
+
+    def test_iter_response_text(self):
+        """Should decode streamed pages with the encoding detector requests uses"""
+        body = "<td>Абонентская плата</td>".encode("cp1251")
+        response = mock.Mock(headers={"Content-Type": "text/html"}, encoding="ISO-8859-1")
+        response.iter_content.return_value = [body[:7], body[7:]]
+        with mock.patch("requests.compat.chardet.detect", return_value={"encoding": "cp1251"}) as detect_mock:
+            self.assertEqual("".join(check_balance.iter_response_text(response)), "<td>Абонентская плата</td>")
+        detect_mock.assert_called_once_with(body[:7])
+
+        # Charset from HTTP headers is trusted
+        response.headers = {"Content-Type": "text/html; charset=windows-1251"}
+        response.encoding = "windows-1251"
+        with mock.patch("requests.compat.chardet.detect") as detect_mock:
+            self.assertEqual("".join(check_balance.iter_response_text(response)), "<td>Абонентская плата</td>")
+        detect_mock.assert_not_called()
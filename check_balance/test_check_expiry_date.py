@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import stat
+import datetime
+import mock
+import unittest
+import argparse
+import tempfile
+import shutil
+import importlib.util
+
+import check_expiry_date
+import http_fixtures
+
+
+class check_expiry_date_FunctionalTests(unittest.TestCase):
+    """Functional tests against API response fixtures"""
+
+    def setUp(self):
+        self.server, self.base_url = http_fixtures.start_replay_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pureservers(self):
+        """Should report the nearest expiry date of all services"""
+        args = argparse.Namespace(login="user@example.com", password="password", provider="pureservers",
+            warning_threshold=10, critical_threshold=5, verbose=False, base_url=self.base_url, record_dir=None,
+            service_types=None, jobs=4)
+        with mock.patch("builtins.print") as print_mock:
+            self.assertEqual(check_expiry_date.main(args), 0)
+        self.assertTrue(print_mock.call_args[0][0].startswith("Expires in 30 day(s). 10001 (VPS-1): "))
+
+        args.warning_threshold, args.critical_threshold = 40, 35
+        with mock.patch("builtins.print") as print_mock:
+            self.assertEqual(check_expiry_date.main(args), 2)
+
+    def test_pureservers_pages(self):
+        """Should read all pages of every service type in a stable order"""
+        args = argparse.Namespace(login="user@example.com", password="password", provider="pureservers",
+            warning_threshold=10, critical_threshold=5, verbose=False, base_url=self.base_url, record_dir=None,
+            service_types=["vps", "dedicated"], jobs=4)
+        for _ in range(3):
+            with mock.patch("builtins.print") as print_mock:
+                self.assertEqual(check_expiry_date.main(args), 0)
+            services = print_mock.call_args[0][0].split(". ", 1)[1].split("; ")
+            self.assertEqual([service.split(" ")[0] for service in services], ["10001", "10002", "10003", "20001"])
+
+    @mock.patch("check_expiry_date.get_pureservers_page", return_value={"list": [], "pageCount": 3})
+    def test_pureservers_no_page_count(self, page_mock):
+        """Should fail instead of reading the first page only when the page count is missing"""
+        with self.assertRaisesRegex(Exception, "Page count \\('pages'\\) is missing from 'vps'"):
+            check_expiry_date.get_pureservers_services(None, "token", ["vps"], 4)
+        page_mock.assert_called_once_with(None, "token", "vps", 0)
+
+    def test_no_http_fixtures(self):
+        """Should use a plain requests session and not import http_fixtures without --base-url and --record"""
+        args = argparse.Namespace(login="user@example.com", password="password", provider="pureservers",
+            warning_threshold=10, critical_threshold=5, verbose=False, base_url=None, record_dir=None,
+            service_types=None, jobs=4)
+        with mock.patch.dict(sys.modules, {"http_fixtures": None}), mock.patch("requests.session") as session_mock:
+            session_mock.return_value.post.side_effect = Exception("Provider is not available")
+            with self.assertRaisesRegex(Exception, "Provider is not available"):
+                check_expiry_date.main(args)
+        session_mock.assert_called_once_with()
+
+    def get_62yun_args(self, **kwargs):
+        args = argparse.Namespace(login="user@example.com", password="password", provider="62yun",
+            warning_threshold=10, critical_threshold=5, verbose=False, base_url=self.base_url, record_dir=None,
+            session_cache=None, browser_ws_endpoint=None)
+        for name, value in kwargs.items():
+            setattr(args, name, value)
+        return args
+
+    @mock.patch("check_expiry_date.get_62yun_services")
+    def test_62yun(self, browser_mock):
+        """Should report the nearest expiry date of 62yun server cards"""
+        today = datetime.date.today()
+        browser_mock.return_value = [
+            ("vpn-de", "IP:193.17.183.104", today + datetime.timedelta(days=30)),
+            ("web-2", "IP:193.17.183.105", today + datetime.timedelta(days=7)),
+        ]
+        with mock.patch("builtins.print") as print_mock:
+            self.assertEqual(check_expiry_date.main(self.get_62yun_args()), 1)
+        status_text = print_mock.call_args[0][0]
+        self.assertTrue(status_text.startswith("Expires in 7 day(s). vpn-de (IP:193.17.183.104): "))
+        self.assertIn("; web-2 (IP:193.17.183.105): ", status_text)
+
+    def test_62yun_replay_request(self):
+        """Should serve browser requests from the replay server and still block images"""
+        session = http_fixtures.create_session(self.base_url)
+        route = mock.Mock()
+        route.request.resource_type = "document"
+        route.request.method = "GET"
+        route.request.url = "https://62yun.ru/"
+        route.request.post_data_buffer = None
+        check_expiry_date.replay_request(session, route)
+        self.assertEqual(self.server.requests, [("GET", "62yun.ru", "/", "")])
+        fulfill_kwargs = route.fulfill.call_args[1]
+        self.assertEqual(fulfill_kwargs["status"], 200)
+        self.assertEqual(fulfill_kwargs["headers"], {"Content-Type": "text/html; charset=utf-8"})
+        expire_day = (datetime.date.today() + datetime.timedelta(days=30)).strftime("%d.%m.%Y")
+        self.assertIn("<div>vpn-de</div><div>{}</div>".format(expire_day), fulfill_kwargs["body"].decode("utf-8"))
+
+        route = mock.Mock()
+        route.request.resource_type = "image"
+        check_expiry_date.replay_request(session, route)
+        route.abort.assert_called_once()
+        route.fulfill.assert_not_called()
+        self.assertEqual(len(self.server.requests), 1)
+
+    @unittest.skipUnless(importlib.util.find_spec("playwright"), "Playwright is not installed")
+    def test_62yun_browser(self):
+        """Should log in, read server cards and log out in a browser against the replayed page"""
+        with mock.patch("builtins.print") as print_mock:
+            self.assertEqual(check_expiry_date.main(self.get_62yun_args()), 0)
+        status_text = print_mock.call_args[0][0]
+        self.assertTrue(status_text.startswith("Expires in 30 day(s). vpn-de (IP:193.17.183.104): "))
+        self.assertIn("; web-2 (IP:193.17.183.105): ", status_text)
+        self.assertIn(" | 'browser'=", status_text)
+
+
+class get_62yun_services_FunctionalTests(unittest.TestCase):
+    """Functional tests for 'get_62yun_services' function with a mocked Playwright"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.state_file_name = os.path.join(self.test_dir, "state.json")
+        self.sync_api = mock.MagicMock()
+        playwright_module = mock.MagicMock(sync_api=self.sync_api)
+        patcher = mock.patch.dict(sys.modules, {"playwright": playwright_module, "playwright.sync_api": self.sync_api})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.playwright = self.sync_api.sync_playwright.return_value.start.return_value
+        self.browser = self.playwright.chromium.launch.return_value
+        self.context = self.browser.new_context.return_value
+        self.page = self.context.new_page.return_value
+        cards = self.page.locator.return_value.filter.return_value
+        cards.count.return_value = 1
+        cards.nth.return_value.inner_text.return_value = "IP:193.17.183.104\nvpn-de\n19.01.2030\nRenew"
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def get_args(self, **kwargs):
+        args = argparse.Namespace(login="user@example.com", password="password", provider="62yun", verbose=False,
+            session_cache=self.state_file_name, browser_ws_endpoint=None, base_url=None)
+        for name, value in kwargs.items():
+            setattr(args, name, value)
+        return args
+
+    def assert_torn_down(self):
+        self.context.close.assert_called_once()
+        self.browser.close.assert_called_once()
+        self.playwright.stop.assert_called_once()
+
+    def test_saved_session(self):
+        """Should reuse saved storage state and skip login and logout"""
+        with open(self.state_file_name, "w") as state_f:
+            json.dump({"cookies": [], "origins": []}, state_f)
+        timings = {}
+        self.assertEqual(check_expiry_date.get_62yun_services(None, self.get_args(), timings),
+            [("vpn-de", "IP:193.17.183.104", datetime.date(2030, 1, 19))])
+        self.browser.new_context.assert_called_once_with(storage_state=self.state_file_name)
+        self.context.route.assert_called_once_with("**/*", check_expiry_date.block_resources)
+        self.page.get_by_role.assert_not_called()
+        self.context.storage_state.assert_not_called()
+        self.assertEqual(list(timings), ["browser", "login", "scrape", "teardown"])
+        self.assert_torn_down()
+
+    def test_expired_session(self):
+        """Should log in and save new storage state when the saved session has expired"""
+        with open(self.state_file_name, "w") as state_f:
+            json.dump({"cookies": [], "origins": []}, state_f)
+        self.sync_api.expect.return_value.to_be_visible.side_effect = [AssertionError, None, None]
+        self.context.storage_state.return_value = {"cookies": [{"name": "sid", "value": "new"}], "origins": []}
+        check_expiry_date.get_62yun_services(None, self.get_args(), {})
+        self.page.locator.return_value.fill.assert_any_call("user@example.com")
+        with open(self.state_file_name) as state_f:
+            self.assertEqual(json.load(state_f)["cookies"], [{"name": "sid", "value": "new"}])
+        self.assertEqual(stat.S_IMODE(os.stat(self.state_file_name).st_mode), 0o600)
+        self.assert_torn_down()
+
+    def test_teardown(self):
+        """Should close the context and disconnect from the browser server when scraping fails"""
+        self.playwright.chromium.connect.return_value = self.browser
+        self.page.get_by_text.return_value.click.side_effect = RuntimeError("Server list has changed")
+        timings = {}
+        with self.assertRaises(RuntimeError):
+            check_expiry_date.get_62yun_services(None,
+                self.get_args(session_cache=None, browser_ws_endpoint="ws://127.0.0.1:3000/chromium"), timings)
+        self.playwright.chromium.connect.assert_called_once_with("ws://127.0.0.1:3000/chromium")
+        self.playwright.chromium.launch.assert_not_called()
+        self.browser.new_context.assert_called_once_with(storage_state=None)
+        self.assertIn("teardown", timings)
+        self.assert_torn_down()
+
+    def test_replay(self):
+        """Should route browser requests through the replay session with --base-url"""
+        session = mock.Mock()
+        check_expiry_date.get_62yun_services(session, self.get_args(session_cache=None, base_url="http://127.0.0.1:8080"), {})
+        route_handler = self.context.route.call_args[0][1]
+        self.assertEqual((route_handler.func, route_handler.args), (check_expiry_date.replay_request, (session,)))
+
+    def test_block_resources(self):
+        """Should abort image, font and media requests only"""
+        for resource_type, aborted in (("image", True), ("font", True), ("media", True), ("document", False),
+                ("script", False)):
+            route = mock.Mock()
+            route.request.resource_type = resource_type
+            check_expiry_date.block_resources(route)
+            self.assertEqual(route.abort.called, aborted)
+            self.assertEqual(route.continue_.called, not aborted)
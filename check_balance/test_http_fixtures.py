@@ -0,0 +1,77 @@
+import os
+import unittest
+import tempfile
+import shutil
+
+import http_fixtures
+
+
+class http_fixtures_FunctionalTests(unittest.TestCase):
+    """Functional tests for HTTP record/replay harness"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.server, self.base_url = http_fixtures.start_replay_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir)
+
+    def test_rewrite_url(self):
+        """Should send requests to base URL keeping original host and path"""
+        self.assertEqual(http_fixtures.rewrite_url("https://api.rifty.org/services/list?page=0", "http://h:1/"),
+            "http://h:1/api.rifty.org/services/list?page=0")
+        self.assertEqual(http_fixtures.rewrite_url("https://stat.sovatelecom.ru", "http://h:1"),
+            "http://h:1/stat.sovatelecom.ru/")
+
+    def test_replay(self):
+        """Should serve the first matching fixture and 404 for unknown requests"""
+        session = http_fixtures.create_session(self.base_url)
+        response = session.get("https://stats.tis-dialog.ru/index.php?mod=payments")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Абонентская плата", response.text)
+        response = session.get("https://stats.tis-dialog.ru/index.php?phnumber=1234567")
+        self.assertIn("руб.", response.text)
+        response = session.post("https://api.rifty.org/auth/login", data="{}")
+        self.assertEqual(response.headers["session"], http_fixtures.SCRUBBED_TOKEN)
+        self.assertEqual(session.get("https://stats.tis-dialog.ru/unknown").status_code, 404)
+
+    def test_record(self):
+        """Should record responses with credentials and session tokens scrubbed"""
+        record_dir = os.path.join(self.test_dir, "recorded")
+        recorder = http_fixtures.Recorder(record_dir, [("1234567", http_fixtures.SCRUBBED_LOGIN),
+            ("pa ss", http_fixtures.SCRUBBED_PASSWORD)], self.base_url)
+        session = http_fixtures.create_session(self.base_url, recorder)
+        session.post("https://stats.tis-dialog.ru/index.php", data={"login": "1234567", "passv": "pa ss"})
+        session.get("https://stats.tis-dialog.ru/index.php?phnumber=1234567&mod=main")
+
+        entries = http_fixtures.load_manifest(record_dir)
+        self.assertEqual([(x["method"], x["host"], x["path"], x["query"]) for x in entries], [
+            ("POST", "stats.tis-dialog.ru", "/index.php", None),
+            ("GET", "stats.tis-dialog.ru", "/index.php", {"phnumber": None, "mod": "main"}),
+        ])
+        self.assertEqual(entries[0]["headers"]["Set-Cookie"], ["PHPSESSID=scrubbed-token; path=/"])
+        self.assertEqual(set(x["source"] for x in entries), set(["recorded"]))
+        with open(os.path.join(record_dir, "manifest.json")) as manifest_f:
+            self.assertNotIn("1234567", manifest_f.read())
+
+        # Recorded fixtures can be replayed
+        replay_server, replay_url = http_fixtures.start_replay_server(record_dir)
+        self.addCleanup(replay_server.server_close)
+        self.addCleanup(replay_server.shutdown)
+        response = http_fixtures.create_session(replay_url).get(
+            "https://stats.tis-dialog.ru/index.php?phnumber=7654321&mod=main")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("руб.", response.text)
+
+    def test_fixture_sources(self):
+        """Should say for every shipped fixture whether it was recorded"""
+        for entry in http_fixtures.load_manifest(http_fixtures.FIXTURES_DIR):
+            self.assertIn(entry.get("source"), ("recorded", "hand-written"), entry["body"])
+
+    def test_scrub(self):
+        """Should replace plain and URL-encoded secrets"""
+        recorder = http_fixtures.Recorder(self.test_dir, [("user@example.com", "L"), ("p&w", "P")])
+        self.assertEqual(recorder.scrub("email=user%40example.com&password=p%26w {\"email\": \"user@example.com\"}"),
+            "email=L&password=P {\"email\": \"L\"}")
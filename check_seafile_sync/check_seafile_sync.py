@@ -2,11 +2,17 @@
 
 import os
 import sys
+import contextlib
 import datetime
-import pathlib
+import fcntl
 import argparse
 import json
+import re
+import socket
+import struct
 import subprocess
+import time
+import types
 
 # Nagios status codes
 STATUS_UNKNOWN = -1
@@ -22,50 +28,391 @@ STATUS_NAMES = {
 }
 
 
+STATE_FILE_NAME = "~/.cache/cheretbe/nagios-plugins/seafile_status.json"
+STATE_FORMAT_VERSION = 2
+
+IN_PROGRESS_STATUSES = [
+    "committing",
+    "initializing",
+    "downloading",
+    "downloading file list",
+    "downloading files",
+    "merging",
+    "uploading",
+]
+
+
+SEAFILE_CONF_DIR = "~/.ccnet"
+
+# Log is read in pieces of this size, memory use doesn't depend on log size
+LOG_READ_SIZE = 1024 * 1024
+# In log mode library list is taken from seaf-daemon at least this often, so that
+# added and removed libraries are noticed even if the log doesn't mention them
+LIBRARY_LIST_REFRESH_SECONDS = 3600
+
+
+class SeafileRpcError(Exception):
+    pass
+
+
+class SeafileRpcClient:
+    """Minimal client of seaf-daemon named pipe RPC (the transport pysearpc uses)
+
+    A request is a 4-byte native-endian length followed by JSON
+    {"service": "seafile-rpcserver", "request": "[\"<function>\", <args>...]"}.
+    A response has the same framing and contains {"ret": ...} or
+    {"err_code": ..., "err_msg": ...}. Objects in "ret" have GObject property
+    names as keys ("repo-id", "auto-sync"), they are returned with underscores
+    ("repo_id", "auto_sync"), same as pysearpc attribute names
+    """
+
+    def __init__(self, socket_path, timeout=10):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.connect(socket_path)
+        except OSError:
+            self.socket.close()
+            raise
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def receive(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise SeafileRpcError("Connection closed by seaf-daemon")
+            data += chunk
+        return data
+
+    def call(self, function_name, *args):
+        body = json.dumps(
+            {"service": "seafile-rpcserver", "request": json.dumps([function_name] + list(args))}
+        ).encode("utf-8")
+        self.socket.sendall(struct.pack("=I", len(body)) + body)
+        (response_size,) = struct.unpack("=I", self.receive(4))
+        response = json.loads(self.receive(response_size).decode("utf-8"))
+        if response.get("err_code"):
+            raise SeafileRpcError(f"{function_name}: {response.get('err_msg')}")
+        return normalize_rpc_object(response.get("ret"))
+
+
+def normalize_rpc_object(value):
+    if isinstance(value, dict):
+        return {key.replace("-", "_"): item for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize_rpc_object(x) for x in value]
+    return value
+
+
+def get_rpc_socket_path(conf_dir):
+    # seaf-cli reads seafile data directory location from <conf dir>/seafile.ini
+    with open(os.path.join(conf_dir, "seafile.ini"), encoding="utf-8") as ini_f:
+        return os.path.join(ini_f.readline().strip(), "seafile.sock")
+
+
+def format_transfer_progress(transfer_task):
+    # Returns (progress text, rate in bytes per second). Text is the same as
+    # 'seaf-cli status' progress column: "<percent>%, <rate>KB/s"
+    if transfer_task is None:
+        return None, None
+    rate = transfer_task.get("rate", 0)
+    done, total = transfer_task.get("block_done", 0), transfer_task.get("block_total", 0)
+    if not total:
+        done, total = transfer_task.get("fs_objects_done", 0), transfer_task.get("fs_objects_total", 0)
+    percent = (done * 100 / total) if total else 0
+    return f"{percent:.1f}%, {rate / 1024:.1f}KB/s", rate
+
+
+def get_library_statuses_rpc(conf_dir):
+    # Mirrors 'seaf-cli status': clone tasks first, then libraries sorted by name
+    # https://github.com/haiwen/seafile/blob/master/app/seaf-cli
+    statuses = []
+    with SeafileRpcClient(get_rpc_socket_path(conf_dir)) as client:
+        for task in client.call("seafile_get_clone_tasks") or []:
+            if task.get("state") == "done":
+                # Clone task is done, library will be reported by repo list
+                continue
+            library = types.SimpleNamespace(
+                name=task.get("repo_name"), status=task.get("state"), progress=None, rate=None, error=None
+            )
+            if library.status == "fetch":
+                library.status = "downloading"
+                library.progress, library.rate = format_transfer_progress(
+                    client.call("seafile_find_transfer_task", task.get("repo_id"))
+                )
+            elif library.status == "error":
+                library.error = client.call("seafile_sync_error_id_to_str", task.get("error"))
+            statuses.append(library)
+
+        auto_sync_enabled = client.call("seafile_is_auto_sync_enabled")
+        for repo in sorted(client.call("seafile_get_repo_list", -1, -1) or [], key=lambda x: x["name"].lower()):
+            library = types.SimpleNamespace(name=repo["name"], status=None, progress=None, rate=None, error=None)
+            statuses.append(library)
+            if not auto_sync_enabled or not repo.get("auto_sync"):
+                library.status = "auto sync disabled"
+                continue
+            sync_task = client.call("seafile_get_repo_sync_task", repo["id"])
+            if sync_task is None:
+                library.status = "waiting for sync"
+                continue
+            library.status = sync_task["state"]
+            if library.status == "error":
+                library.error = client.call("seafile_sync_error_id_to_str", sync_task.get("error"))
+            elif library.status in ("uploading", "downloading"):
+                library.progress, library.rate = format_transfer_progress(
+                    client.call("seafile_find_transfer_task", repo["id"])
+                )
+    return statuses
+
+
+def get_library_statuses_seaf_cli(conf_dir):
+    statuses = []
+    for line in subprocess.check_output(
+        ("seaf-cli", "status", "-c", conf_dir), universal_newlines=True
+    ).splitlines():
+        if line.strip() and line[0] != "#":
+            columns = [x.strip() for x in line.split("\t")]
+            library = types.SimpleNamespace(
+                name=columns[0], status=columns[1], progress=None, rate=None, error=None
+            )
+            # Third column is transfer progress or error description
+            if len(columns) > 2 and columns[2]:
+                if library.status == "error":
+                    library.error = columns[2]
+                else:
+                    library.progress = columns[2]
+            statuses.append(library)
+    return statuses
+
+
+def get_library_statuses(conf_dir, verbose=False):
+    # Talking to seaf-daemon directly saves starting seaf-cli (another Python
+    # interpreter), which then does the same RPC calls
+    try:
+        return get_library_statuses_rpc(conf_dir)
+    except (OSError, ValueError, KeyError, TypeError, SeafileRpcError) as e:
+        if verbose:
+            print(f"seaf-daemon RPC has failed ({e}), using seaf-cli")
+    return get_library_statuses_seaf_cli(conf_dir)
+
+
+# https://github.com/haiwen/seafile/blob/master/daemon/sync-mgr.c (transition_sync_state)
+# Repo 'name' sync state transition from 'synchronized' to 'committing'.
+# Repo 'name' sync state transition from uploading to 'error': 'Server error'.
+LOG_TRANSITION_RE = re.compile(
+    r"Repo '(?P<name>.+)' sync state transition from '?(?P<old>[^']*?)'? "
+    r"to '(?P<new>[^']+)'(?:: '(?P<error>.*)')?"
+)
+# Older clients log "[%x %X]" in C locale, newer ones "%Y-%m-%d %H:%M:%S"
+LOG_TIMESTAMP_FORMATS = (
+    (re.compile(r"\[(\d\d/\d\d/\d\d \d\d:\d\d:\d\d)\]"), "%m/%d/%y %H:%M:%S"),
+    (re.compile(r"\[?(\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d)"), "%Y-%m-%d %H:%M:%S"),
+)
+
+
+def parse_log_line(line):
+    # Returns (Unix timestamp, library, new status, error text) or None if the line
+    # is not a sync state transition
+    if "sync state transition" not in line:
+        return None
+    transition = LOG_TRANSITION_RE.search(line)
+    if transition is None:
+        return None
+    for timestamp_re, timestamp_format in LOG_TIMESTAMP_FORMATS:
+        timestamp = timestamp_re.match(line)
+        if timestamp:
+            # Log timestamps are in local time
+            since = int(time.mktime(time.strptime(timestamp.group(1).replace("T", " "), timestamp_format)))
+            return since, transition.group("name"), transition.group("new"), transition.group("error")
+    return None
+
+
+def read_log_transitions(log_file_name, log_position):
+    # Reads log from saved position. Returns (transitions, new log position, whether
+    # the log was read from the start). Log is read from the start if it has been
+    # rotated (different inode) or truncated
+    transitions = []
+    with open(log_file_name, "rb") as log_f:
+        log_stat = os.fstat(log_f.fileno())
+        offset = 0
+        if (
+            log_position is not None
+            and log_position.get("inode") == log_stat.st_ino
+            and log_position.get("offset", 0) <= log_stat.st_size
+        ):
+            offset = log_position["offset"]
+        log_f.seek(offset)
+        position = offset
+        data = b""
+        while True:
+            chunk = log_f.read(LOG_READ_SIZE)
+            if not chunk:
+                break
+            data += chunk
+            # Incomplete last line is left for the next piece (or the next run)
+            data_end = data.rfind(b"\n") + 1
+            for line in data[:data_end].decode("utf-8", errors="replace").splitlines():
+                transition = parse_log_line(line)
+                if transition is not None:
+                    transitions.append(transition)
+            data = data[data_end:]
+            position += data_end
+    return transitions, {"inode": log_stat.st_ino, "offset": position}, offset == 0
+
+
+@contextlib.contextmanager
+def locked_state_file(state_file_name):
+    # Lock is held for the whole check, so overlapping runs don't overwrite each
+    # other's state. Lock file modification time is the time of the previous
+    # successful check
+    os.makedirs(os.path.dirname(state_file_name), exist_ok=True)
+    with open(state_file_name + ".lock", "a") as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        last_check_time = os.fstat(lock_f.fileno()).st_mtime
+        check_time = time.time()
+        yield last_check_time
+        # Not reached if the check has raised (e.g. library listing has failed)
+        os.utime(lock_f.fileno(), (check_time, check_time))
+
+
+def load_state(state_file_name):
+    # Returns ({library: [status, since(, error)]}, log position), where 'since' is
+    # a Unix timestamp and log position is {"inode": ..., "offset": ...} or None
+    try:
+        with open(state_file_name) as state_f:
+            state = json.load(state_f)
+    except FileNotFoundError:
+        return {}, None
+    if state.get("version") == STATE_FORMAT_VERSION:
+        return state["libraries"], state.get("log")
+    # Old format: {library: <ISO 8601 time when library was last seen synchronized>}
+    # [!] 3.7+
+    return {
+        library: [None, datetime.datetime.fromisoformat(last_synchronized).timestamp()]
+        for library, last_synchronized in state.items()
+    }, None
+
+
+def save_state(state_file_name, libraries, log_position=None):
+    state = {"version": STATE_FORMAT_VERSION, "libraries": libraries}
+    if log_position is not None:
+        state["log"] = log_position
+    temp_file_name = f"{state_file_name}.{os.getpid()}.tmp"
+    with open(temp_file_name, "w", encoding="utf-8") as state_f:
+        json.dump(state, state_f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(temp_file_name, state_file_name)
+
+
+def get_library_state(old_state, status, now, last_check_time):
+    # Returns [status, since]. For a synchronized library 'since' is the time it became
+    # synchronized. For other statuses it is the last time the library was seen
+    # synchronized (or first seen if it never was), i.e. the previous check time if
+    # it has just left synchronized status
+    if status == "synchronized":
+        if old_state and old_state[0] == "synchronized":
+            return old_state
+        return [status, now]
+    if old_state is None:
+        return [status, now]
+    if old_state[0] == "synchronized":
+        return [status, int(last_check_time)]
+    return [status, old_state[1]]
+
+
+def get_libraries_from_log(conf_dir, log_file_name, old_libraries, log_position, now, verbose=False):
+    # Applies state transitions logged since the previous check to the saved state.
+    # Returns (library statuses, {library: [status, since(, error)]}, new log position)
+    list_refreshed = (log_position or {}).get("refreshed", 0)
+    transitions, log_position, read_from_start = read_log_transitions(log_file_name, log_position)
+    if verbose:
+        print(f"{len(transitions)} sync state transition(s) in '{log_file_name}'")
+    unknown_libraries = set(x[1] for x in transitions) - set(old_libraries)
+    libraries = dict(old_libraries)
+    for since, library, status, error in transitions:
+        libraries[library] = get_library_state(libraries.get(library), status, since, since)[:2]
+        if error:
+            libraries[library].append(error)
+
+    if read_from_start or unknown_libraries or (now - list_refreshed >= LIBRARY_LIST_REFRESH_SECONDS):
+        # First run or the log has been rotated: it doesn't have to mention every
+        # library and can miss some transitions, so library list and current
+        # statuses are taken from seaf-daemon. Same for a library that has been
+        # added and periodically, to drop removed libraries
+        if verbose:
+            print("Refreshing library list")
+        list_refreshed = now
+        reported_libraries = {}
+        for library_status in get_library_statuses(conf_dir, verbose):
+            state = libraries.get(library_status.name)
+            if (state is None) or (state[0] != library_status.status):
+                state = get_library_state(state, library_status.status, now, now)[:2]
+                if library_status.error:
+                    state.append(library_status.error)
+            reported_libraries[library_status.name] = state
+        libraries = reported_libraries
+    log_position["refreshed"] = list_refreshed
+
+    statuses = [
+        types.SimpleNamespace(
+            name=library, status=state[0], progress=None, rate=None, error=state[2] if len(state) > 2 else None
+        )
+        for library, state in sorted(libraries.items(), key=lambda x: x[0].lower())
+    ]
+    return statuses, libraries, log_position
+
+
 def main(args):
     exit_status = STATUS_OK
     exit_status_text = ""
+    perfdata = []
 
     try:
-        status_file_name = os.path.expanduser("~/.cache/cheretbe/nagios-plugins/seafile_status.json")
-        if os.path.isfile(status_file_name):
-            with open(status_file_name) as status_f:
-                seafile_status = json.load(status_f)
-            for library in seafile_status.keys():
-                # [!] 3.7+
-                seafile_status[library] = datetime.datetime.fromisoformat(seafile_status[library])
-        else:
-            seafile_status = {}
-
-        for line in subprocess.check_output(("seaf-cli", "status"), universal_newlines=True).splitlines():
-            if line[0] != "#":
-                library, status = [x.strip() for x in line.split("\t")[0:2]]
-                if library not in seafile_status:
-                    # Strip microseconds to emulate Linux 'date -Iseconds' behavior
-                    seafile_status[library] = datetime.datetime.now().replace(microsecond=0)
+        state_file_name = os.path.expanduser(STATE_FILE_NAME)
+        with locked_state_file(state_file_name) as last_check_time:
+            old_libraries, old_log_position = load_state(state_file_name)
+            log_position = old_log_position
+            now = int(time.time())
+            conf_dir = os.path.expanduser(args.conf_dir)
+
+            if args.log_file is not None:
+                statuses, libraries, log_position = get_libraries_from_log(
+                    conf_dir,
+                    os.path.expanduser(args.log_file or os.path.join(conf_dir, "logs", "seafile.log")),
+                    old_libraries,
+                    old_log_position,
+                    now,
+                    args.verbose,
+                )
+            else:
+                statuses = get_library_statuses(conf_dir, args.verbose)
+                # Libraries that are not reported anymore are dropped from the state
+                libraries = {
+                    x.name: get_library_state(old_libraries.get(x.name), x.status, now, last_check_time)
+                    for x in statuses
+                }
+
+            for library_status in statuses:
+                library, status = library_status.name, library_status.status
                 # https://github.com/haiwen/seafile/blob/master/daemon/sync-mgr.c#L473
                 # https://github.com/haiwen/seafile/blob/master/app/seaf-cli#L815
                 if exit_status_text:
                     exit_status_text += "; "
 
-                # if library == "projects":
-                # seafile_status[library] = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(minutes=100)
-                # seafile_status[library] = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=1, minutes=10)
-                # status = "committing"
-
+                stuck_seconds = 0
                 if status == "synchronized":
                     exit_status_text += f"{library}: {status}"
-                    seafile_status[library] = datetime.datetime.now().replace(microsecond=0)
-                elif status in [
-                    "committing",
-                    "initializing",
-                    "downloading",
-                    "downloading file list",
-                    "downloading files",
-                    "merging",
-                    "uploading",
-                ]:
-                    time_delta = datetime.datetime.now().replace(microsecond=0) - seafile_status[library]
+                elif status in IN_PROGRESS_STATUSES:
+                    time_delta = datetime.timedelta(seconds=int(now - libraries[library][1]))
+                    stuck_seconds = int(time_delta.total_seconds())
                     status_icon = ""
                     if time_delta.total_seconds() > (args.warning * 60):
                         status_icon = "(!)"
@@ -75,16 +422,22 @@ def main(args):
                         status_icon = "(!)"
                         exit_status = STATUS_CRITICAL
                     exit_status_text += f"{library}: {status} {status_icon}{str(time_delta)}"
+                    if library_status.progress:
+                        exit_status_text += f" ({library_status.progress})"
                 else:
                     exit_status = STATUS_CRITICAL
                     exit_status_text += f"{library}: {status}"
+                    if library_status.error:
+                        exit_status_text += f" ({library_status.error})"
+                label = library.replace("'", "''")
+                perfdata.append(f"'{label}'={stuck_seconds}s;{args.warning * 60};{args.critical * 60};0")
 
-        for library in seafile_status.keys():
-            seafile_status[library] = seafile_status[library].isoformat()
-
-        os.makedirs(os.path.dirname(status_file_name), exist_ok=True)
-        with open(status_file_name, "w", encoding="utf-8") as status_f:
-            json.dump(seafile_status, status_f, ensure_ascii=False, indent=4)
+            # Nothing to write if no library has changed its status and no log lines were read
+            if (libraries != old_libraries) or (log_position != old_log_position):
+                save_state(state_file_name, libraries, log_position)
+        # Time in progress is exact in log mode, so it is worth graphing
+        if (args.log_file is not None) and perfdata:
+            exit_status_text += " | " + " ".join(perfdata)
     except Exception as e:
         exit_status = STATUS_UNKNOWN
         exit_status_text = f"Unhandled exception: {e}"
@@ -103,6 +456,25 @@ if __name__ == "__main__":
     parser.add_argument(
         "-c", "--critical", type=int, default=90, help="Warning threshold in minutes (default=90)"
     )
+    parser.add_argument(
+        "-C",
+        "--conf-dir",
+        dest="conf_dir",
+        default=SEAFILE_CONF_DIR,
+        help="Seafile client config directory, same as 'seaf-cli -c' (default=~/.ccnet)",
+    )
+    parser.add_argument(
+        "-L",
+        "--log-file",
+        dest="log_file",
+        nargs="?",
+        const="",
+        default=None,
+        help=(
+            "Track sync state transitions in seafile client log, reading only lines added since "
+            "the previous check (default log file=<conf dir>/logs/seafile.log)"
+        ),
+    )
     parser.add_argument(
         "-v",
         "--verbose",
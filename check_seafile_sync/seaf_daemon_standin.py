@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Stand-in for seaf-daemon RPC endpoint (<seafile data dir>/seafile.sock). Answers
+# the calls check_seafile_sync.py and seaf-cli status make, using library data
+# from a JSON file:
+#   [{"name": "lib1", "state": "synchronized"},
+#    {"name": "lib2", "state": "uploading", "rate": 102400, "block_done": 5, "block_total": 10},
+#    {"name": "lib3", "state": "error", "error": 7},
+#    {"name": "lib4", "auto_sync": false}]
+# A library without "state" has no sync task ("waiting for sync"). Objects are
+# returned with hyphenated keys ("auto-sync", "block-done"), the way seaf-daemon
+# serializes GObject properties.
+#
+# Used by tests and benchmarks:
+#   seaf_daemon_standin.py -c /tmp/ccnet -l libraries.json
+#   check_seafile_sync.py -C /tmp/ccnet
+
+import os
+import argparse
+import json
+import socketserver
+import struct
+import threading
+
+# Subset of seafile/common/sync-error.h texts
+SYNC_ERRORS = {
+    0: "Success",
+    2: "Server error",
+    3: "Failed to login to server",
+    7: "Error occurred in upload or download",
+    9: "Server has been removed",
+}
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            header = self.receive(4)
+            if header is None:
+                return
+            (size,) = struct.unpack("=I", header)
+            request = json.loads(self.receive(size).decode("utf-8"))
+            function_name, *args = json.loads(request["request"])
+            try:
+                response = {"ret": self.server.call(function_name, args)}
+            except Exception as e:
+                response = {"err_code": 500, "err_msg": str(e)}
+            body = json.dumps(response).encode("utf-8")
+            self.request.sendall(struct.pack("=I", len(body)) + body)
+
+    def receive(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+class SeafDaemonStandin(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, libraries, auto_sync_enabled=True):
+        self.libraries = {f"repo-{i:04d}": library for i, library in enumerate(libraries)}
+        self.auto_sync_enabled = auto_sync_enabled
+        self.calls = []
+        super().__init__(socket_path, RequestHandler)
+
+    def call(self, function_name, args):
+        self.calls.append(function_name)
+        if function_name == "seafile_get_clone_tasks":
+            return []
+        if function_name == "seafile_is_auto_sync_enabled":
+            return 1 if self.auto_sync_enabled else 0
+        if function_name == "seafile_get_repo_list":
+            return [
+                {"id": repo_id, "name": library["name"], "auto-sync": library.get("auto_sync", True)}
+                for repo_id, library in self.libraries.items()
+            ]
+        if function_name == "seafile_get_repo_sync_task":
+            library = self.libraries[args[0]]
+            if "state" not in library:
+                return None
+            return {"repo-id": args[0], "state": library["state"], "error": library.get("error", 0)}
+        if function_name == "seafile_sync_error_id_to_str":
+            return SYNC_ERRORS.get(args[0], "Unknown error")
+        if function_name == "seafile_find_transfer_task":
+            library = self.libraries[args[0]]
+            return {key.replace("_", "-"): library.get(key, 0) for key in ("rate", "block_done", "block_total")}
+        raise ValueError(f"Unknown function {function_name}")
+
+
+def start_standin(conf_dir, libraries, auto_sync_enabled=True):
+    # Creates seaf-cli config directory layout (<conf dir>/seafile.ini pointing
+    # to data directory) and serves RPC in a background thread
+    data_dir = os.path.join(conf_dir, "seafile-data")
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(conf_dir, "seafile.ini"), "w") as ini_f:
+        ini_f.write(data_dir + "\n")
+    socket_path = os.path.join(data_dir, "seafile.sock")
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = SeafDaemonStandin(socket_path, libraries, auto_sync_enabled)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="seaf-daemon RPC stand-in")
+    parser.add_argument("-c", "--conf-dir", dest="conf_dir", required=True, help="Config directory to create")
+    parser.add_argument("-l", "--libraries", dest="libraries_file", required=True, help="JSON file with libraries")
+    args = parser.parse_args()
+    with open(args.libraries_file) as libraries_f:
+        server = start_standin(os.path.abspath(args.conf_dir), json.load(libraries_f))
+    print(f"Serving on {server.server_address}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,292 @@
+import os
+import json
+import mock
+import unittest
+import argparse
+import datetime
+import tempfile
+import time
+import shutil
+
+import check_seafile_sync
+import seaf_daemon_standin
+
+
+def seaf_cli_output(libraries):
+    return "# Name\tStatus\tProgress\n" + "".join(f"{name}\t{status}\n" for name, status in libraries)
+
+
+class state_store_FunctionalTests(unittest.TestCase):
+    """Functional tests for state file handling"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.test_dir, "cache", "seafile_status.json")
+        patcher = mock.patch("check_seafile_sync.STATE_FILE_NAME", self.state_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def run_check(self, libraries, now):
+        # Config directory doesn't exist, so RPC fails and seaf-cli output is used
+        args = argparse.Namespace(warning=30, critical=90, verbose=False,
+            conf_dir=os.path.join(self.test_dir, "ccnet"), log_file=None)
+        with mock.patch("subprocess.check_output", return_value=seaf_cli_output(libraries)), \
+                mock.patch("time.time", return_value=now), \
+                mock.patch("builtins.print") as print_mock, \
+                self.assertRaises(SystemExit) as exit_context:
+            check_seafile_sync.main(args)
+        return exit_context.exception.code, print_mock.call_args[0][0]
+
+    def set_last_check_time(self, last_check_time):
+        os.utime(self.state_file + ".lock", (last_check_time, last_check_time))
+
+    def test_state_transitions(self):
+        """Should count time in progress from the last check that saw library synchronized"""
+        self.assertEqual(self.run_check([("lib1", "synchronized"), ("lib2", "synchronized")], 10000),
+            (0, "lib1: synchronized; lib2: synchronized"))
+        with open(self.state_file) as state_f:
+            self.assertEqual(json.load(state_f), {"version": 2, "libraries": {
+                "lib1": ["synchronized", 10000], "lib2": ["synchronized", 10000]}})
+
+        self.set_last_check_time(20000)
+        self.assertEqual(self.run_check([("lib1", "committing"), ("lib2", "synchronized")], 20060),
+            (0, "lib1: committing 0:01:00; lib2: synchronized"))
+        # Changing between in-progress statuses doesn't reset the time
+        self.assertEqual(self.run_check([("lib1", "uploading"), ("lib2", "synchronized")], 20000 + 31 * 60),
+            (1, "lib1: uploading (!)0:31:00; lib2: synchronized"))
+        self.assertEqual(self.run_check([("lib1", "uploading"), ("lib2", "error")], 20000 + 91 * 60),
+            (2, "lib1: uploading (!)1:31:00; lib2: error"))
+
+    def test_failed_check(self):
+        """Should not update last check time if library listing has failed"""
+        self.run_check([("lib1", "synchronized")], 10000)
+        self.set_last_check_time(10000)
+        args = argparse.Namespace(warning=30, critical=90, verbose=False,
+            conf_dir=os.path.join(self.test_dir, "ccnet"), log_file=None)
+        with mock.patch("subprocess.check_output", side_effect=OSError("seaf-cli not found")), \
+                mock.patch("time.time", return_value=20000), \
+                mock.patch("builtins.print"), \
+                self.assertRaises(SystemExit) as exit_context:
+            check_seafile_sync.main(args)
+        self.assertEqual(exit_context.exception.code, check_seafile_sync.STATUS_UNKNOWN)
+        self.assertEqual(os.stat(self.state_file + ".lock").st_mtime, 10000)
+
+        self.run_check([("lib1", "synchronized")], 20060)
+        self.assertEqual(os.stat(self.state_file + ".lock").st_mtime, 20060)
+
+    def test_write_on_change(self):
+        """Should not rewrite state file if nothing has changed and drop removed libraries"""
+        self.run_check([("lib1", "synchronized"), ("lib2", "committing")], 10000)
+        with mock.patch("check_seafile_sync.save_state") as save_state_mock:
+            self.run_check([("lib1", "synchronized"), ("lib2", "committing")], 10060)
+            save_state_mock.assert_not_called()
+
+        self.run_check([("lib1", "synchronized")], 10120)
+        self.assertEqual(check_seafile_sync.load_state(self.state_file), ({"lib1": ["synchronized", 10000]}, None))
+        self.assertEqual([f_name for f_name in os.listdir(os.path.dirname(self.state_file))
+            if f_name.endswith(".tmp")], [])
+
+    def test_old_format(self):
+        """Should read state file in old format"""
+        os.makedirs(os.path.dirname(self.state_file))
+        last_synchronized = datetime.datetime(2024, 1, 26, 13, 0, 0)
+        with open(self.state_file, "w") as state_f:
+            json.dump({"lib1": last_synchronized.isoformat()}, state_f)
+
+        exit_code, status_text = self.run_check([("lib1", "committing")], last_synchronized.timestamp() + 3600)
+        self.assertEqual((exit_code, status_text), (1, "lib1: committing (!)1:00:00"))
+        self.assertEqual(check_seafile_sync.load_state(self.state_file),
+            ({"lib1": ["committing", last_synchronized.timestamp()]}, None))
+
+
+class rpc_FunctionalTests(unittest.TestCase):
+    """Functional tests for seaf-daemon RPC client"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.conf_dir = os.path.join(self.test_dir, "ccnet")
+        patcher = mock.patch("check_seafile_sync.STATE_FILE_NAME",
+            os.path.join(self.test_dir, "cache", "seafile_status.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def start_standin(self, libraries, auto_sync_enabled=True):
+        server = seaf_daemon_standin.start_standin(self.conf_dir, libraries, auto_sync_enabled)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_library_statuses(self):
+        """Should return structured library statuses in seaf-cli order"""
+        self.start_standin([
+            {"name": "lib2", "state": "uploading", "rate": 102400, "block_done": 5, "block_total": 10},
+            {"name": "Lib1", "state": "synchronized"},
+            {"name": "lib3", "state": "error", "error": 3},
+            {"name": "lib4"},
+            {"name": "lib5", "state": "synchronized", "auto_sync": False},
+        ])
+        with mock.patch("subprocess.check_output") as check_output_mock:
+            statuses = check_seafile_sync.get_library_statuses(self.conf_dir)
+            check_output_mock.assert_not_called()
+        self.assertEqual([vars(x) for x in statuses], [
+            {"name": "Lib1", "status": "synchronized", "progress": None, "rate": None, "error": None},
+            {"name": "lib2", "status": "uploading", "progress": "50.0%, 100.0KB/s", "rate": 102400,
+                "error": None},
+            {"name": "lib3", "status": "error", "progress": None, "rate": None,
+                "error": "Failed to login to server"},
+            {"name": "lib4", "status": "waiting for sync", "progress": None, "rate": None, "error": None},
+            {"name": "lib5", "status": "auto sync disabled", "progress": None, "rate": None, "error": None},
+        ])
+
+    def test_check_output(self):
+        """Should include transfer progress and error details in status text"""
+        self.start_standin([
+            {"name": "lib1", "state": "downloading", "rate": 2048, "block_done": 1, "block_total": 4},
+            {"name": "lib2", "state": "error", "error": 9},
+        ])
+        args = argparse.Namespace(warning=30, critical=90, verbose=False, conf_dir=self.conf_dir, log_file=None)
+        with mock.patch("builtins.print") as print_mock, self.assertRaises(SystemExit) as exit_context:
+            check_seafile_sync.main(args)
+        self.assertEqual((exit_context.exception.code, print_mock.call_args[0][0]),
+            (2, "lib1: downloading 0:00:00 (25.0%, 2.0KB/s); lib2: error (Server has been removed)"))
+
+    def test_seaf_cli_fallback(self):
+        """Should use seaf-cli if RPC fails and ignore blank lines in its output"""
+        server = self.start_standin([{"name": "lib1", "state": "synchronized"}])
+        server.libraries = None
+        with mock.patch("subprocess.check_output",
+                return_value=seaf_cli_output([("lib1", "synchronized")]) + "\n") as check_output_mock:
+            statuses = check_seafile_sync.get_library_statuses(self.conf_dir)
+        check_output_mock.assert_called_once_with(("seaf-cli", "status", "-c", self.conf_dir),
+            universal_newlines=True)
+        self.assertEqual([(x.name, x.status) for x in statuses], [("lib1", "synchronized")])
+
+
+class log_FunctionalTests(unittest.TestCase):
+    """Functional tests for seafile.log tracking"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.test_dir, "cache", "seafile_status.json")
+        self.log_file = os.path.join(self.test_dir, "seafile.log")
+        patcher = mock.patch("check_seafile_sync.STATE_FILE_NAME", self.state_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_log(self, lines, mode="a"):
+        with open(self.log_file, mode) as log_f:
+            log_f.write("".join(lines))
+
+    def run_check(self, now, libraries=()):
+        args = argparse.Namespace(warning=30, critical=90, verbose=False,
+            conf_dir=os.path.join(self.test_dir, "ccnet"), log_file=self.log_file)
+        with mock.patch("subprocess.check_output", return_value=seaf_cli_output(libraries)) as check_output_mock, \
+                mock.patch("time.time", return_value=now), \
+                mock.patch("builtins.print") as print_mock, \
+                self.assertRaises(SystemExit) as exit_context:
+            check_seafile_sync.main(args)
+        return exit_context.exception.code, print_mock.call_args[0][0], check_output_mock.called
+
+    def test_parse_log_line(self):
+        """Should parse transitions in old and new log formats"""
+        since = time.mktime((2024, 3, 26, 10, 0, 1, 0, 0, -1))
+        self.assertEqual(check_seafile_sync.parse_log_line(
+            "[03/26/24 10:00:01] sync-mgr.c(582): Repo 'My lib' sync state transition "
+            "from 'synchronized' to 'committing'."), (since, "My lib", "committing", None))
+        self.assertEqual(check_seafile_sync.parse_log_line(
+            "2024-03-26 10:00:01 sync-mgr.c(621): Repo 'lib' sync state transition "
+            "from uploading to 'error': 'Server error'."), (since, "lib", "error", "Server error"))
+        self.assertIsNone(check_seafile_sync.parse_log_line("[03/26/24 10:00:01] http-tx-mgr.c(1157): Transfer done."))
+
+    def test_incremental_reading(self):
+        """Should read only new log lines and count time from exact transition time"""
+        start = time.mktime((2024, 3, 26, 10, 0, 0, 0, 0, -1))
+        self.write_log([
+            "[03/26/24 09:00:00] sync-mgr.c(582): Repo 'lib1' sync state transition "
+            "from 'synchronized' to 'committing'.\n",
+            "[03/26/24 09:00:10] sync-mgr.c(582): Repo 'lib1' sync state transition "
+            "from 'committing' to 'synchronized'.\n",
+        ], "w")
+        # First run takes library list from seaf-daemon/seaf-cli
+        self.assertEqual(self.run_check(start, [("lib1", "synchronized"), ("lib2", "synchronized")]),
+            (0, "lib1: synchronized; lib2: synchronized | 'lib1'=0s;1800;5400;0 'lib2'=0s;1800;5400;0", True))
+
+        self.write_log([
+            "[03/26/24 10:05:00] sync-mgr.c(582): Repo 'lib2' sync state transition "
+            "from 'synchronized' to 'committing'.\n",
+            "[03/26/24 10:06:00] sync-mgr.c(582): Repo 'lib2' sync state transition "
+            "from 'committing' to 'uploading'.\n",
+            # Incomplete line is read on the next run
+            "[03/26/24 10:07:00] sync-mgr.c(582): Repo 'lib1'",
+        ])
+        with open(self.log_file, "rb") as log_f:
+            complete_lines_size = log_f.read().rfind(b"\n") + 1
+        self.assertEqual(self.run_check(start + 40 * 60),
+            (1, "lib1: synchronized; lib2: uploading (!)0:35:00 | 'lib1'=0s;1800;5400;0 'lib2'=2100s;1800;5400;0",
+                False))
+        self.assertEqual(check_seafile_sync.load_state(self.state_file)[1]["offset"], complete_lines_size)
+
+        self.write_log([
+            " sync state transition from 'synchronized' to 'error': 'Server error'.\n"
+        ])
+        exit_code, status_text, _ = self.run_check(start + 41 * 60)
+        self.assertEqual((exit_code, status_text.split(" | ")[0]),
+            (2, "lib1: error (Server error); lib2: uploading (!)0:36:00"))
+
+    def test_rotation(self):
+        """Should read rotated log from the start"""
+        start = time.mktime((2024, 3, 26, 10, 0, 0, 0, 0, -1))
+        self.write_log(["[03/26/24 09:00:00] sync-mgr.c(582): Repo 'lib1' sync state transition "
+            "from 'synchronized' to 'committing'.\n"] * 10, "w")
+        self.run_check(start, [("lib1", "committing")])
+
+        os.rename(self.log_file, self.log_file + ".1")
+        self.write_log(["[03/26/24 10:10:00] sync-mgr.c(582): Repo 'lib1' sync state transition "
+            "from 'committing' to 'synchronized'.\n"], "w")
+        self.assertEqual(self.run_check(start + 600, [("lib1", "synchronized")])[0:2],
+            (0, "lib1: synchronized | 'lib1'=0s;1800;5400;0"))
+        self.assertEqual(check_seafile_sync.load_state(self.state_file)[0], {"lib1": ["synchronized", start + 600]})
+
+    def test_library_list_refresh(self):
+        """Should refresh library list for an unknown library and periodically"""
+        start = time.mktime((2024, 3, 26, 10, 0, 0, 0, 0, -1))
+        self.write_log(["[03/26/24 09:00:00] sync-mgr.c(582): Repo 'lib1' sync state transition "
+            "from 'committing' to 'synchronized'.\n"], "w")
+        self.run_check(start, [("lib1", "synchronized"), ("lib2", "synchronized")])
+        self.assertEqual(self.run_check(start + 60)[2], False)
+
+        # A library added after the first run
+        self.write_log(["[03/26/24 10:02:00] sync-mgr.c(582): Repo 'lib3' sync state transition "
+            "from 'synchronized' to 'committing'.\n"])
+        self.assertEqual(self.run_check(start + 180, [("lib1", "synchronized"), ("lib2", "synchronized"),
+            ("lib3", "committing")]), (0, "lib1: synchronized; lib2: synchronized; lib3: committing 0:01:00 | "
+            "'lib1'=0s;1800;5400;0 'lib2'=0s;1800;5400;0 'lib3'=60s;1800;5400;0", True))
+        self.assertEqual(self.run_check(start + 240)[2], False)
+
+        # Removed library is dropped by the periodic refresh
+        exit_code, status_text, refreshed = self.run_check(
+            start + 180 + check_seafile_sync.LIBRARY_LIST_REFRESH_SECONDS,
+            [("lib1", "synchronized"), ("lib3", "synchronized")])
+        self.assertEqual((exit_code, status_text.split(" | ")[0], refreshed),
+            (0, "lib1: synchronized; lib3: synchronized", True))
+
+    def test_read_in_pieces(self):
+        """Should read the log in pieces, lines may span piece boundaries"""
+        lines = ["[03/26/24 09:00:{:02d}] sync-mgr.c(582): Repo 'lib{}' sync state transition "
+            "from 'synchronized' to 'committing'.\n".format(i, i) for i in range(50)]
+        self.write_log(lines + ["[03/26/24 09:01:00] incomplete"], "w")
+        with mock.patch("check_seafile_sync.LOG_READ_SIZE", 37):
+            transitions, log_position, read_from_start = check_seafile_sync.read_log_transitions(
+                self.log_file, None)
+        self.assertEqual([x[1] for x in transitions], ["lib{}".format(i) for i in range(50)])
+        self.assertEqual(log_position["offset"], len("".join(lines)))
+        self.assertTrue(read_from_start)
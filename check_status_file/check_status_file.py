@@ -2,10 +2,11 @@
 
 import sys
 import os
+import re
+import stat
+import time
 import argparse
 import datetime
-import dateutil.parser
-import pytz
 
 # Nagios status codes
 STATUS_UNKNOWN  = -1
@@ -21,6 +22,22 @@ STATUS_CODES = {
     "CRITICAL": STATUS_CRITICAL
 }
 
+STATUS_NAMES = {
+    STATUS_OK:       "OK",
+    STATUS_WARNING:  "WARNING",
+    STATUS_CRITICAL: "CRITICAL",
+    STATUS_UNKNOWN:  "UNKNOWN"
+}
+
+try:
+    UTC = datetime.timezone.utc
+except AttributeError:
+    # Python 2 has no stdlib timezones, pytz is used instead (imported on demand)
+    UTC = None
+
+# Status codes from the least to the most severe (used to aggregate multiple results)
+STATUS_SEVERITY = [STATUS_OK, STATUS_WARNING, STATUS_UNKNOWN, STATUS_CRITICAL]
+
 def print_stdout(string_to_print):
     print(string_to_print)
 
@@ -37,93 +54,521 @@ def get_timedelta_from_now(other_timestamp):
         return((datetime.datetime.now() - other_timestamp).total_seconds())
     else:
         # With timezone
-        return((pytz.utc.localize(datetime.datetime.utcnow()) - other_timestamp).total_seconds())
+        if UTC is not None:
+            utc_now = datetime.datetime.fromtimestamp(time.time(), UTC)
+        else:
+            import pytz
+            utc_now = pytz.utc.localize(datetime.datetime.utcnow())
+        return((utc_now - other_timestamp).total_seconds())
 
 
-def check_file(status_file_name, warning_hours, critical_hours):
-    if not(os.path.isfile(status_file_name)):
-        print_stdout("CRITICAL - status file '{}' does not exist".format(status_file_name))
-        return(STATUS_CRITICAL)
+def parse_timestamp(timestamp_str):
+    # Fast path: strict ISO 8601 (e.g. 'date -Iseconds' output) is parsed by the standard
+    # library (Python 3.7+). dateutil is slow to import and is used only as a fallback
+    # for other formats
+    if hasattr(datetime.datetime, "fromisoformat"):
+        try:
+            if timestamp_str.endswith("Z"):
+                # Python versions before 3.11 don't accept 'Z' as UTC designator
+                return(datetime.datetime.fromisoformat(timestamp_str[:-1] + "+00:00"))
+            return(datetime.datetime.fromisoformat(timestamp_str))
+        except ValueError:
+            pass
 
+    import dateutil.parser
+    return(dateutil.parser.parse(timestamp_str))
+
+
+class StatusDataError(Exception):
+    """Status file contents can't be used. Message is a status text without the status prefix"""
+    pass
+
+
+def parse_status_line(status_file_name, status_line):
     # Status data is expected as a single semicolon-delimited line in the
     # following format:
     # <timestamp>;<status>;<text description>
     # Timestamp is in ISO 8601 format.
     # Status can be one of the following values: OK, WARNING, ERROR, CRITICAL
-    with open(status_file_name, "r") as f:
-        # Python replaces \r\n with \n on Windows automatically, no need to use os.linesep
-        status_data = f.readline().rstrip("\n").split(";")
+    status_data = status_line.rstrip("\n").split(";")
 
     if len(status_data) != 3:
-        print_stdout("CRITICAL - Wrong status data in '{}'".format(status_file_name))
-        return(STATUS_CRITICAL)
+        raise StatusDataError("Wrong status data in '{}'".format(status_file_name))
+
+    return(parse_status_fields(status_file_name, *status_data))
+
 
+def parse_status_fields(status_file_name, timestamp_str, status_str, description):
     try:
-        status_timestamp = dateutil.parser.parse(status_data[0])
+        status_timestamp = parse_timestamp(timestamp_str)
     except ValueError as e:
-        print_stdout("CRITICAL - Wrong date/time format in file '{}': {}".format(status_file_name, status_data[0]))
-        return(STATUS_CRITICAL)
+        raise StatusDataError("Wrong date/time format in file '{}': {}".format(status_file_name, timestamp_str))
 
     try:
-        status_code = STATUS_CODES[status_data[1].upper()]
+        status_code = STATUS_CODES[status_str.upper()]
     except KeyError as e:
-        print_stdout("CRITICAL - Wrong status code in file '{}': {}".format(status_file_name, status_data[1]))
-        return(STATUS_CRITICAL)
+        raise StatusDataError("Wrong status code in file '{}': {}".format(status_file_name, status_str))
+
+    # (timestamp as written, parsed timestamp, status code, text description)
+    return((timestamp_str, status_timestamp, status_code, description))
+
+
+def parse_items(status_file_name, file_contents):
+    # Multi-item status data is a JSON object:
+    # {
+    #     "timestamp": "<default timestamp for items>",
+    #     "items": {
+    #         "<name>": {"timestamp": "...", "status": "OK", "text": "...", "perfdata": "label=1;2;3"},
+    #         ...
+    #     }
+    # }
+    # Item's timestamp and perfdata are optional
+    import json
+
+    try:
+        items_data = json.loads(file_contents)
+        items = items_data["items"]
+    except (ValueError, KeyError, TypeError):
+        raise StatusDataError("Wrong status data in '{}'".format(status_file_name))
+    if not isinstance(items, dict):
+        raise StatusDataError("Wrong status data in '{}'".format(status_file_name))
+
+    result = {}
+    for item_name in items:
+        item = items[item_name]
+        try:
+            # (timestamp as written, parsed timestamp, status code, text description, perfdata)
+            result[item_name] = parse_status_fields(status_file_name,
+                item.get("timestamp", items_data.get("timestamp")), item["status"],
+                item.get("text", "")) + (item.get("perfdata", ""),)
+        except StatusDataError as e:
+            result[item_name] = StatusDataError("Item '{}': {}".format(item_name, e))
+        except (KeyError, TypeError, AttributeError):
+            result[item_name] = StatusDataError("Item '{}': Wrong status data in '{}'".format(
+                item_name, status_file_name))
+    return(result)
+
+
+def read_status_data(status_file_name):
+    # Returns a tuple for a regular status file or a dictionary of tuples (or
+    # StatusDataError instances for invalid items) for a multi-item file
+    with open(status_file_name, "r") as f:
+        # Python replaces \r\n with \n on Windows automatically, no need to use os.linesep
+        first_line = f.readline()
+        if first_line.lstrip().startswith("{"):
+            return(parse_items(status_file_name, first_line + f.read()))
+        return(parse_status_line(status_file_name, first_line))
+
+
+def read_last_lines(status_file_name, line_count, block_size=8192):
+    # Reads the file backwards block by block until enough lines are collected,
+    # so the cost doesn't depend on file size
+    with open(status_file_name, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        non_blank_lines = 0
+        # One more line is needed to make sure the first line is complete. Blank
+        # lines are skipped below, so they don't count
+        while (position > 0) and (non_blank_lines <= line_count):
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+            non_blank_lines = len([line for line in data.split(b"\n") if line.strip()])
+
+    lines = data.splitlines()
+    if position > 0:
+        # Partially read line
+        lines = lines[1:]
+    lines = [line.decode("utf-8").rstrip("\r") for line in lines if line.strip()]
+    return(lines[-line_count:])
+
+
+def get_history_status(status_file_name, warning_hours, critical_hours, history_records,
+        flap_window_hours, flap_threshold):
+    # History file contains status lines appended by a producer, the last one is
+    # the current status
+    if not(os.path.isfile(status_file_name)):
+        return((STATUS_CRITICAL, "CRITICAL - status file '{}' does not exist".format(status_file_name)))
+
+    status_lines = read_last_lines(status_file_name, history_records)
+    if not status_lines:
+        return((STATUS_CRITICAL, "CRITICAL - Wrong status data in '{}'".format(status_file_name)))
+    try:
+        current_status_data = parse_status_line(status_file_name, status_lines[-1])
+    except StatusDataError as e:
+        return((STATUS_CRITICAL, "CRITICAL - {}".format(e)))
+
+    history = []
+    for status_line in status_lines[:-1]:
+        try:
+            history.append(parse_status_line(status_file_name, status_line))
+        except StatusDataError:
+            # Damaged old records don't affect current status
+            pass
+    history.append(current_status_data)
+
+    status_code, status_text = get_status(current_status_data, warning_hours, critical_hours)
+
+    # Time in current state: going back until the state changes
+    state_since = current_status_data[1]
+    state_is_complete = False
+    for status_data in reversed(history[:-1]):
+        if status_data[2] != current_status_data[2]:
+            state_is_complete = True
+            break
+        state_since = status_data[1]
+    time_in_state = get_timedelta_from_now(state_since)
+
+    flap_window_seconds = datetime.timedelta(hours=flap_window_hours).total_seconds()
+    window = [status_data for status_data in history
+        if get_timedelta_from_now(status_data[1]) <= flap_window_seconds]
+    failures = len([status_data for status_data in window if status_data[2] != STATUS_OK])
+    state_changes = len([i for i in range(1, len(window)) if window[i][2] != window[i - 1][2]])
+
+    status_text += "; {} for {}{:.2f} hour(s), {} failure(s) and {} state change(s) in last {} hour(s)".format(
+        STATUS_NAMES[current_status_data[2]], "" if state_is_complete else "at least ",
+        time_in_state / 3600, failures, state_changes, flap_window_hours)
+    if state_changes >= flap_threshold:
+        status_text += " (flapping)"
+        if status_code == STATUS_OK:
+            status_code = STATUS_WARNING
+            status_text = "WARNING" + status_text[len("OK"):]
+    status_text += " | time_in_state={:.0f}s failures={};;;0 state_changes={};{};;0".format(
+        time_in_state, failures, state_changes, flap_threshold)
+
+    return((status_code, status_text))
+
+
+def get_status(status_data, warning_hours, critical_hours):
+    timestamp_str, status_timestamp, status_code, description = status_data
 
     status_age = get_timedelta_from_now(status_timestamp)
     status_age_hours_str = "{:.2f} hour(s)".format(status_age / 3600)
 
-    return_value = STATUS_UNKNOWN
-
     if status_age <= datetime.timedelta(hours=warning_hours).total_seconds():
         # Last status change is under the warning threshold
         if status_code == STATUS_OK:
-            print_stdout("OK - {} [{}, {} ago]".format(status_data[2],
-                status_data[0], status_age_hours_str))
-            return_value = STATUS_OK
+            return((STATUS_OK, "OK - {} [{}, {} ago]".format(description,
+                timestamp_str, status_age_hours_str)))
         elif status_code == STATUS_WARNING:
-            print_stdout("WARNING - {} [{}, {} ago]".format(status_data[2],
-                status_data[0], status_age_hours_str))
-            return_value = STATUS_WARNING
+            return((STATUS_WARNING, "WARNING - {} [{}, {} ago]".format(description,
+                timestamp_str, status_age_hours_str)))
         else:
-            print_stdout("CRITICAL - {} [{}, {} ago]".format(status_data[2],
-                status_data[0], status_age_hours_str))
-            return_value = STATUS_CRITICAL
+            return((STATUS_CRITICAL, "CRITICAL - {} [{}, {} ago]".format(description,
+                timestamp_str, status_age_hours_str)))
     elif status_age <= datetime.timedelta(hours=critical_hours).total_seconds():
         # Last status change is over the warning threshold, but not over the critical
-        print_stdout("WARNING - {} since last status update is over the limit of {} hour(s) [{} - {}]".format(
-            status_age_hours_str, warning_hours, status_data[0], status_data[2]))
-        return_value = STATUS_WARNING
+        return((STATUS_WARNING, "WARNING - {} since last status update is over the limit of {} hour(s) [{} - {}]".format(
+            status_age_hours_str, warning_hours, timestamp_str, description)))
     else:
         # Last status change is over the critical threshold
-        print_stdout("CRITICAL - {} since last status update is over the limit of {} hour(s) [{} - {}]".format(
-            status_age_hours_str, critical_hours, status_data[0], status_data[2]))
-        return_value = STATUS_CRITICAL
+        return((STATUS_CRITICAL, "CRITICAL - {} since last status update is over the limit of {} hour(s) [{} - {}]".format(
+            status_age_hours_str, critical_hours, timestamp_str, description)))
+
+
+def prefix_perfdata_labels(perfdata, prefix):
+    # 'label'=value;... or label=value;... -> 'prefix label'=value;...
+    result = []
+    for label, value in re.findall(r"('[^']*'|[^\s=]+)=(\S*)", perfdata):
+        result.append("'{} {}'={}".format(prefix, label.strip("'"), value))
+    return(" ".join(result))
 
-    return(return_value)
 
-def main():
+def get_items_status(items, warning_hours, critical_hours, item_name=None):
+    if item_name is not None:
+        if item_name not in items:
+            return((STATUS_CRITICAL, "CRITICAL - Item '{}' not found".format(item_name)))
+        if isinstance(items[item_name], StatusDataError):
+            return((STATUS_CRITICAL, "CRITICAL - {}".format(items[item_name])))
+        status_code, status_text = get_status(items[item_name][:4], warning_hours, critical_hours)
+        if items[item_name][4]:
+            status_text += " | " + items[item_name][4]
+        return((status_code, status_text))
+
+    if not items:
+        return((STATUS_UNKNOWN, "UNKNOWN - No items in status file"))
+
+    # Worst-of aggregate: summary line with perfdata of all items, non-OK items
+    # are listed in the long output
+    counts = dict((status_code, 0) for status_code in STATUS_SEVERITY)
+    details = []
+    perfdata = []
+    for name in sorted(items):
+        if isinstance(items[name], StatusDataError):
+            status_code, status_text = STATUS_CRITICAL, "CRITICAL - {}".format(items[name])
+        else:
+            status_code, status_text = get_status(items[name][:4], warning_hours, critical_hours)
+            if items[name][4]:
+                perfdata.append(prefix_perfdata_labels(items[name][4], name))
+        counts[status_code] += 1
+        if status_code != STATUS_OK:
+            details.append("{}: {}".format(name, status_text))
+
+    exit_code = get_worst_status([status_code for status_code in counts if counts[status_code]])
+    status_text = "{} - {} item(s): {} critical, {} warning, {} unknown, {} ok".format(
+        STATUS_NAMES[exit_code], len(items), counts[STATUS_CRITICAL], counts[STATUS_WARNING],
+        counts[STATUS_UNKNOWN], counts[STATUS_OK])
+    if perfdata:
+        status_text += " | " + " ".join(perfdata)
+    return((exit_code, "\n".join([status_text] + details)))
+
+
+def evaluate_status_data(status_data, warning_hours, critical_hours, item_name=None):
+    # Status data as returned by read_status_data()
+    if isinstance(status_data, dict):
+        return(get_items_status(status_data, warning_hours, critical_hours, item_name))
+    if item_name is not None:
+        return((STATUS_CRITICAL, "CRITICAL - Status file has no items, can't get item '{}'".format(item_name)))
+    return(get_status(status_data, warning_hours, critical_hours))
+
+
+def get_file_status(status_file_name, warning_hours, critical_hours, item_name=None):
+    if not(os.path.isfile(status_file_name)):
+        return((STATUS_CRITICAL, "CRITICAL - status file '{}' does not exist".format(status_file_name)))
+
+    try:
+        status_data = read_status_data(status_file_name)
+    except StatusDataError as e:
+        return((STATUS_CRITICAL, "CRITICAL - {}".format(e)))
+
+    return(evaluate_status_data(status_data, warning_hours, critical_hours, item_name))
+
+
+def check_file(status_file_name, warning_hours, critical_hours, item_name=None):
+    status_code, status_text = get_file_status(status_file_name, warning_hours, critical_hours, item_name)
+    print_stdout(status_text)
+    return(status_code)
+
+
+def get_worst_status(status_codes):
+    worst_status = STATUS_OK
+    for status_code in status_codes:
+        if STATUS_SEVERITY.index(status_code) > STATUS_SEVERITY.index(worst_status):
+            worst_status = status_code
+    return(worst_status)
+
+
+def get_status_file_names(directory=None, glob_pattern=None, list_file=None):
+    if directory is not None:
+        # Hidden files are skipped (temporary files of atomic writers, editor swap files, etc.)
+        return([os.path.join(directory, f_name) for f_name in sorted(os.listdir(directory))
+            if not f_name.startswith(".")])
+    elif glob_pattern is not None:
+        import glob
+        return(sorted(glob.glob(glob_pattern)))
+    else:
+        # One file name per line, empty lines and lines starting with '#' are ignored
+        with open(list_file, "r") as f:
+            return([line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")])
+
+
+def get_batch_status(status_file_names, warning_hours, critical_hours, history_options=None, item_name=None):
+    # history_options: None for regular status files or a dictionary with
+    # get_history_status() parameters for history files
+    results = []
+    critical_seconds = datetime.timedelta(hours=critical_hours).total_seconds()
+    now = time.time()
+    for status_file_name in status_file_names:
+        try:
+            file_stat = os.stat(status_file_name)
+        except OSError:
+            file_stat = None
+        if (file_stat is None) or not(stat.S_ISREG(file_stat.st_mode)):
+            results.append((status_file_name, STATUS_CRITICAL,
+                "CRITICAL - status file '{}' does not exist".format(status_file_name)))
+            continue
+
+        # Status is written no later than the file is modified, so if modification
+        # time is already over the critical threshold, there is no need to read the file
+        mtime_age = now - file_stat.st_mtime
+        if mtime_age > critical_seconds:
+            results.append((status_file_name, STATUS_CRITICAL,
+                "CRITICAL - status file was last modified {:.2f} hour(s) ago, which is over the limit of {} hour(s)".format(
+                    mtime_age / 3600, critical_hours)))
+            continue
+
+        try:
+            if history_options is None:
+                status_code, status_text = evaluate_status_data(read_status_data(status_file_name),
+                    warning_hours, critical_hours, item_name)
+            else:
+                status_code, status_text = get_history_status(status_file_name, warning_hours,
+                    critical_hours, **history_options)
+        except StatusDataError as e:
+            status_code, status_text = STATUS_CRITICAL, "CRITICAL - {}".format(e)
+        except Exception as e:
+            status_code, status_text = STATUS_UNKNOWN, "UNKNOWN - Unhandled exception: {}".format(e)
+        results.append((status_file_name, status_code, status_text))
+
+    return(results)
+
+
+def strip_perfdata(status_text):
+    # Perfdata of single files can't go to batch long output: labels of different
+    # files would clash
+    return("\n".join([line.split("|", 1)[0].rstrip() for line in status_text.splitlines()]))
+
+
+def print_batch_status(results, output_format):
+    if not results:
+        print_stdout("UNKNOWN - No status files to check")
+        return(STATUS_UNKNOWN)
+
+    exit_code = get_worst_status([result[1] for result in results])
+
+    if output_format == "json":
+        import json
+        print_stdout(json.dumps({
+            "status": exit_code,
+            "files": [{"file": f_name, "status": status_code, "status_text": status_text}
+                for f_name, status_code, status_text in results]
+        }))
+    elif output_format == "lines":
+        for f_name, status_code, status_text in results:
+            # Multi-item files have item details on separate lines
+            for line in status_text.splitlines():
+                print_stdout("{}: {}".format(f_name, line))
+    else:
+        counts = dict((status_code, 0) for status_code in STATUS_SEVERITY)
+        for result in results:
+            counts[result[1]] += 1
+        # Summary line with perfdata, non-OK files are listed in the long output
+        print_stdout("{} - {} status file(s): {} critical, {} warning, {} unknown, {} ok | "
+            "critical={} warning={} unknown={} ok={}".format(STATUS_NAMES[exit_code], len(results),
+                counts[STATUS_CRITICAL], counts[STATUS_WARNING], counts[STATUS_UNKNOWN], counts[STATUS_OK],
+                counts[STATUS_CRITICAL], counts[STATUS_WARNING], counts[STATUS_UNKNOWN], counts[STATUS_OK]))
+        for f_name, status_code, status_text in results:
+            if status_code != STATUS_OK:
+                for line in strip_perfdata(status_text).splitlines():
+                    print_stdout("{}: {}".format(f_name, line))
+
+    return(exit_code)
+
+def query_watcher(socket_path, status_file_names, warning_hours, critical_hours, item_name=None):
+    # Asks status_file_watcher.py for results instead of reading files
+    import json
+    import socket
+
+    request = {
+        "files": [os.path.abspath(f_name) for f_name in status_file_names],
+        "warning_hours": warning_hours,
+        "critical_hours": critical_hours,
+        "item": item_name
+    }
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client_socket.settimeout(10)
+    try:
+        client_socket.connect(os.path.expanduser(socket_path))
+        client_socket.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        response_data = b""
+        while True:
+            chunk = client_socket.recv(65536)
+            if not chunk:
+                break
+            response_data += chunk
+    finally:
+        client_socket.close()
+
+    response = json.loads(response_data.decode("utf-8"))
+    if "error" in response:
+        raise Exception("Status file watcher error: {}".format(response["error"]))
+    # An incomplete reply would silently drop files, caller reads them directly then
+    if [result[0] for result in response["results"]] != request["files"]:
+        raise Exception("Status file watcher reply doesn't match the request")
+    # Keep file names as they were passed to us
+    return([(f_name, result[1], result[2]) for f_name, result in zip(status_file_names, response["results"])])
+
+
+def main(argv=None):
     exit_code = STATUS_UNKNOWN
     try:
         parser = argparse.ArgumentParser(description="Nagios plugin to report status from custom file")
-        parser.add_argument("status_file_name", help="File to read status information from")
+        source_group = parser.add_mutually_exclusive_group(required=True)
+        source_group.add_argument("status_file_name", nargs="?", help="File to read status information from")
+        source_group.add_argument("-d", "--directory", dest="directory", default=None,
+          help="Check every status file in a directory (hidden files are skipped)")
+        source_group.add_argument("-g", "--glob", dest="glob_pattern", default=None,
+          help="Check every status file matching a glob pattern")
+        source_group.add_argument("-l", "--list-file", dest="list_file", default=None,
+          help="Check every status file listed in a file (one name per line)")
         parser.add_argument('-w', '--warning-hours', dest='warning_hours', type=int, default=25,
           help='Number of hours since last change to cause warning state (default: %(default)d)')
         parser.add_argument('-c', '--critical-hours', dest='critical_hours', type=int, default=49,
           help='Number of hours since last change to cause critical state (default: %(default)d)')
+        parser.add_argument('-o', '--output', dest='output', default="summary",
+          choices=["summary", "lines", "json"],
+          help='Output format when checking multiple files (default: %(default)s)')
+        parser.add_argument('-i', '--item', dest='item_name', default=None,
+          help='Report status of a single item of a multi-item (JSON) status file instead of the worst one')
+        parser.add_argument('-H', '--history', dest='history', action='store_true', default=False,
+          help='Status file is an append-only log, the last line is the current status')
+        parser.add_argument('-r', '--history-records', dest='history_records', type=int, default=100,
+          help='Number of last history records to read (default: %(default)d)')
+        parser.add_argument('--flap-window-hours', dest='flap_window_hours', type=int, default=24,
+          help='Time window to count failures and state changes in (default: %(default)d)')
+        parser.add_argument('--flap-threshold', dest='flap_threshold', type=int, default=5,
+          help='Number of state changes in the window to consider status flapping (default: %(default)d)')
+        parser.add_argument('-s', '--watcher-socket', dest='watcher_socket', default=None,
+          help='Get results from status_file_watcher.py listening on this socket (files are read '
+          'directly if the watcher is not available)')
 
-        options = parser.parse_args()
+        options = parser.parse_args(argv)
         if options.warning_hours > options.critical_hours:
             print("Error: critical threshold cannot be less than warning")
             return (STATUS_UNKNOWN)
 
-        exit_code = check_file(options.status_file_name, options.warning_hours,
-          options.critical_hours)
+        if options.status_file_name is not None:
+            status_file_names = [options.status_file_name]
+        else:
+            status_file_names = get_status_file_names(directory=options.directory,
+              glob_pattern=options.glob_pattern, list_file=options.list_file)
+
+        history_options = None
+        if options.history:
+            history_options = {
+                "history_records": options.history_records,
+                "flap_window_hours": options.flap_window_hours,
+                "flap_threshold": options.flap_threshold
+            }
+
+        results = None
+        # Watcher keeps the first line of a file only, history files are always read directly
+        if options.watcher_socket and (history_options is None):
+            try:
+                results = query_watcher(options.watcher_socket, status_file_names,
+                  options.warning_hours, options.critical_hours, options.item_name)
+            except Exception:
+                # Watcher is not running or has failed, read files directly
+                pass
+
+        if options.status_file_name is not None:
+            if (results is None) and (history_options is not None):
+                exit_code, status_text = get_history_status(options.status_file_name,
+                  options.warning_hours, options.critical_hours, **history_options)
+                print_stdout(status_text)
+            elif results is None:
+                exit_code = check_file(options.status_file_name, options.warning_hours,
+                  options.critical_hours, options.item_name)
+            else:
+                print_stdout(results[0][2])
+                exit_code = results[0][1]
+        else:
+            if results is None:
+                results = get_batch_status(status_file_names, options.warning_hours,
+                  options.critical_hours, history_options, options.item_name)
+            exit_code = print_batch_status(results, options.output)
 
     except Exception as e:
         print("Unhandled exception: {}".format(e))
 
     return (exit_code)
 
+def run(argv):
+    # In-process entry point for tools/check_server.py: argv without program name,
+    # output goes to sys.stdout, returns exit code
+    return(main(argv))
+
 if __name__ == '__main__':
     sys.exit(main())
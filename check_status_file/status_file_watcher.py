@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+# Resident companion to check_status_file.py. Keeps parsed status files in memory,
+# re-reads a file only when inotify reports that it has changed and answers
+# check_status_file.py queries over a Unix socket (see --watcher-socket option).
+# Age thresholds are evaluated at query time, so a query costs no file system access.
+#
+# Clients are handled in threads, a slow client doesn't hold up the others.
+#
+# Protocol: a client sends a single JSON line
+#   {"files": ["/abs/path", ...], "warning_hours": 25, "critical_hours": 49, "item": null}
+# and gets back a single JSON line
+#   {"results": [["/abs/path", <status code>, "<status text>"], ...]}
+
+import os
+import sys
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import datetime
+import json
+import selectors
+import signal
+import socket
+import struct
+import threading
+import time
+
+import check_status_file
+
+DEFAULT_SOCKET_PATH = "~/.cache/cheretbe/nagios-plugins/status_file_watcher.sock"
+# Requests contain a list of file names, thousands of them are still well under this limit
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# A client has this many seconds to send its request
+REQUEST_TIMEOUT = 5
+DEFAULT_MAX_FILES = 10000
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY is not watched on purpose: a file is re-read when the writer closes it,
+# not while it is being written
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+verbose = False
+
+
+def print_verbose(verbose_msg):
+    if verbose:
+        print("{} {}".format(datetime.datetime.now().strftime("%x %X"), verbose_msg), flush=True)
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd):
+        if self._rm_watch(self.fd, wd) < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def read_events(self):
+        events = []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset : offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StatusFileCache:
+    """Parsed status data of known files, kept up to date by inotify events or polling.
+    At most max_files files are kept, least recently queried ones are evicted first"""
+
+    def __init__(self, inotify=None, max_files=DEFAULT_MAX_FILES):
+        self.inotify = inotify
+        self.max_files = max_files
+        # Client threads and the main loop share the cache
+        self.lock = threading.RLock()
+        # file name -> (stat signature, status data tuple or StatusDataError instance),
+        # in order of last query
+        self.files = collections.OrderedDict()
+        # directory -> set of known file names in it
+        self.directories = {}
+        self.watch_descriptors = {}
+
+    def get_status_data(self, status_file_name):
+        if status_file_name not in self.files:
+            directory = os.path.dirname(status_file_name)
+            if not self.watch_directory(directory):
+                # Directory can't be watched (does not exist, no more watches, etc.)
+                # Don't cache anything, the file is read on every query
+                return self.read_file(status_file_name)[1]
+            self.directories[directory].add(status_file_name)
+            self.files[status_file_name] = self.read_file(status_file_name)
+            self.evict_files()
+        else:
+            self.files.move_to_end(status_file_name)
+        return self.files[status_file_name][1]
+
+    def evict_files(self):
+        while len(self.files) > self.max_files:
+            status_file_name, _ = self.files.popitem(last=False)
+            print_verbose(f"Evicting '{status_file_name}'")
+            directory = os.path.dirname(status_file_name)
+            directory_files = self.directories.get(directory)
+            if directory_files is None:
+                continue
+            directory_files.discard(status_file_name)
+            # Watches are limited (fs.inotify.max_user_watches), a directory without
+            # known files doesn't need one
+            if not directory_files:
+                self.unwatch_directory(directory)
+
+    def unwatch_directory(self, directory):
+        print_verbose(f"No known files left in '{directory}', not watching it")
+        del self.directories[directory]
+        for wd, watched_directory in list(self.watch_descriptors.items()):
+            if watched_directory == directory:
+                del self.watch_descriptors[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError as e:
+                    # Watch is already gone with the directory
+                    print_verbose(f"Can't remove watch of '{directory}': {e}")
+
+    def watch_directory(self, directory, preload=False):
+        if directory in self.directories:
+            return True
+        if self.inotify is not None:
+            try:
+                self.watch_descriptors[self.inotify.add_watch(directory, WATCH_MASK)] = directory
+            except OSError as e:
+                print_verbose(f"Can't watch directory '{directory}': {e}")
+                return False
+        elif not os.path.isdir(directory):
+            return False
+        print_verbose(f"Watching directory '{directory}'")
+        self.directories[directory] = set()
+        if preload:
+            for f_name in os.listdir(directory):
+                if not f_name.startswith("."):
+                    self.get_status_data(os.path.join(directory, f_name))
+        return True
+
+    @staticmethod
+    def read_file(status_file_name):
+        # Returns (stat signature, status data) where status data is either returned
+        # by check_status_file.read_status_data() or is a StatusDataError instance
+        try:
+            file_stat = os.stat(status_file_name)
+        except OSError:
+            file_stat = None
+        if (file_stat is None) or not os.path.isfile(status_file_name):
+            return (None, check_status_file.StatusDataError(
+                "status file '{}' does not exist".format(status_file_name)))
+        signature = (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        try:
+            return (signature, check_status_file.read_status_data(status_file_name))
+        except (check_status_file.StatusDataError, OSError, UnicodeDecodeError) as e:
+            if not isinstance(e, check_status_file.StatusDataError):
+                e = check_status_file.StatusDataError(
+                    "Can't read status file '{}': {}".format(status_file_name, e))
+            return (signature, e)
+
+    def reload_file(self, status_file_name):
+        if status_file_name in self.files:
+            print_verbose(f"Reloading '{status_file_name}'")
+            self.files[status_file_name] = self.read_file(status_file_name)
+
+    def forget_directory(self, directory):
+        print_verbose(f"Directory '{directory}' is gone, forgetting its files")
+        for status_file_name in self.directories.pop(directory, ()):
+            self.files.pop(status_file_name, None)
+
+    def process_events(self):
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Some events are lost, reload everything we know about
+                for status_file_name in list(self.files):
+                    self.reload_file(status_file_name)
+                continue
+            directory = self.watch_descriptors.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self.watch_descriptors.pop(wd)
+                self.forget_directory(directory)
+            elif name and not name.startswith("."):
+                self.reload_file(os.path.join(directory, name))
+
+    def poll_changes(self):
+        # Fallback for systems without inotify: only stat() calls, files are read
+        # when their signature has changed
+        for status_file_name, (signature, _) in list(self.files.items()):
+            try:
+                file_stat = os.stat(status_file_name)
+                new_signature = (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+            except OSError:
+                new_signature = None
+            if new_signature != signature:
+                self.reload_file(status_file_name)
+
+
+def get_query_results(cache, request):
+    results = []
+    for status_file_name in request["files"]:
+        status_file_name = os.path.abspath(status_file_name)
+        with cache.lock:
+            status_data = cache.get_status_data(status_file_name)
+        if isinstance(status_data, check_status_file.StatusDataError):
+            status_code, status_text = check_status_file.STATUS_CRITICAL, "CRITICAL - {}".format(status_data)
+        else:
+            status_code, status_text = check_status_file.evaluate_status_data(
+                status_data, request["warning_hours"], request["critical_hours"], request.get("item"))
+        results.append([status_file_name, status_code, status_text])
+    return results
+
+
+def handle_client(cache, client_socket):
+    with client_socket:
+        deadline = time.monotonic() + REQUEST_TIMEOUT
+        request_data = b""
+        try:
+            while not request_data.endswith(b"\n"):
+                # Whole request must arrive in time, not just every chunk
+                client_socket.settimeout(max(0.001, deadline - time.monotonic()))
+                chunk = client_socket.recv(65536)
+                if not chunk:
+                    break
+                request_data += chunk
+                if len(request_data) > MAX_REQUEST_SIZE:
+                    raise ValueError("Request is too large")
+            response = {"results": get_query_results(cache, json.loads(request_data.decode("utf-8")))}
+        except socket.timeout:
+            return
+        except Exception as e:
+            response = {"error": str(e)}
+        try:
+            client_socket.settimeout(REQUEST_TIMEOUT)
+            client_socket.sendall(json.dumps(response).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+
+
+def serve(server_socket, cache, poll_interval):
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ, "client")
+    if cache.inotify is not None:
+        selector.register(cache.inotify, selectors.EVENT_READ, "inotify")
+
+    next_poll = time.monotonic() + poll_interval
+    while True:
+        timeout = None if cache.inotify is not None else max(0, next_poll - time.monotonic())
+        for key, _ in selector.select(timeout):
+            if key.data == "inotify":
+                with cache.lock:
+                    cache.process_events()
+            else:
+                try:
+                    client_socket, _ = server_socket.accept()
+                except BlockingIOError:
+                    continue
+                threading.Thread(target=handle_client, args=(cache, client_socket), daemon=True).start()
+        if cache.inotify is None and time.monotonic() >= next_poll:
+            with cache.lock:
+                cache.poll_changes()
+            next_poll = time.monotonic() + poll_interval
+
+
+def create_server_socket(socket_path):
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server_socket.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server_socket.listen(128)
+    server_socket.setblocking(False)
+    return server_socket
+
+
+def main(args):
+    global verbose
+    verbose = args.verbose
+
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError) as e:
+        print(f"inotify is not available ({e}), polling every {args.poll_interval} second(s)", flush=True)
+        inotify = None
+
+    cache = StatusFileCache(inotify, args.max_files)
+    for directory in args.directories:
+        cache.watch_directory(os.path.abspath(directory), preload=True)
+
+    socket_path = os.path.expanduser(args.socket_path)
+    server_socket = create_server_socket(socket_path)
+    print_verbose(f"Listening on '{socket_path}'")
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        serve(server_socket, cache, args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server_socket.close()
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Status file watcher for check_status_file.py")
+    parser.add_argument(
+        "directories", nargs="*",
+        help="Directories to watch and preload on startup (directories of queried files are watched automatically)",
+    )
+    parser.add_argument(
+        "-s", "--socket", dest="socket_path", default=DEFAULT_SOCKET_PATH,
+        help="Unix socket to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-p", "--poll-interval", dest="poll_interval", type=int, default=30,
+        help="Polling interval in seconds if inotify is not available (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-m", "--max-files", dest="max_files", type=int, default=DEFAULT_MAX_FILES,
+        help="Maximum number of status files kept in memory (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-v", "--verbose", dest="verbose", action="store_true", default=False,
+        help="Display verbose debug messages",
+    )
+
+    main(parser.parse_args())
@@ -8,6 +8,7 @@ import freezegun
 import dateutil.tz
 import tempfile
 import shutil
+import json
 
 import check_status_file
 
@@ -60,6 +61,27 @@ class get_timedelta_from_now_UnitTests(unittest.TestCase):
         self.assertEqual(ret_val, 4781)
 
 
+class parse_timestamp_UnitTests(unittest.TestCase):
+    """Unit tests for 'parse_timestamp' function"""
+
+    def test_iso_8601(self):
+        """Should parse ISO 8601 timestamps without dateutil"""
+        with mock.patch("dateutil.parser.parse") as parse_mock:
+            self.assertEqual(check_status_file.parse_timestamp("2017-05-30T11:12:05+02:00"),
+                datetime.datetime(2017, 5, 30, 11, 12, 5, tzinfo=dateutil.tz.tzoffset(None, 7200)))
+            self.assertEqual(check_status_file.parse_timestamp("2017-05-30T11:12:05Z"),
+                datetime.datetime(2017, 5, 30, 11, 12, 5, tzinfo=dateutil.tz.tzutc()))
+            self.assertEqual(check_status_file.parse_timestamp("2017-05-30 11:12:05"),
+                datetime.datetime(2017, 5, 30, 11, 12, 5))
+            parse_mock.assert_not_called()
+
+    def test_other_formats(self):
+        """Should fall back to dateutil for non-ISO timestamps"""
+        self.assertEqual(check_status_file.parse_timestamp("May 30 2017 11:12:05 +0200"),
+            datetime.datetime(2017, 5, 30, 11, 12, 5, tzinfo=dateutil.tz.tzoffset(None, 7200)))
+        self.assertRaises(ValueError, check_status_file.parse_timestamp, "wrong_date")
+
+
 @mock.patch("os.path.isfile")
 @mock.patch("check_status_file.print_stdout")
 @mock.patch("check_status_file.get_timedelta_from_now")
@@ -299,4 +321,255 @@ class check_file_FunctionalTests(unittest.TestCase):
 
         self.assertEqual(0, check_status_file.check_file(
             self.create_test_status_file([test_timestamp + ";OK;test3-trailing-space ", "line2", "line3"]), 3, 5))
-        print_stdout_mock.assert_called_with("OK - test3-trailing-space  [{}, 2.00 hour(s) ago]".format(test_timestamp))
\ No newline at end of file
+        print_stdout_mock.assert_called_with("OK - test3-trailing-space  [{}, 2.00 hour(s) ago]".format(test_timestamp))
+
+class batch_mode_FunctionalTests(unittest.TestCase):
+    """Functional tests for batch (multiple files) mode"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def create_test_status_file(self, f_name, file_contents):
+        test_file_full_path = os.path.join(self.test_dir, f_name)
+        with open(test_file_full_path, "w") as f:
+            f.write(file_contents + "\n")
+        return(test_file_full_path)
+
+    def timestamp_as_iso_8601(self, hours_offset=0):
+        timestamp = datetime.datetime.now(dateutil.tz.tzlocal()).replace(microsecond=0)
+        return((timestamp + datetime.timedelta(hours=hours_offset)).isoformat())
+
+    def test_get_status_file_names(self):
+        """Should list status files from a directory, a glob pattern or a list file"""
+        f1 = self.create_test_status_file("status1", "")
+        f2 = self.create_test_status_file("status2", "")
+        self.create_test_status_file(".hidden", "")
+        list_file = self.create_test_status_file(".list", "# comment\n\n{}\n  {}  \n".format(f2, f1))
+
+        self.assertEqual([f1, f2], check_status_file.get_status_file_names(directory=self.test_dir))
+        self.assertEqual([f1, f2], check_status_file.get_status_file_names(
+            glob_pattern=os.path.join(self.test_dir, "status*")))
+        self.assertEqual([f2, f1], check_status_file.get_status_file_names(list_file=list_file))
+
+    def test_get_batch_status(self):
+        """Should check every file and skip reading files modified too long ago"""
+        ok_file = self.create_test_status_file("ok", self.timestamp_as_iso_8601(-2) + ";OK;description")
+        wrong_file = self.create_test_status_file("wrong", "wrong_data")
+        old_file = self.create_test_status_file("old", self.timestamp_as_iso_8601(-2) + ";OK;description")
+        old_mtime = time.time() - 50 * 3600
+        os.utime(old_file, (old_mtime, old_mtime))
+        missing_file = os.path.join(self.test_dir, "missing")
+
+        with mock.patch("check_status_file.read_status_data",
+                wraps=check_status_file.read_status_data) as read_status_data_mock:
+            results = check_status_file.get_batch_status([ok_file, wrong_file, old_file, missing_file], 25, 49)
+            # Neither old nor missing file is read
+            self.assertEqual(2, read_status_data_mock.call_count)
+
+        self.assertEqual([f_name for f_name, _, _ in results], [ok_file, wrong_file, old_file, missing_file])
+        self.assertEqual([status_code for _, status_code, _ in results], [0, 2, 2, 2])
+        self.assertEqual(results[1][2], "CRITICAL - Wrong status data in '{}'".format(wrong_file))
+        self.assertTrue(results[2][2].startswith("CRITICAL - status file was last modified 50.00 hour(s) ago"))
+        self.assertEqual(results[3][2], "CRITICAL - status file '{}' does not exist".format(missing_file))
+
+    @mock.patch("check_status_file.print_stdout")
+    def test_print_batch_status(self, print_stdout_mock):
+        """Should return worst status and print results in requested format"""
+        results = [
+            ("f1", 0, "OK - text1"),
+            ("f2", 1, "WARNING - text2"),
+            ("f3", 0, "OK - text3"),
+        ]
+        self.assertEqual(1, check_status_file.print_batch_status(results, "summary"))
+        self.assertEqual(print_stdout_mock.call_args_list, [
+            mock.call("WARNING - 3 status file(s): 0 critical, 1 warning, 0 unknown, 2 ok | "
+                "critical=0 warning=1 unknown=0 ok=2"),
+            mock.call("f2: WARNING - text2")
+        ])
+
+        print_stdout_mock.reset_mock()
+        self.assertEqual(1, check_status_file.print_batch_status(results, "lines"))
+        self.assertEqual(print_stdout_mock.call_args_list,
+            [mock.call("f1: OK - text1"), mock.call("f2: WARNING - text2"), mock.call("f3: OK - text3")])
+
+        print_stdout_mock.reset_mock()
+        self.assertEqual(1, check_status_file.print_batch_status(results, "json"))
+        self.assertEqual(json.loads(print_stdout_mock.call_args[0][0]), {
+            "status": 1,
+            "files": [
+                {"file": "f1", "status": 0, "status_text": "OK - text1"},
+                {"file": "f2", "status": 1, "status_text": "WARNING - text2"},
+                {"file": "f3", "status": 0, "status_text": "OK - text3"},
+            ]
+        })
+
+        # UNKNOWN is worse than WARNING, but better than CRITICAL
+        self.assertEqual(-1, check_status_file.print_batch_status(results + [("f4", -1, "UNKNOWN")], "lines"))
+        self.assertEqual(2, check_status_file.print_batch_status(
+            results + [("f4", -1, "UNKNOWN"), ("f5", 2, "CRITICAL")], "lines"))
+        # Nothing to check
+        self.assertEqual(-1, check_status_file.print_batch_status([], "summary"))
+
+        # Perfdata of a file is not repeated in the long output
+        print_stdout_mock.reset_mock()
+        check_status_file.print_batch_status(results + [("f4", 1, "WARNING - 6 (flapping) | time_in_state=3600s")],
+            "summary")
+        self.assertEqual(print_stdout_mock.call_args_list[-1], mock.call("f4: WARNING - 6 (flapping)"))
+
+        # Multi-item file: every line is attributed to the file, item perfdata is dropped
+        items_result = ("f5", 2, "CRITICAL - 2 item(s): 1 critical, 0 warning, 0 unknown, 1 ok | "
+            "'job1 files'=10;;;0\njob2: CRITICAL - failed [2017-05-30T10:00:00+02:00, 1.00 hour(s) ago]")
+        print_stdout_mock.reset_mock()
+        check_status_file.print_batch_status(results + [items_result], "summary")
+        self.assertEqual(print_stdout_mock.call_args_list[-2:], [
+            mock.call("f5: CRITICAL - 2 item(s): 1 critical, 0 warning, 0 unknown, 1 ok"),
+            mock.call("f5: job2: CRITICAL - failed [2017-05-30T10:00:00+02:00, 1.00 hour(s) ago]"),
+        ])
+        print_stdout_mock.reset_mock()
+        check_status_file.print_batch_status([items_result], "lines")
+        self.assertEqual(print_stdout_mock.call_count, 2)
+
+
+class history_mode_FunctionalTests(unittest.TestCase):
+    """Functional tests for history (append-only log) mode"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.test_dir, "history")
+        self.now = datetime.datetime(2017, 5, 30, 11, 12, 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_history(self, records):
+        # records: list of (hours_offset, status, description), oldest first
+        now = self.now
+        with open(self.history_file, "w") as f:
+            for hours_offset, status, description in records:
+                f.write("{};{};{}\n".format((now + datetime.timedelta(hours=hours_offset)).isoformat(),
+                    status, description))
+
+    def test_read_last_lines(self):
+        """Should return last lines without reading the whole file"""
+        with open(self.history_file, "w") as f:
+            for i in range(10000):
+                f.write("line {}\n".format(i))
+            f.write("\n")
+
+        read_sizes = []
+        original_open = open
+        def open_mock(*args, **kwargs):
+            f = original_open(*args, **kwargs)
+            original_read = f.read
+            def read_mock(size=-1):
+                read_sizes.append(size)
+                return original_read(size)
+            f.read = read_mock
+            return f
+
+        with mock.patch(BUILTIN_OPEN_NAME, side_effect=open_mock):
+            lines = check_status_file.read_last_lines(self.history_file, 3, block_size=16)
+        self.assertEqual(lines, ["line 9997", "line 9998", "line 9999"])
+        self.assertTrue(sum(read_sizes) < 100)
+
+        # File is shorter than requested number of lines
+        self.assertEqual(len(check_status_file.read_last_lines(self.history_file, 20000)), 10000)
+
+        # Blank lines don't count as records
+        with open(self.history_file, "w") as f:
+            f.write("line 1\nline 2\n\n\n\nline 3\n\n\n")
+        self.assertEqual(check_status_file.read_last_lines(self.history_file, 2, block_size=4), ["line 2", "line 3"])
+
+    @mock.patch("check_status_file.get_timedelta_from_now")
+    def test_get_history_status(self, get_timedelta_from_now_mock):
+        """Should report current status, time in state, failures and flapping"""
+        get_timedelta_from_now_mock.side_effect = lambda timestamp: (self.now - timestamp).total_seconds()
+
+        self.write_history([(-30, "ERROR", "old failure"), (-5, "ERROR", "failure"), (-4, "wrong_status", ""),
+            (-3, "OK", "recovered"), (-2, "OK", "running"), (-1, "OK", "running")])
+        status_code, status_text = check_status_file.get_history_status(self.history_file, 25, 49,
+            history_records=100, flap_window_hours=24, flap_threshold=5)
+        self.assertEqual(status_code, 0)
+        self.assertTrue(status_text.startswith("OK - running ["))
+        self.assertTrue(status_text.endswith("; OK for 3.00 hour(s), 1 failure(s) and 1 state change(s) "
+            "in last 24 hour(s) | time_in_state=10800s failures=1;;;0 state_changes=1;5;;0"))
+
+        # Only last two records are read, start of the state is unknown
+        status_code, status_text = check_status_file.get_history_status(self.history_file, 25, 49,
+            history_records=2, flap_window_hours=24, flap_threshold=5)
+        self.assertIn("; OK for at least 2.00 hour(s), 0 failure(s)", status_text)
+
+        # Flapping turns OK into WARNING
+        self.write_history([(-6, "OK", "1"), (-5, "ERROR", "2"), (-4, "OK", "3"), (-3, "ERROR", "4"),
+            (-2, "OK", "5"), (-1, "OK", "6")])
+        status_code, status_text = check_status_file.get_history_status(self.history_file, 25, 49,
+            history_records=100, flap_window_hours=24, flap_threshold=4)
+        self.assertEqual(status_code, 1)
+        self.assertTrue(status_text.startswith("WARNING - 6 ["))
+        self.assertIn("2 failure(s) and 4 state change(s) in last 24 hour(s) (flapping) |", status_text)
+
+        # Last record is damaged
+        self.write_history([(-2, "OK", "1"), (-1, "wrong_status", "2")])
+        self.assertEqual(check_status_file.get_history_status(self.history_file, 25, 49,
+            history_records=100, flap_window_hours=24, flap_threshold=4),
+            (2, "CRITICAL - Wrong status code in file '{}': wrong_status".format(self.history_file)))
+
+
+@mock.patch("check_status_file.get_timedelta_from_now")
+class items_mode_FunctionalTests(unittest.TestCase):
+    """Functional tests for multi-item (JSON) status files"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.items_file = os.path.join(self.test_dir, "items")
+        with open(self.items_file, "w") as f:
+            json.dump({
+                "timestamp": "2017-05-30T11:12:05+02:00",
+                "items": {
+                    "job1": {"status": "OK", "text": "done; 10 files", "perfdata": "files=10;;;0 'run time'=5s"},
+                    "job2": {"status": "warning", "text": "slow", "timestamp": "2017-05-30T10:00:00+02:00"},
+                    "job3": {"status": "wrong_status", "text": "description"},
+                    "job4": {"text": "no status"}
+                }
+            }, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_read_status_data(self, get_timedelta_from_now_mock):
+        """Should parse every item once"""
+        items = check_status_file.read_status_data(self.items_file)
+        self.assertEqual(sorted(items), ["job1", "job2", "job3", "job4"])
+        self.assertEqual(items["job1"][0], "2017-05-30T11:12:05+02:00")
+        self.assertEqual(items["job1"][2:], (0, "done; 10 files", "files=10;;;0 'run time'=5s"))
+        self.assertEqual(items["job2"][0], "2017-05-30T10:00:00+02:00")
+        self.assertEqual(items["job2"][2:], (1, "slow", ""))
+        self.assertEqual(str(items["job3"]),
+            "Item 'job3': Wrong status code in file '{}': wrong_status".format(self.items_file))
+        self.assertEqual(str(items["job4"]), "Item 'job4': Wrong status data in '{}'".format(self.items_file))
+
+    def test_get_file_status(self, get_timedelta_from_now_mock):
+        """Should return worst-of aggregate or a single item status"""
+        get_timedelta_from_now_mock.return_value = 3600
+
+        status_code, status_text = check_status_file.get_file_status(self.items_file, 10, 20)
+        self.assertEqual(status_code, 2)
+        self.assertEqual(status_text.splitlines(), [
+            "CRITICAL - 4 item(s): 2 critical, 1 warning, 0 unknown, 1 ok | 'job1 files'=10;;;0 'job1 run time'=5s",
+            "job2: WARNING - slow [2017-05-30T10:00:00+02:00, 1.00 hour(s) ago]",
+            "job3: CRITICAL - Item 'job3': Wrong status code in file '{}': wrong_status".format(self.items_file),
+            "job4: CRITICAL - Item 'job4': Wrong status data in '{}'".format(self.items_file),
+        ])
+
+        self.assertEqual(check_status_file.get_file_status(self.items_file, 10, 20, "job1"),
+            (0, "OK - done; 10 files [2017-05-30T11:12:05+02:00, 1.00 hour(s) ago] | files=10;;;0 'run time'=5s"))
+        self.assertEqual(check_status_file.get_file_status(self.items_file, 10, 20, "job5"),
+            (2, "CRITICAL - Item 'job5' not found"))
+
+        with open(self.items_file, "w") as f:
+            f.write('{"items": []}')
+        self.assertEqual(check_status_file.get_file_status(self.items_file, 10, 20),
+            (2, "CRITICAL - Wrong status data in '{}'".format(self.items_file)))
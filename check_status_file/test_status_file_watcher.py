@@ -0,0 +1,169 @@
+import os
+import mock
+import unittest
+import datetime
+import threading
+import time
+import tempfile
+import shutil
+import json
+import socket
+import dateutil.tz
+
+import check_status_file
+import status_file_watcher
+
+
+class StatusFileCache_FunctionalTests(unittest.TestCase):
+    """Functional tests for 'StatusFileCache' class"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.inotify = status_file_watcher.Inotify()
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.test_dir)
+
+    def write_status_file(self, f_name, status, description):
+        timestamp = datetime.datetime.now(dateutil.tz.tzlocal()).replace(microsecond=0).isoformat()
+        with open(os.path.join(self.test_dir, f_name), "w") as f:
+            f.write("{};{};{}\n".format(timestamp, status, description))
+        return(os.path.join(self.test_dir, f_name))
+
+    def test_reloads_changed_files_only(self):
+        """Should re-read a file only after it has been changed"""
+        cache = status_file_watcher.StatusFileCache(self.inotify)
+        f1 = self.write_status_file("status1", "OK", "first")
+        f2 = self.write_status_file("status2", "OK", "second")
+        self.assertEqual(cache.get_status_data(f1)[3], "first")
+        self.assertEqual(cache.get_status_data(f2)[3], "second")
+
+        with mock.patch("check_status_file.read_status_data",
+                wraps=check_status_file.read_status_data) as read_status_data_mock:
+            # Nothing has changed, no file reads
+            cache.process_events()
+            self.assertEqual(cache.get_status_data(f1)[3], "first")
+            read_status_data_mock.assert_not_called()
+
+            self.write_status_file("status1", "WARNING", "changed")
+            cache.process_events()
+            read_status_data_mock.assert_called_once_with(f1)
+            self.assertEqual(cache.get_status_data(f1)[3], "changed")
+
+            os.remove(f2)
+            cache.process_events()
+            self.assertEqual(str(cache.get_status_data(f2)),
+                "status file '{}' does not exist".format(f2))
+
+            self.write_status_file("status2", "OK", "recreated")
+            cache.process_events()
+            self.assertEqual(cache.get_status_data(f2)[3], "recreated")
+
+    def test_polling(self):
+        """Should detect changes by file signature when inotify is not available"""
+        cache = status_file_watcher.StatusFileCache(None)
+        f1 = self.write_status_file("status1", "OK", "first")
+        self.assertEqual(cache.get_status_data(f1)[3], "first")
+        with open(f1, "w") as f:
+            f.write("wrong_data\n")
+        cache.poll_changes()
+        self.assertEqual(str(cache.get_status_data(f1)), "Wrong status data in '{}'".format(f1))
+
+    def test_query(self):
+        """Should return the same results as check_file() through a socket"""
+        f1 = self.write_status_file("status1", "WARNING", "description")
+        socket_path = os.path.join(self.test_dir, "sockets", "watcher.sock")
+        server_socket = status_file_watcher.create_server_socket(socket_path)
+        cache = status_file_watcher.StatusFileCache(self.inotify)
+        server_thread = threading.Thread(target=status_file_watcher.serve,
+            args=(server_socket, cache, 30), daemon=True)
+        server_thread.start()
+
+        missing_file = os.path.join(self.test_dir, "missing")
+        results = check_status_file.query_watcher(socket_path, [f1, missing_file], 25, 49)
+        self.assertEqual(results, [
+            (f1, 1, check_status_file.get_file_status(f1, 25, 49)[1]),
+            (missing_file, 2, "CRITICAL - status file '{}' does not exist".format(missing_file)),
+        ])
+
+    def test_eviction(self):
+        """Should keep at most max_files files, evicting least recently queried ones"""
+        cache = status_file_watcher.StatusFileCache(self.inotify, max_files=2)
+        f1 = self.write_status_file("status1", "OK", "first")
+        f2 = self.write_status_file("status2", "OK", "second")
+        f3 = self.write_status_file("status3", "OK", "third")
+        cache.get_status_data(f1)
+        cache.get_status_data(f2)
+        cache.get_status_data(f1)
+        cache.get_status_data(f3)
+        self.assertEqual(list(cache.files), [f1, f3])
+        self.assertEqual(cache.directories[self.test_dir], set([f1, f3]))
+        # Evicted file is read again on the next query
+        self.assertEqual(cache.get_status_data(f2)[3], "second")
+
+    def test_eviction_unwatch(self):
+        """Should remove the watch of a directory whose files have all been evicted"""
+        cache = status_file_watcher.StatusFileCache(self.inotify, max_files=1)
+        f1 = self.write_status_file("status1", "OK", "first")
+        other_dir = os.path.join(self.test_dir, "other")
+        os.mkdir(other_dir)
+        f2 = os.path.join(other_dir, "status2")
+        shutil.copy(f1, f2)
+        cache.get_status_data(f1)
+        with mock.patch.object(self.inotify, "rm_watch", wraps=self.inotify.rm_watch) as rm_watch_mock:
+            cache.get_status_data(f2)
+        self.assertEqual(list(cache.directories), [other_dir])
+        self.assertEqual(list(cache.watch_descriptors.values()), [other_dir])
+        rm_watch_mock.assert_called_once()
+        # Removed watch sends IN_IGNORED, it doesn't affect the other directory
+        time.sleep(0.1)
+        cache.process_events()
+        self.assertEqual(list(cache.files), [f2])
+        # Directory is watched again on the next query of its file
+        self.assertEqual(cache.get_status_data(f1)[3], "first")
+        self.assertEqual(sorted(cache.watch_descriptors.values()), [self.test_dir])
+
+    def test_stalled_client(self):
+        """Should answer other clients while a client hasn't sent its request"""
+        f1 = self.write_status_file("status1", "OK", "description")
+        socket_path = os.path.join(self.test_dir, "sockets", "watcher.sock")
+        server_socket = status_file_watcher.create_server_socket(socket_path)
+        cache = status_file_watcher.StatusFileCache(self.inotify)
+        threading.Thread(target=status_file_watcher.serve,
+            args=(server_socket, cache, 30), daemon=True).start()
+
+        stalled_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled_socket.connect(socket_path)
+        try:
+            stalled_socket.sendall(b'{"files": [')
+            started = time.monotonic()
+            results = check_status_file.query_watcher(socket_path, [f1], 25, 49)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(results[0][1], check_status_file.STATUS_OK)
+        finally:
+            stalled_socket.close()
+
+    def test_incomplete_reply(self):
+        """Should read files directly if watcher reply doesn't match the request"""
+        f1 = self.write_status_file("status1", "OK", "first")
+        self.write_status_file("status2", "WARNING", "second")
+        socket_path = os.path.join(self.test_dir, ".sockets", "watcher.sock")
+        server_socket = status_file_watcher.create_server_socket(socket_path)
+        server_socket.setblocking(True)
+
+        def serve_incomplete_replies():
+            # Replies with the first file only
+            while True:
+                client_socket, _ = server_socket.accept()
+                with client_socket:
+                    client_socket.recv(65536)
+                    client_socket.sendall(json.dumps({"results": [[f1, 0, "OK - first"]]}).encode("utf-8") + b"\n")
+
+        threading.Thread(target=serve_incomplete_replies, daemon=True).start()
+        with self.assertRaises(Exception):
+            check_status_file.query_watcher(socket_path, [f1, os.path.join(self.test_dir, "status2")], 25, 49)
+        with mock.patch("check_status_file.print_stdout") as print_stdout_mock:
+            exit_code = check_status_file.main(["-d", self.test_dir, "-s", socket_path, "-o", "lines"])
+        self.assertEqual(exit_code, check_status_file.STATUS_WARNING)
+        self.assertEqual(print_stdout_mock.call_count, 2)
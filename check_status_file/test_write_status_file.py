@@ -0,0 +1,94 @@
+import os
+import mock
+import unittest
+import threading
+import tempfile
+import shutil
+
+import check_status_file
+import write_status_file
+
+
+class write_status_FunctionalTests(unittest.TestCase):
+    """Functional tests for status file writer"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.status_file = os.path.join(self.test_dir, "status")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_format_status_line(self):
+        """Should produce lines that check_status_file parses on the fast path"""
+        line = write_status_file.format_status_line("warning", "description")
+        self.assertTrue(line.endswith(";WARNING;description\n"))
+        with mock.patch("dateutil.parser.parse") as parse_mock:
+            status_data = check_status_file.parse_status_line("file_name", line)
+            parse_mock.assert_not_called()
+        self.assertEqual(status_data[2:], (1, "description"))
+        self.assertIsNotNone(status_data[1].tzinfo)
+
+        self.assertRaises(ValueError, write_status_file.format_status_line, "wrong_status", "description")
+        self.assertRaises(ValueError, write_status_file.format_status_line, "OK", "text;with;semicolons")
+        self.assertRaises(ValueError, write_status_file.format_status_line, "OK", "two\nlines")
+
+    def test_write_status(self):
+        """Should replace status file without leaving temporary files"""
+        write_status_file.write_status(self.status_file, "ERROR", "first")
+        write_status_file.write_status(self.status_file, "OK", "second", fsync=write_status_file.FSYNC_FULL)
+        self.assertEqual(check_status_file.get_file_status(self.status_file, 1, 2)[0], 0)
+        self.assertEqual(os.listdir(self.test_dir), ["status"])
+
+        # Append mode
+        write_status_file.write_status(self.status_file, "WARNING", "third", append=True)
+        self.assertEqual(check_status_file.read_last_lines(self.status_file, 10)[1][-len(";WARNING;third"):],
+            ";WARNING;third")
+
+        # Nothing is written if any of the statuses is invalid
+        other_file = os.path.join(self.test_dir, "other")
+        self.assertRaises(ValueError, write_status_file.write_statuses,
+            [(other_file, "OK", "text"), (self.status_file, "wrong_status", "text")])
+        self.assertFalse(os.path.exists(other_file))
+
+    def test_write_statuses(self):
+        """Should write many files with the same timestamp"""
+        file_names = [os.path.join(self.test_dir, "status{}".format(i)) for i in range(10)]
+        write_status_file.write_statuses([(f_name, "OK", "text") for f_name in file_names],
+            fsync=write_status_file.FSYNC_FULL)
+        timestamps = set(check_status_file.read_status_data(f_name)[0] for f_name in file_names)
+        self.assertEqual(len(timestamps), 1)
+
+    def test_concurrent_writers(self):
+        """Should never expose a partially written file to readers"""
+        write_status_file.write_status(self.status_file, "OK", "initial")
+
+        def writer(writer_id):
+            for i in range(200):
+                write_status_file.write_status(self.status_file, "OK", "writer {} " .format(writer_id) + "x" * i)
+
+        writers = [threading.Thread(target=writer, args=(i,)) for i in range(4)]
+        for thread in writers:
+            thread.start()
+        while any(thread.is_alive() for thread in writers):
+            status_data = check_status_file.read_status_data(self.status_file)
+            self.assertEqual(status_data[2], 0)
+        for thread in writers:
+            thread.join()
+        self.assertEqual(os.listdir(self.test_dir), ["status"])
+
+    def test_main(self):
+        """Should read batch updates from a file"""
+        batch_file = os.path.join(self.test_dir, "batch")
+        with open(batch_file, "w") as f:
+            f.write("{};OK;text; with semicolon\n\n".format(self.status_file))
+        with mock.patch("sys.stdout"):
+            self.assertEqual(write_status_file.main(mock.Mock(batch_file=batch_file,
+                fsync="none", append=False)), 1)
+        self.assertFalse(os.path.exists(self.status_file))
+
+        with open(batch_file, "w") as f:
+            f.write("{0}1;OK;text1\n{0}2;critical;text2\n".format(self.status_file))
+        self.assertEqual(write_status_file.main(mock.Mock(batch_file=batch_file,
+            fsync="file", append=False)), 0)
+        self.assertEqual(check_status_file.read_status_data(self.status_file + "2")[2:], (2, "text2"))
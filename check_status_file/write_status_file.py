@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Writes status files in the format check_status_file.py reads. A file is written
+# to a temporary file in the same directory and then renamed, so readers never see
+# a truncated or half-written file, and concurrent writers don't corrupt it (the last
+# one wins). History files (check_status_file.py --history) are appended to with a
+# single write() call instead.
+#
+# As a library:
+#   import write_status_file
+#   write_status_file.write_status("/var/lib/nagios/status/backup", "OK", "Backup has finished")
+#   write_status_file.write_statuses([(file1, "OK", "text1"), (file2, "ERROR", "text2")])
+#
+# As a command:
+#   write_status_file.py /var/lib/nagios/status/backup OK "Backup has finished"
+#   printf '%s\n' "/path/file1;OK;text1" "/path/file2;ERROR;text2" | write_status_file.py -b -
+
+import os
+import sys
+import argparse
+import datetime
+
+import check_status_file
+
+# fsync policies
+FSYNC_NONE = "none"  # rely on the OS to flush data (survives process crash, not power loss)
+FSYNC_FILE = "file"  # flush file contents before it is renamed into place
+FSYNC_FULL = "full"  # flush file contents and directory entries
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_FULL)
+
+
+def format_timestamp(timestamp=None):
+    # Local time with UTC offset and without microseconds, same as 'date -Iseconds'
+    # output. check_status_file.py parses it without dateutil
+    if timestamp is None:
+        timestamp = datetime.datetime.now().astimezone()
+    return timestamp.replace(microsecond=0).isoformat()
+
+
+def format_status_line(status, text, timestamp=None):
+    if status.upper() not in check_status_file.STATUS_CODES:
+        raise ValueError(
+            f"Invalid status '{status}', expected one of: {', '.join(check_status_file.STATUS_CODES)}"
+        )
+    if (";" in text) or ("\n" in text) or ("\r" in text):
+        raise ValueError("Status text can't contain semicolons or line breaks")
+    if not isinstance(timestamp, str):
+        timestamp = format_timestamp(timestamp)
+    return f"{timestamp};{status.upper()};{text}\n"
+
+
+def fsync_directory(directory):
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_file_atomically(file_name, data, fsync=FSYNC_NONE):
+    # Temporary file is hidden, so it is skipped by check_status_file.py directory
+    # mode and status_file_watcher.py. Name is unique per writer
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    temp_file_name = os.path.join(directory, f".{base_name}.{os.getpid()}.{os.urandom(4).hex()}.tmp")
+    # 0o666 with umask applied, same permissions as shell redirection would give
+    fd = os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        try:
+            os.write(fd, data)
+            if fsync != FSYNC_NONE:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        try:
+            os.unlink(temp_file_name)
+        except OSError:
+            pass
+        raise
+
+
+def append_to_file(file_name, data, fsync=FSYNC_NONE):
+    # Single write() with O_APPEND: concurrent appenders don't interleave short lines
+    fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(fd, data)
+        if fsync != FSYNC_NONE:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_statuses(updates, fsync=FSYNC_NONE, append=False, timestamp=None):
+    # updates: iterable of (file name, status, text). All status lines are validated
+    # before anything is written and get the same timestamp. With FSYNC_FULL every
+    # directory is synced once after all files are written
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(f"Invalid fsync policy '{fsync}', expected one of: {', '.join(FSYNC_POLICIES)}")
+    if not isinstance(timestamp, str):
+        timestamp = format_timestamp(timestamp)
+    lines = [
+        (file_name, format_status_line(status, text, timestamp).encode("utf-8"))
+        for file_name, status, text in updates
+    ]
+
+    directories = set()
+    for file_name, line in lines:
+        if append:
+            append_to_file(file_name, line, fsync)
+        else:
+            write_file_atomically(file_name, line, fsync)
+        directories.add(os.path.dirname(os.path.abspath(file_name)))
+    if fsync == FSYNC_FULL:
+        for directory in directories:
+            fsync_directory(directory)
+
+
+def write_status(file_name, status, text, timestamp=None, fsync=FSYNC_NONE, append=False):
+    write_statuses([(file_name, status, text)], fsync=fsync, append=append, timestamp=timestamp)
+
+
+def read_batch(batch_f):
+    # One "<file name>;<status>;<text>" line per file, empty lines are ignored
+    updates = []
+    for line in batch_f:
+        line = line.rstrip("\r\n")
+        if line.strip():
+            fields = line.split(";", 2)
+            if len(fields) != 3:
+                raise ValueError(f"Invalid batch line: {line}")
+            updates.append(tuple(fields))
+    return updates
+
+
+def main(args):
+    try:
+        if args.batch_file:
+            if args.batch_file == "-":
+                updates = read_batch(sys.stdin)
+            else:
+                with open(args.batch_file) as batch_f:
+                    updates = read_batch(batch_f)
+        else:
+            if (args.status_file_name is None) or (args.status is None) or (args.text is None):
+                print("Error: status file name, status and text are required")
+                return 1
+            updates = [(args.status_file_name, args.status, args.text)]
+        write_statuses(updates, fsync=args.fsync, append=args.append)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write status files for check_status_file.py")
+    parser.add_argument("status_file_name", nargs="?", help="Status file to write")
+    parser.add_argument("status", nargs="?", help="Status: OK, WARNING, ERROR or CRITICAL")
+    parser.add_argument("text", nargs="?", help="Status text")
+    parser.add_argument(
+        "-b", "--batch", dest="batch_file", default=None,
+        help="Write many files, reading '<file name>;<status>;<text>' lines from a file ('-' for stdin)",
+    )
+    parser.add_argument(
+        "-a", "--append", dest="append", action="store_true", default=False,
+        help="Append to a history file instead of replacing the file",
+    )
+    parser.add_argument(
+        "-f", "--fsync", dest="fsync", default=FSYNC_NONE, choices=FSYNC_POLICIES,
+        help="fsync policy (default: %(default)s)",
+    )
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,274 @@
+import os
+import mock
+import unittest
+import tempfile
+import shutil
+import types
+import io
+import contextlib
+
+import unattended_upgrades
+
+AUTO_UPGRADES = (
+    'APT::Periodic::Update-Package-Lists "1";\n'
+    'APT::Periodic::Unattended-Upgrade "1";\n'
+)
+UNATTENDED_UPGRADES = (
+    '// Automatically upgrade packages from these (origin:archive) pairs\n'
+    'Unattended-Upgrade::Allowed-Origins {\n'
+    '        "${distro_id}:${distro_codename}";\n'
+    '        "${distro_id}:${distro_codename}-security";\n'
+    '        "${distro_id}:${distro_codename}-updates";\n'
+    '//      "${distro_id}:${distro_codename}-proposed";\n'
+    '};\n'
+)
+PERIODIC = (
+    'APT {\n'
+    '    Periodic {\n'
+    '        Download-Upgradeable-Packages "1";\n'
+    '        AutocleanInterval "7"; /* weekly */\n'
+    '    };\n'
+    '};\n'
+)
+
+
+def parse(text):
+    config = {}
+    unattended_upgrades.parse_apt_config(text, config)
+    return config
+
+
+class parse_apt_config_FunctionalTests(unittest.TestCase):
+    """Functional tests for 'parse_apt_config' function"""
+
+    def test_values(self):
+        """Should read values with full keys and scopes, skipping comments"""
+        config = parse(AUTO_UPGRADES + UNATTENDED_UPGRADES + PERIODIC)
+        self.assertEqual(config, {
+            'apt::periodic::update-package-lists': '1',
+            'apt::periodic::unattended-upgrade': '1',
+            'apt::periodic::download-upgradeable-packages': '1',
+            'apt::periodic::autocleaninterval': '7',
+            'unattended-upgrade::allowed-origins': [
+                '${distro_id}:${distro_codename}',
+                '${distro_id}:${distro_codename}-security',
+                '${distro_id}:${distro_codename}-updates',
+            ],
+        })
+
+    def test_comments(self):
+        """Should ignore commented out settings"""
+        config = parse(
+            '// APT::Periodic::Unattended-Upgrade "1";\n'
+            '/* APT::Periodic::Update-Package-Lists "1";\n'
+            '   APT::Periodic::AutocleanInterval "7"; */\n'
+            '# APT::Periodic::Download-Upgradeable-Packages "1";\n'
+            'Acquire::http::Proxy "http://proxy.example.com:3128/"; // proxy\n'
+        )
+        self.assertEqual(config, {'acquire::http::proxy': 'http://proxy.example.com:3128/'})
+
+    def test_override(self):
+        """Should keep the last value of a key, keys are case insensitive"""
+        config = parse(
+            'APT::Periodic::Unattended-Upgrade "1";\n'
+            'APT { Periodic { Unattended-Upgrade "0"; }; };\n'
+            'apt::periodic::unattended-upgrade "3";\n'
+        )
+        self.assertEqual(config, {'apt::periodic::unattended-upgrade': '3'})
+
+    def test_clear(self):
+        """Should remove a key and its subkeys on #clear"""
+        config = parse(UNATTENDED_UPGRADES + AUTO_UPGRADES + (
+            '#clear Unattended-Upgrade::Allowed-Origins;\n'
+            '#clear APT::Periodic;\n'
+            'Unattended-Upgrade::Allowed-Origins { "${distro_id}:${distro_codename}-security"; };\n'
+        ))
+        self.assertEqual(config, {
+            'unattended-upgrade::allowed-origins': ['${distro_id}:${distro_codename}-security'],
+        })
+
+    def test_include(self):
+        """Should read #include files relative to the including file"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(temp_dir, 'periodic.inc'), 'w') as f:
+                f.write(PERIODIC)
+            config = {}
+            unattended_upgrades.parse_apt_config(
+                '#include "periodic.inc";\nAPT::Periodic::AutocleanInterval "14";\n', config, temp_dir
+            )
+            self.assertEqual(config, {
+                'apt::periodic::download-upgradeable-packages': '1',
+                'apt::periodic::autocleaninterval': '14',
+            })
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_list_append(self):
+        """Should append values of keys ending in '::' to the key's list"""
+        config = parse(UNATTENDED_UPGRADES + (
+            'Unattended-Upgrade::Allowed-Origins:: "${distro_id}ESMApps:${distro_codename}-apps-security";\n'
+            'Unattended-Upgrade { Package-Blacklist:: "vim"; Package-Blacklist:: "libc6"; };\n'
+        ))
+        self.assertEqual(config['unattended-upgrade::allowed-origins'], [
+            '${distro_id}:${distro_codename}',
+            '${distro_id}:${distro_codename}-security',
+            '${distro_id}:${distro_codename}-updates',
+            '${distro_id}ESMApps:${distro_codename}-apps-security',
+        ])
+        self.assertEqual(config['unattended-upgrade::package-blacklist'], ['vim', 'libc6'])
+        self.assertNotIn('unattended-upgrade::allowed-origins::', config)
+
+    def test_recursive_include(self):
+        """Should not read a file again while it is being included"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(temp_dir, 'self.inc'), 'w') as f:
+                f.write('APT::Periodic::AutocleanInterval "7";\n#include "other.inc";\n')
+            with open(os.path.join(temp_dir, 'other.inc'), 'w') as f:
+                f.write('Unattended-Upgrade::Allowed-Origins:: "a";\n#include "self.inc";\n')
+            config = {}
+            unattended_upgrades.read_apt_config_file(os.path.join(temp_dir, 'self.inc'), config)
+            self.assertEqual(config, {
+                'apt::periodic::autocleaninterval': '7',
+                'unattended-upgrade::allowed-origins': ['a'],
+            })
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class read_apt_config_FunctionalTests(unittest.TestCase):
+    """Functional tests for 'read_apt_config' function"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.parts_dir = os.path.join(self.temp_dir, 'apt.conf.d')
+        os.mkdir(self.parts_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, file_name, contents):
+        with open(os.path.join(self.temp_dir, file_name), 'w') as f:
+            f.write(contents)
+
+    def test_part_order(self):
+        """Should read parts in alphanumeric order and apt.conf after them"""
+        self.write_file('apt.conf.d/20auto-upgrades', 'APT::Periodic::Unattended-Upgrade "1";\n')
+        self.write_file('apt.conf.d/10periodic', 'APT::Periodic::Unattended-Upgrade "0";\n')
+        self.write_file('apt.conf.d/99local.conf', 'APT::Periodic::Update-Package-Lists "2";\n')
+        self.assertEqual(unattended_upgrades.read_apt_config(self.parts_dir), {
+            'apt::periodic::unattended-upgrade': '1',
+            'apt::periodic::update-package-lists': '2',
+        })
+
+        self.write_file('apt.conf', 'APT::Periodic::Update-Package-Lists "3";\n')
+        self.assertEqual(
+            unattended_upgrades.read_apt_config(self.parts_dir)['apt::periodic::update-package-lists'], '3'
+        )
+
+    def test_ignored_parts(self):
+        """Should ignore parts APT ignores: backups, other extensions, invalid names"""
+        self.write_file('apt.conf.d/20auto-upgrades', 'APT::Periodic::Unattended-Upgrade "1";\n')
+        for part_name in ('20auto-upgrades.dpkg-old', '20auto-upgrades~', '20auto-upgrades.bak', 'local conf'):
+            self.write_file(os.path.join('apt.conf.d', part_name), 'APT::Periodic::Unattended-Upgrade "0";\n')
+        os.mkdir(os.path.join(self.parts_dir, '30dir'))
+        self.assertEqual(unattended_upgrades.read_apt_config(self.parts_dir), {
+            'apt::periodic::unattended-upgrade': '1',
+        })
+
+    def test_no_directory(self):
+        """Should return empty configuration if there is no parts directory"""
+        self.assertEqual(unattended_upgrades.read_apt_config(os.path.join(self.temp_dir, 'missing')), {})
+
+
+class main_FunctionalTests(unittest.TestCase):
+    """Functional tests for 'main' function"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.parts_dir = os.path.join(self.temp_dir, 'apt.conf.d')
+        os.mkdir(self.parts_dir)
+        self.write_part('20auto-upgrades', AUTO_UPGRADES)
+        self.write_part('50unattended-upgrades', UNATTENDED_UPGRADES)
+        self.write_part('60periodic', PERIODIC)
+        self.options = types.SimpleNamespace(config_file='', config_dir=self.parts_dir)
+
+        patcher = mock.patch('unattended_upgrades.package_installed', return_value=True)
+        self.package_installed_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('unattended_upgrades.REBOOT_REQUIRED_FILE', os.path.join(self.temp_dir, 'reboot-required'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_part(self, part_name, contents):
+        with open(os.path.join(self.parts_dir, part_name), 'w') as f:
+            f.write(contents)
+
+    def run_main(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            exit_code = unattended_upgrades.main(self.options)
+        return exit_code, output.getvalue().strip()
+
+    def test_ok(self):
+        """Should return OK with unattended upgrade period when everything is configured"""
+        self.assertEqual(self.run_main(), (unattended_upgrades.OK, 'OK - unattended_upgrades runs every 1 days'))
+
+    def test_reboot_required(self):
+        """Should return WARNING when reboot is required"""
+        with open(unattended_upgrades.REBOOT_REQUIRED_FILE, 'w'):
+            pass
+        self.assertEqual(self.run_main(), (unattended_upgrades.WARNING, 'WARNING - Server requires a reboot'))
+
+    def test_not_installed(self):
+        """Should return CRITICAL when the package is not installed"""
+        self.package_installed_mock.return_value = False
+        self.assertEqual(self.run_main()[0], unattended_upgrades.CRITICAL)
+
+    def test_origins(self):
+        """Should check allowed origins in the merged configuration"""
+        self.write_part('90local', '#clear Unattended-Upgrade::Allowed-Origins;\n')
+        self.assertEqual(self.run_main(), (
+            unattended_upgrades.CRITICAL,
+            "CRITICAL - 'unattended-upgrades' is not configured to install security updates",
+        ))
+
+        self.write_part('90local', (
+            '#clear Unattended-Upgrade::Allowed-Origins;\n'
+            'Unattended-Upgrade::Allowed-Origins { "${distro_id}:${distro_codename}-security"; };\n'
+        ))
+        self.assertEqual(self.run_main(), (
+            unattended_upgrades.WARNING,
+            "WARNING - 'unattended-upgrades' is not configured to install recommended updates",
+        ))
+
+    def test_overridden_period(self):
+        """Should use the value from the part that is read last"""
+        self.write_part('10periodic', 'APT::Periodic::Unattended-Upgrade "5";\n')
+        self.write_part('99local', 'APT::Periodic::Unattended-Upgrade "3";\n')
+        self.assertEqual(self.run_main(), (unattended_upgrades.OK, 'OK - unattended_upgrades runs every 3 days'))
+
+        self.write_part('99local', 'APT::Periodic::Unattended-Upgrade "0";\n')
+        self.assertEqual(self.run_main(), (
+            unattended_upgrades.CRITICAL,
+            'CRITICAL - In {}: APT::Periodic::Unattended-Upgrade is set to 0'.format(self.parts_dir),
+        ))
+
+    def test_config_file(self):
+        """Should check a single file instead of the directory with --config-file"""
+        config_file_name = os.path.join(self.temp_dir, 'custom.conf')
+        with open(config_file_name, 'w') as f:
+            f.write(UNATTENDED_UPGRADES + AUTO_UPGRADES)
+        self.options.config_file = config_file_name
+        self.assertEqual(self.run_main(), (
+            unattended_upgrades.CRITICAL,
+            'CRITICAL - In {}: APT::Periodic::Download-Upgradeable-Packages is set to None'.format(config_file_name),
+        ))
+
+        with open(config_file_name, 'a') as f:
+            f.write(PERIODIC)
+        self.assertEqual(self.run_main(), (unattended_upgrades.OK, 'OK - unattended_upgrades runs every 1 days'))
@@ -9,6 +9,38 @@ WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+APT_CONFIG_PARTS_DIR = '/etc/apt/apt.conf.d'
+REBOOT_REQUIRED_FILE = '/var/run/reboot-required'
+
+# apt.conf(5): parts are read in alphanumeric order, files with other characters
+# in the name or an extension other than .conf are ignored
+APT_CONFIG_PART_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+# One match per statement: comment, #clear/#include directive (or a '#' comment),
+# 'Key "value";' (or unquoted value), 'Key {', list item '"value";' or '}'.
+# Anything else (e.g. stray ';') is skipped.
+APT_CONFIG_STATEMENT_RE = re.compile(
+    r'(//[^\n]*|/\*.*?\*/)'
+    r'|(#[^\n]*)'
+    r'|([^\s{};"]+)\s+(?:"([^"]*)"|([^\s{};"]+))\s*;'
+    r'|([^\s{};"]+)\s*\{'
+    r'|"([^"]*)"\s*;'
+    r'|(\})',
+    re.DOTALL,
+)
+
+ALLOWED_ORIGINS_KEY = 'Unattended-Upgrade::Allowed-Origins'
+SECURITY_ORIGIN = '${distro_id}:${distro_codename}-security'
+UPDATES_ORIGIN = '${distro_id}:${distro_codename}-updates'
+PERIODIC_KEYS = [
+    # Make sure this one is first
+    'APT::Periodic::Unattended-Upgrade',
+    #
+    'APT::Periodic::Update-Package-Lists',
+    'APT::Periodic::Download-Upgradeable-Packages',
+    'APT::Periodic::AutocleanInterval',
+]
+
+
 def package_installed(package_name):
     """ @since: 2014-08-04
         @author: Jivan
@@ -22,117 +54,165 @@ def package_installed(package_name):
     return ret
 
 
-def config_file_contains(config_filename, content_regex):
-    """ @since: 2014-08-04
-        @author: Jivan
-        @return: True if \a content_regex matches content in \a config_filename.
-    """
-    # config file object
-    cf = open(config_filename, 'r')
-    # file contents
-    fc = cf.read()
-    # search match
-    sm = re.search(content_regex, fc, flags=re.MULTILINE)
-    ret = bool(sm)
-    return ret
+def append_apt_config_value(config, key, value):
+    values = config.get(key)
+    if not isinstance(values, list):
+        values = config[key] = []
+    values.append(value)
 
 
-def get_config_value(config_filename, config_value_regex):
+def parse_apt_config(text, config, base_dir=None, including=()):
     """
-        @since: 2014-08-06
-        @author: Jivan
-        @return: The value of the config variable described by \a config_value_regex.
-        @param config_value_regex: a regular expression which will match the config variable
-            and it's value as the first group.
-            Example: if a config variable looks like 'mysetting: <n>' config_value_regex would
-                be 'mysetting: (\d+)'
+        Single pass over APT configuration text (apt.conf(5) syntax), results are merged
+        into \a config: {lower case full key: value}. A later value of a key overrides an
+        earlier one, values listed in a scope without a key ('Key { "a"; "b"; };') or set
+        with a key ending in '::' ('Key:: "a";') are appended to the key's list. #clear and
+        #include directives are supported, \a including: real paths of the files whose
+        #include is being read, a file that includes itself is not read again.
     """
-    # config file object
-    cf = open(config_filename, 'r')
-    # file contents
-    fc = cf.read()
-    # search match
-    sm = re.search(config_value_regex, fc, flags=re.MULTILINE)
-    if not sm or len(sm.groups()) != 1:
-        ret = None
-    else:
-        ret = sm.group(1)
-    return ret
-
-
-try:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--config-file", dest="config_file", default="",
-        help='Custom config file')
-    options = parser.parse_args()
-
-    # --- Check that 'unattended-upgrades' is installed.
-    if not package_installed('unattended-upgrades'):
-        print("CRITICAL - Package 'unattended-upgrades' not installed")
-        sys.exit(CRITICAL)
-
-    # --- /etc/apt/apt.conf.d/50unattended-upgrades checks
+    # Full key prefixes ('apt::periodic::') of the open scopes
+    scopes = ['']
+    for comment, directive, key, value, bare_value, scope, item, close in APT_CONFIG_STATEMENT_RE.findall(text):
+        if comment:
+            continue
+        if key.endswith('::'):
+            append_apt_config_value(config, scopes[-1] + key[:-2].lower(), bare_value or value)
+        elif key:
+            config[scopes[-1] + key.lower()] = bare_value or value
+        elif scope:
+            scopes.append(scopes[-1] + scope.lower() + '::')
+        elif close:
+            if len(scopes) > 1:
+                scopes.pop()
+        elif directive:
+            directive = directive.split()
+            if directive[0] == '#clear':
+                for key in directive[1:]:
+                    clear_apt_config_key(config, key.rstrip(';'))
+            elif (directive[0] == '#include') and (len(directive) > 1):
+                include_file_name = directive[1].rstrip(';').strip('"')
+                if base_dir is not None:
+                    include_file_name = os.path.join(base_dir, include_file_name)
+                read_apt_config_file(include_file_name, config, including)
+        elif len(scopes) > 1:
+            # List item, the value of the scope key
+            append_apt_config_value(config, scopes[-1][:-2], item)
+
+
+def clear_apt_config_key(config, key):
+    key = key.lower()
+    for config_key in list(config):
+        if (config_key == key) or config_key.startswith(key + '::'):
+            del config[config_key]
+
+
+def read_apt_config_file(config_filename, config, including=()):
+    real_filename = os.path.realpath(config_filename)
+    if real_filename in including:
+        return
+    with open(config_filename, 'r') as cf:
+        parse_apt_config(cf.read(), config, os.path.dirname(config_filename), including + (real_filename,))
+
+
+def read_apt_config(parts_dir=APT_CONFIG_PARTS_DIR):
+    """
+        @return: merged configuration of every file in \a parts_dir and of apt.conf next
+            to it (/etc/apt/apt.conf), in the order APT reads them. Each file is read once.
+    """
+    main_file = os.path.join(os.path.dirname(os.path.abspath(parts_dir)), 'apt.conf')
+    config = {}
+    if os.path.isdir(parts_dir):
+        for part_name in sorted(os.listdir(parts_dir)):
+            extension = os.path.splitext(part_name)[1]
+            if not APT_CONFIG_PART_NAME_RE.match(part_name) or extension not in ('', '.conf'):
+                continue
+            part_filename = os.path.join(parts_dir, part_name)
+            if os.path.isfile(part_filename):
+                read_apt_config_file(part_filename, config)
+    if os.path.isfile(main_file):
+        read_apt_config_file(main_file, config)
+    return config
+
+
+def get_config_value(config, key):
+    return config.get(key.lower())
+
+
+def check_config(config, config_source):
+    """
+        @return: (exit code, message) of configuration checks, (OK, unattended upgrade
+            period) if every check has passed.
+    """
+    allowed_origins = get_config_value(config, ALLOWED_ORIGINS_KEY)
+    if not isinstance(allowed_origins, list):
+        allowed_origins = []
 
     # --- Check that unattended-upgrades is configured to install security updates.
-    # '^\s*' Ensures that the line isn't commented out
-    expected_content_regex = r'^\s*' + re.escape(r'"${distro_id}:${distro_codename}-security";')
-    if options.config_file:
-        config_filename = options.config_file
-    else:
-        config_filename = '/etc/apt/apt.conf.d/50unattended-upgrades'
-    if not config_file_contains(config_filename, expected_content_regex):
-        print("CRITICAL - 'unattended-upgrades' is not configured to install security updates")
-        sys.exit(CRITICAL)
+    if SECURITY_ORIGIN not in allowed_origins:
+        return (CRITICAL, "CRITICAL - 'unattended-upgrades' is not configured to install security updates")
 
     # --- Check that unattended-upgrades is configured to install recommended updates.
-    # '^\s*' Ensures that the line isn't commented out.
-    expected_content_regex = r'^\s*' + re.escape(r'"${distro_id}:${distro_codename}-updates";')
-    if options.config_file:
-        config_filename = options.config_file
-    else:
-        config_filename = '/etc/apt/apt.conf.d/50unattended-upgrades'
-    if not config_file_contains(config_filename, expected_content_regex):
-        print("WARNING - 'unattended-upgrades' is not configured to install recommended updates")
-        sys.exit(WARNING)
+    if UPDATES_ORIGIN not in allowed_origins:
+        return (WARNING, "WARNING - 'unattended-upgrades' is not configured to install recommended updates")
 
     # --- Check that unattended-upgrades is configured to run.
     # This could be set up in "/etc/apt/apt.conf.d/10periodic" (deprecated) or in
-    #    "/etc/apt/apt.conf.d/20unattended-upgrades".
-    if options.config_file:
-        config_filename = options.config_file
-    else:
-        config_filename = '/etc/apt/apt.conf.d/20auto-upgrades'
-    if not os.path.isfile(config_filename):
-        config_filename = '/etc/apt/apt.conf.d/10periodic'
-    config_variable_regexes = [
-        # Make sure this one is first
-        re.escape(r'APT::Periodic::Unattended-Upgrade "') + r'(\d+)' + re.escape(r'";'),
-        #
-        r'APT::Periodic::Update-Package-Lists "(\d+)";',
-        r'APT::Periodic::Download-Upgradeable-Packages "(\d+)";',
-        r'APT::Periodic::AutocleanInterval "(\d+)";',
-    ]
-    for cvr in config_variable_regexes:
-        val = get_config_value(config_filename, cvr)
-        val = None if val is None else int(val)
+    #    "/etc/apt/apt.conf.d/20auto-upgrades", the merged configuration has both.
+    for key in PERIODIC_KEYS:
+        val = get_config_value(config, key)
+        try:
+            val = None if val is None else int(val)
+        except (TypeError, ValueError):
+            val = None
         if not val:
-            print("CRITICAL - In {}: {} is set to {}".format(config_filename, cvr, val))
-            sys.exit(CRITICAL)
-        if cvr == config_variable_regexes[0]:
+            return (CRITICAL, "CRITICAL - In {}: {} is set to {}".format(config_source, key, val))
+        if key == PERIODIC_KEYS[0]:
             unattended_upgrade_period = val
+    return (OK, unattended_upgrade_period)
 
 
+def main(options):
+    # --- Check that 'unattended-upgrades' is installed.
+    if not package_installed('unattended-upgrades'):
+        print("CRITICAL - Package 'unattended-upgrades' not installed")
+        return CRITICAL
+
+    if options.config_file:
+        config = {}
+        read_apt_config_file(options.config_file, config)
+        config_source = options.config_file
+    else:
+        config = read_apt_config(options.config_dir)
+        config_source = options.config_dir
+
+    exit_code, message = check_config(config, config_source)
+    if exit_code != OK:
+        print(message)
+        return exit_code
+    unattended_upgrade_period = message
+
     # --- Check if a reboot is required (by checking for file '/var/run/reboot-required')
-    reboot_required = os.path.exists('/var/run/reboot-required')
+    reboot_required = os.path.exists(REBOOT_REQUIRED_FILE)
     if reboot_required:
         print("WARNING - Server requires a reboot")
-        sys.exit(WARNING)
+        return WARNING
     else:
         print("OK - unattended_upgrades runs every {} days".format(unattended_upgrade_period))
-        sys.exit(OK)
-except Exception as ex:
-    print(ex)
-    pass
-
-print("UNKNOWN - Check failed with unknown error")
-sys.exit(UNKNOWN)
+        return OK
+
+
+if __name__ == '__main__':
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-c", "--config-file", dest="config_file", default="",
+            help='Custom config file, checked instead of APT configuration directory')
+        parser.add_argument("-d", "--config-dir", dest="config_dir", default=APT_CONFIG_PARTS_DIR,
+            help='APT configuration parts directory (default: %(default)s)')
+        options = parser.parse_args()
+        sys.exit(main(options))
+    except Exception as ex:
+        print(ex)
+        pass
+
+    print("UNKNOWN - Check failed with unknown error")
+    sys.exit(UNKNOWN)
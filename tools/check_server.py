@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# Resident check runner for zabbix_item_wrapper.py (see its --server-socket option).
+# Python plugins that define run(argv) are imported once and run in-process, so a
+# Zabbix poll doesn't start a second interpreter for them. Shell, Perl and other
+# Python plugins are run as subprocesses, same as the wrapper does.
+#   tools/check_server.py -j 8
+#   tools/zabbix_item_wrapper.py -s ~/.cache/cheretbe/nagios-plugins/check_server.sock \
+#     /path/check_status_file.py /var/lib/nagios/status/backup
+#
+# Protocol: a client sends a single JSON line
+#   {"command": ["/path/check_status_file.py", "/var/lib/nagios/status/backup"],
+#    "timeout": 25, "no_text_status": false}
+# and gets back a single JSON line, same as zabbix_item_wrapper.py output
+#   {"status": 0, "status_text": "OK Backup has finished"}
+# A request takes about a millisecond, the wrapper's own interpreter startup is
+# what remains. To avoid that too, a Zabbix UserParameter can talk to the socket
+# directly:
+#   echo '{"command": ["/path/check_status_file.py", "/path/backup"]}' | socat - UNIX-CONNECT:/path/check_server.sock
+#
+# Timeout applies to subprocesses only: a plugin running in-process can't be
+# interrupted, in-process plugins are expected to be fast (file or socket reads).
+# A plugin file is imported again when its modification time changes.
+
+import os
+import sys
+import argparse
+import ast
+import datetime
+import importlib.util
+import io
+import json
+import re
+import signal
+import socketserver
+import threading
+
+import zabbix_item_wrapper
+
+DEFAULT_SOCKET_PATH = "~/.cache/cheretbe/nagios-plugins/check_server.sock"
+DEFAULT_JOBS = 8
+MAX_REQUEST_SIZE = 1024 * 1024
+
+verbose = False
+
+
+def print_verbose(verbose_msg):
+    if verbose:
+        print("{} {}".format(datetime.datetime.now().strftime("%x %X"), verbose_msg), flush=True)
+
+
+class ThreadOutput(io.TextIOBase):
+    """sys.stdout/sys.stderr replacement: a thread running a plugin writes to its own buffer"""
+
+    def __init__(self, original):
+        self.original = original
+        self.local = threading.local()
+
+    def get_target(self):
+        buffer = getattr(self.local, "buffer", None)
+        return self.original if buffer is None else buffer
+
+    def write(self, text):
+        return self.get_target().write(text)
+
+    def flush(self):
+        self.get_target().flush()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        return self.local.buffer
+
+    def release(self):
+        self.local.buffer = None
+
+
+def get_python_script(command):
+    # Returns (script file name, arguments) for "script.py args" and
+    # "python3 script.py args" commands, (None, None) for anything else
+    if command[0].endswith(".py"):
+        return command[0], command[1:]
+    if os.path.basename(command[0]).startswith("python") and (len(command) > 1) and command[1].endswith(".py"):
+        return command[1], command[2:]
+    return None, None
+
+
+class PluginLoader:
+    """Imported plugin modules with run(argv), reloaded when the file changes.
+    Only scripts that define run() at module level are imported"""
+
+    def __init__(self):
+        # file name -> (modification time, run function or None if the plugin
+        # can't run in-process)
+        self.plugins = {}
+        self.lock = threading.Lock()
+
+    def get_entry_point(self, script_file_name):
+        script_file_name = os.path.abspath(script_file_name)
+        try:
+            mtime = os.stat(script_file_name).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            cached = self.plugins.get(script_file_name)
+            if (cached is None) or (cached[0] != mtime):
+                cached = (mtime, self.load(script_file_name))
+                self.plugins[script_file_name] = cached
+        return cached[1]
+
+    @staticmethod
+    def defines_run(script_file_name):
+        # Scripts are parsed, not imported: top level code of a script without
+        # run() (no __main__ guard, sys.exit() calls) must not run in the server
+        try:
+            with open(script_file_name, "rb") as script_f:
+                tree = ast.parse(script_f.read(), script_file_name)
+        except (OSError, SyntaxError, ValueError):
+            return False
+        return any(isinstance(node, ast.FunctionDef) and (node.name == "run") for node in tree.body)
+
+    @staticmethod
+    def load(script_file_name):
+        if not PluginLoader.defines_run(script_file_name):
+            print_verbose(f"'{script_file_name}' has no run(), it will run as a subprocess")
+            return None
+        # Sibling modules (e.g. http_fixtures) are imported by plain name, some of
+        # them only when run() is called. The directory goes after the standard
+        # library and site-packages, so it can't shadow them
+        plugin_dir = os.path.dirname(script_file_name)
+        if plugin_dir not in sys.path:
+            sys.path.append(plugin_dir)
+        # Plugins with the same file name in different directories, or named like a
+        # module already imported, don't replace each other in sys.modules
+        module_name = "check_server_plugin_" + re.sub(r"\W", "_", script_file_name)
+        try:
+            spec = importlib.util.spec_from_file_location(module_name, script_file_name)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+        except BaseException as e:
+            # sys.exit() at import too. Until the file changes it runs as a subprocess
+            sys.modules.pop(module_name, None)
+            print_verbose(f"Can't import '{script_file_name}', it will run as a subprocess: {e}")
+            return None
+        entry_point = getattr(module, "run", None)
+        print_verbose(
+            "Loaded '{}', {}".format(script_file_name, "in-process" if callable(entry_point) else "no run(), subprocess")
+        )
+        return entry_point if callable(entry_point) else None
+
+
+def run_in_process(entry_point, argv):
+    # Returns (exit code, output)
+    output = sys.stdout.capture()
+    sys.stderr.capture()
+    try:
+        try:
+            exit_code = entry_point(argv)
+        except SystemExit as e:
+            # argparse errors and --help
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            print("Unhandled exception: {}".format(e))
+            exit_code = zabbix_item_wrapper.STATUS_UNKNOWN
+    finally:
+        sys.stdout.release()
+        sys.stderr.release()
+    return exit_code, output.getvalue()
+
+
+def run_check(server, request):
+    command = request["command"]
+    no_text_status = request.get("no_text_status", False)
+    script_file_name, argv = get_python_script(command)
+    entry_point = server.loader.get_entry_point(script_file_name) if script_file_name else None
+    with server.semaphore:
+        if entry_point is None:
+            return zabbix_item_wrapper.run_command(command, request.get("timeout"), no_text_status)
+        exit_code, output = run_in_process(entry_point, argv)
+    return zabbix_item_wrapper.get_status_obj(exit_code, output.rstrip(), no_text_status)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request_data = self.rfile.readline(MAX_REQUEST_SIZE + 1)
+            if len(request_data) > MAX_REQUEST_SIZE:
+                raise ValueError("Request is too large")
+            response = run_check(self.server, json.loads(request_data.decode("utf-8")))
+        except Exception as e:
+            response = {"error": str(e)}
+        try:
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+
+
+class CheckServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, jobs=DEFAULT_JOBS):
+        self.loader = PluginLoader()
+        # Connections are accepted right away, at most this many checks run at once
+        self.semaphore = threading.BoundedSemaphore(jobs)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+
+def install_thread_output():
+    # Idempotent, tests start more than one server in a process
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+    if not isinstance(sys.stderr, ThreadOutput):
+        sys.stderr = ThreadOutput(sys.stderr)
+
+
+def start_server(socket_path, jobs=DEFAULT_JOBS):
+    # Serves in a background thread
+    install_thread_output()
+    server = CheckServer(socket_path, jobs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(args):
+    global verbose
+    verbose = args.verbose
+
+    install_thread_output()
+    socket_path = os.path.expanduser(args.socket_path)
+    server = CheckServer(socket_path, args.jobs)
+    print_verbose(f"Listening on '{socket_path}'")
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident check runner for zabbix_item_wrapper.py")
+    parser.add_argument(
+        "-s", "--socket", dest="socket_path", default=DEFAULT_SOCKET_PATH,
+        help="Unix socket to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=DEFAULT_JOBS,
+        help="Maximum number of checks running at once (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-v", "--verbose", dest="verbose", action="store_true", default=False,
+        help="Display verbose debug messages",
+    )
+
+    main(parser.parse_args())
@@ -0,0 +1,140 @@
+import os
+import sys
+import shutil
+import socket
+import threading
+import tempfile
+import time
+import unittest
+
+import check_server
+import zabbix_item_wrapper
+
+STATUS_PLUGIN = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "check_status_file", "check_status_file.py"
+)
+
+
+class check_server_FunctionalTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.temp_dir, "check_server.sock")
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        self.server = check_server.start_server(self.socket_path, jobs=2)
+        self.status_file_name = os.path.join(self.temp_dir, "backup")
+        with open(self.status_file_name, "w") as status_f:
+            status_f.write("{};OK;Backup has finished\n".format(time.strftime("%Y-%m-%dT%H:%M:%S")))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        shutil.rmtree(self.temp_dir)
+
+    def test_in_process(self):
+        """Should run Python plugins with run() in-process and return same result as a subprocess"""
+        missing_file_name = os.path.join(self.temp_dir, "missing")
+        for command, argv in (
+            ([STATUS_PLUGIN, self.status_file_name], [self.status_file_name]),
+            ([sys.executable, STATUS_PLUGIN, self.status_file_name, "-w", "0"], [self.status_file_name, "-w", "0"]),
+            ([STATUS_PLUGIN, missing_file_name], [missing_file_name]),
+        ):
+            self.assertEqual(
+                zabbix_item_wrapper.query_server(self.socket_path, command),
+                zabbix_item_wrapper.run_command([sys.executable, STATUS_PLUGIN] + argv),
+            )
+        self.assertIsNotNone(self.server.loader.get_entry_point(STATUS_PLUGIN))
+
+    def test_subprocess(self):
+        """Should run other commands as subprocesses, with timeout"""
+        self.assertEqual(
+            zabbix_item_wrapper.query_server(self.socket_path, ["sh", "-c", "echo Low; exit 1"]),
+            {"status": 1, "status_text": "WARNING Low"},
+        )
+        self.assertEqual(
+            zabbix_item_wrapper.query_server(self.socket_path, ["sleep", "10"], timeout=0.5, no_text_status=True),
+            {"status": -1, "status_text": "Timed out after 0.5 second(s)"},
+        )
+
+    def test_fallback(self):
+        """Should run the command directly when the server is not available"""
+        self.assertEqual(
+            zabbix_item_wrapper.run_item(["echo", "hi"], server_socket=os.path.join(self.temp_dir, "none.sock")),
+            {"status": 0, "status_text": "OK hi"},
+        )
+
+    def test_server_failure(self):
+        """Should report UNKNOWN without running the command when the server fails to reply"""
+        failing_socket_path = os.path.join(self.temp_dir, "failing.sock")
+        failing_server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(failing_server.close)
+        failing_server.bind(failing_socket_path)
+        failing_server.listen(1)
+
+        def close_connection():
+            connection, _ = failing_server.accept()
+            connection.recv(65536)
+            connection.close()
+
+        threading.Thread(target=close_connection, daemon=True).start()
+        marker_file_name = os.path.join(self.temp_dir, "ran")
+        status_obj = zabbix_item_wrapper.run_item(
+            ["touch", marker_file_name], timeout=5, no_text_status=True, server_socket=failing_socket_path
+        )
+        self.assertEqual(status_obj["status"], zabbix_item_wrapper.STATUS_UNKNOWN)
+        self.assertTrue(status_obj["status_text"].startswith("Check server has failed: "))
+        self.assertFalse(os.path.exists(marker_file_name))
+
+    def test_module_names(self):
+        """Should import plugins with the same file name, or named like a loaded module, side by side"""
+        for dir_name in ("first", "second"):
+            os.mkdir(os.path.join(self.temp_dir, dir_name))
+            with open(os.path.join(self.temp_dir, dir_name, "json.py"), "w") as plugin_f:
+                plugin_f.write("def run(argv):\n    print('{}')\n    return 0\n".format(dir_name))
+        for dir_name in ("first", "second", "first"):
+            self.assertEqual(
+                zabbix_item_wrapper.query_server(
+                    self.socket_path, [sys.executable, os.path.join(self.temp_dir, dir_name, "json.py")]
+                ),
+                {"status": 0, "status_text": "OK " + dir_name},
+            )
+        self.assertTrue(hasattr(sys.modules["json"], "dumps"))
+
+    def write_plugin(self, file_name, source):
+        plugin_file_name = os.path.join(self.temp_dir, file_name)
+        with open(plugin_file_name, "w") as plugin_f:
+            plugin_f.write(source)
+        return plugin_file_name
+
+    def get_run_count(self, counter_file_name):
+        with open(counter_file_name) as counter_f:
+            return len(counter_f.readlines())
+
+    def test_no_run(self):
+        """Should not import scripts without run(), their top level code runs only as a subprocess"""
+        counter_file_name = os.path.join(self.temp_dir, "counter")
+        plugin_file_name = self.write_plugin("script.py", (
+            "open({!r}, 'a').write('run\\n')\n"
+            "print('Done')\n"
+        ).format(counter_file_name))
+        self.assertEqual(zabbix_item_wrapper.query_server(self.socket_path, [sys.executable, plugin_file_name]),
+            {"status": 0, "status_text": "OK Done"})
+        self.assertEqual(self.get_run_count(counter_file_name), 1)
+        self.assertIsNone(self.server.loader.get_entry_point(plugin_file_name))
+
+    def test_exit_on_import(self):
+        """Should survive sys.exit() at import and not import the plugin again until it changes"""
+        counter_file_name = os.path.join(self.temp_dir, "counter")
+        plugin_file_name = self.write_plugin("exits.py", (
+            "import sys\n"
+            "open({!r}, 'a').write('run\\n')\n"
+            "print('Not configured')\n"
+            "sys.exit(2)\n"
+            "def run(argv):\n"
+            "    return 0\n"
+        ).format(counter_file_name))
+        for _ in range(2):
+            self.assertEqual(zabbix_item_wrapper.query_server(self.socket_path, [sys.executable, plugin_file_name]),
+                {"status": 2, "status_text": "CRITICAL Not configured"})
+        # One import, two subprocess runs
+        self.assertEqual(self.get_run_count(counter_file_name), 3)
@@ -0,0 +1,166 @@
+import io
+import os
+import sys
+import fcntl
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import zabbix_item_wrapper
+
+
+class batch_FunctionalTests(unittest.TestCase):
+    def test_batch(self):
+        """Should run batch commands in parallel and key results by item name"""
+        batch = zabbix_item_wrapper.load_batch(io.StringIO(json.dumps({
+            "ok": [sys.executable, "-c", "import time; time.sleep(0.5); print('All good')"],
+            "warning": {"command": [sys.executable, "-c", "import sys, time; time.sleep(0.5); print('Low'); sys.exit(1)"]},
+            "python_unknown": [sys.executable, "-c", "import sys; print('Error'); sys.exit(-1)"],
+            "missing": ["/nonexistent/check"],
+        })), 10)
+        start = time.monotonic()
+        results = zabbix_item_wrapper.run_batch(batch, jobs=4)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(list(results), ["ok", "warning", "python_unknown", "missing"])
+        self.assertEqual(results["ok"], {"status": 0, "status_text": "OK All good"})
+        self.assertEqual(results["warning"], {"status": 1, "status_text": "WARNING Low"})
+        self.assertEqual(results["python_unknown"], {"status": -1, "status_text": "UNKNOWN Error"})
+        self.assertEqual(results["missing"]["status"], -1)
+
+    def test_timeout(self):
+        """Should kill the whole process group of a command that times out"""
+        batch = zabbix_item_wrapper.load_batch(io.StringIO(json.dumps({
+            # Child of a shell keeps stdout open, it has to be killed too
+            "hung": {"command": ["sh", "-c", "sleep 30; echo done"], "timeout": 0.5},
+        })), 10)
+        start = time.monotonic()
+        results = zabbix_item_wrapper.run_batch(batch, jobs=4, no_text_status=True)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(results, {"hung": {"status": -1, "status_text": "Timed out after 0.5 second(s)"}})
+
+
+class cache_FunctionalTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, "cache")
+        self.counter_file_name = os.path.join(self.temp_dir, "counter")
+        # Counts its runs, takes a while
+        self.command = ["sh", "-c", "echo run >> '{}'; sleep 0.3; echo 'Expires in 30 day(s)'".format(
+            self.counter_file_name)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_run_count(self):
+        with open(self.counter_file_name) as counter_f:
+            return len(counter_f.readlines())
+
+    def run_cached(self, ttl=60, max_stale=0):
+        return zabbix_item_wrapper.run_cached_item(self.command, ttl, max_stale, cache_dir=self.cache_dir)
+
+    def test_hit_and_miss(self):
+        """Should run the command once per TTL and report cache status and age"""
+        self.assertEqual(self.run_cached(),
+            {"status": 0, "status_text": "OK Expires in 30 day(s)", "cache": "miss", "cache_age": 0})
+        result = zabbix_item_wrapper.run_cached_item(
+            self.command, 60, no_text_status=True, cache_dir=self.cache_dir)
+        self.assertEqual(result["cache"], "hit")
+        self.assertEqual(result["status_text"], "Expires in 30 day(s)")
+        self.assertEqual(self.get_run_count(), 1)
+        self.assertEqual(self.run_cached(ttl=0)["cache"], "miss")
+        self.assertEqual(self.get_run_count(), 2)
+
+    def test_single_flight(self):
+        """Should run the command once for concurrent callers"""
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.run_cached())) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.get_run_count(), 1)
+        self.assertEqual(sorted(x["cache"] for x in results), ["hit"] * 4 + ["miss"])
+
+    def test_stale(self):
+        """Should return a stale result while another caller refreshes it"""
+        self.run_cached()
+        cache_key = zabbix_item_wrapper.get_cache_key(self.command)
+        cache_file_name = os.path.join(self.cache_dir, cache_key + ".json")
+        with open(cache_file_name) as cache_f:
+            entry = json.load(cache_f)
+        entry["timestamp"] -= 100
+        with open(cache_file_name, "w") as cache_f:
+            json.dump(entry, cache_f)
+
+        with open(os.path.join(self.cache_dir, cache_key + ".lock"), "a") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            result = self.run_cached(ttl=60, max_stale=3600)
+        self.assertEqual((result["cache"], result["cache_age"]), ("stale", 100))
+        # Too old to be returned stale: refreshed
+        self.assertEqual(self.run_cached(ttl=10, max_stale=10)["cache"], "miss")
+        self.assertEqual(self.get_run_count(), 2)
+
+    def test_unknown(self):
+        """Should not cache UNKNOWN results"""
+        self.command = ["sh", "-c", "echo run >> '{}'; echo 'Login has failed'; exit 255".format(self.counter_file_name)]
+        for _ in range(2):
+            self.assertEqual(self.run_cached(),
+                {"status": -1, "status_text": "UNKNOWN Login has failed", "cache": "miss", "cache_age": 0})
+        self.assertEqual(self.get_run_count(), 2)
+
+    def test_lock_timeout(self):
+        """Should stop waiting for another run at the timeout and return a stale result or UNKNOWN"""
+        os.makedirs(self.cache_dir)
+        cache_key = zabbix_item_wrapper.get_cache_key(self.command)
+        with open(os.path.join(self.cache_dir, cache_key + ".lock"), "a") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            start = time.monotonic()
+            result = zabbix_item_wrapper.run_cached_item(
+                self.command, 60, timeout=0.3, no_text_status=True, cache_dir=self.cache_dir)
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(result,
+                {"status": -1, "status_text": "Timed out after 0.3 second(s) waiting for another run"})
+
+            zabbix_item_wrapper.write_cache_entry(os.path.join(self.cache_dir, cache_key + ".json"), self.command,
+                {"status": 0, "status_text": "Expires in 30 day(s)"})
+            result = zabbix_item_wrapper.run_cached_item(self.command, 0, timeout=0.3, cache_dir=self.cache_dir)
+            self.assertEqual((result["status_text"], result["cache"]), ("OK Expires in 30 day(s)", "stale"))
+        self.assertFalse(os.path.exists(self.counter_file_name))
+
+
+class perfdata_FunctionalTests(unittest.TestCase):
+    def test_parse_perfdata(self):
+        """Should parse perfdata of the first line and long output with units normalized"""
+        metrics = zabbix_item_wrapper.parse_perfdata(
+            "OK - 2 pools|tank=42% 'read ''fast'' time'=15ms;100;200;0\n"
+            "Long output line\n"
+            "Last long line | used=2GB;;;0;8GB\n"
+            "balance=1234,56 age=U;@10:20 invalid=abc"
+        )
+        self.assertEqual(list(metrics), ["tank", "read 'fast' time", "used", "balance", "age"])
+        self.assertEqual(metrics["tank"], {"value": 42.0, "uom": "%", "warn": None, "crit": None, "min": None, "max": None})
+        self.assertEqual(metrics["read 'fast' time"],
+            {"value": 0.015, "uom": "s", "warn": 0.1, "crit": 0.2, "min": 0.0, "max": None})
+        self.assertEqual(metrics["used"],
+            {"value": 2 * 1024 ** 3, "uom": "B", "warn": None, "crit": None, "min": 0.0, "max": 8 * 1024 ** 3})
+        self.assertEqual(metrics["balance"]["value"], 1234.56)
+        self.assertEqual((metrics["age"]["value"], metrics["age"]["warn"]), (None, "@10:20"))
+        self.assertEqual(zabbix_item_wrapper.parse_perfdata("OK - no perfdata\nLong output"), {})
+
+    def test_ranges(self):
+        """Should keep every range threshold as a string"""
+        metrics = zabbix_item_wrapper.parse_perfdata("OK|a=3;10:;20 b=3;~:10;@5:8 c=3s;10:20;5")
+        self.assertEqual((metrics["a"]["warn"], metrics["a"]["crit"]), ("10:", 20.0))
+        self.assertEqual((metrics["b"]["warn"], metrics["b"]["crit"]), ("~:10", "@5:8"))
+        self.assertEqual((metrics["c"]["warn"], metrics["c"]["crit"]), ("10:20", 5.0))
+
+    def test_batch_metrics(self):
+        """Should add metrics to every batch item"""
+        batch = zabbix_item_wrapper.load_batch(io.StringIO(json.dumps({
+            "zpools": ["sh", "-c", "echo 'ALL ZFS POOLS OK (tank)|tank=42% '"],
+        })), 10)
+        results = zabbix_item_wrapper.run_batch(batch, jobs=1, metrics=True)
+        self.assertEqual(results["zpools"]["metrics"]["tank"]["value"], 42.0)
@@ -1,8 +1,52 @@
 #!/usr/bin/env python3
 
+# Runs a Nagios-style check and prints its result as JSON for a Zabbix item:
+#   zabbix_item_wrapper.py /path/check_status_file.py /var/lib/nagios/status/backup
+#   {"status": 0, "status_text": "OK Backup has finished"}
+#
+# Batch mode (-b) runs many checks in parallel and prints one JSON document keyed
+# by item name, to be split by Zabbix dependent items (JSONPath $.backup.status).
+# Batch file ('-' for stdin) maps item names to commands, optionally with own
+# timeout in seconds:
+#   {"backup": ["/path/check_status_file.py", "/var/lib/nagios/status/backup"],
+#    "smart": {"command": ["/path/check_smart.sh", "/dev/sda"], "timeout": 20}}
+#   {"backup": {"status": 0, "status_text": "OK ..."}, "smart": {"status": 0, ...}}
+#
+# With -s commands are sent to check_server.py, which runs Python plugins
+# in-process. If the server is not running, commands are run directly. Other server
+# failures are reported as UNKNOWN.
+#
+# Result cache (--cache-ttl, or "ttl" and "max_stale" of a batch item): a result
+# younger than TTL seconds is returned without running the command. Results are
+# kept in files keyed by command line, so every wrapper process shares them, and
+# callers asking for the same command at once wait for a single run. A result up to
+# max-stale seconds past TTL is returned right away while another caller refreshes
+# it. A caller waits for another run no longer than its timeout, then gets the
+# stale result if there is any, UNKNOWN otherwise. UNKNOWN results (failed runs,
+# timeouts) are not cached. Cached output has "cache" ("hit", "stale" or "miss") and "cache_age" (seconds)
+# fields added:
+#   {"status": 0, "status_text": "OK Expires in 30 day(s) ...", "cache": "hit", "cache_age": 1234}
+#
+# With -m perfdata of the output (first line and long output) is added as "metrics",
+# so that dependent items take every value from one run ($.metrics.tank.value).
+# Values and thresholds are converted to base units: seconds, bytes, percent.
+# Range thresholds (10:, ~:10, @5:8) are kept as strings:
+#   ALL ZFS POOLS OK (tank)|tank=42% 'read time'=15ms;100;200 used=2GB;;;0;8GB
+#   "metrics": {"tank": {"value": 42.0, "uom": "%", "warn": null, "crit": null, "min": null, "max": null},
+#     "read time": {"value": 0.015, "uom": "s", "warn": 0.1, "crit": 0.2, "min": null, "max": null},
+#     "used": {"value": 2147483648.0, "uom": "B", "warn": null, "crit": null, "min": 0.0, "max": 8589934592.0}}
+
+import os
 import argparse
 import subprocess
+import fcntl
+import hashlib
 import json
+import re
+import shutil
+import signal
+import sys
+import time
 
 # Nagios status codes
 STATUS_UNKNOWN = -1
@@ -15,18 +59,317 @@ STATUS_NAMES = {
     STATUS_CRITICAL: "CRITICAL",
     STATUS_UNKNOWN: "UNKNOWN",
 }
+# Zabbix agent waits 30 seconds at most, the whole batch has to fit in it
+DEFAULT_BATCH_TIMEOUT = 25
+DEFAULT_BATCH_JOBS = 8
+CACHE_DIR = "~/.cache/cheretbe/nagios-plugins/zabbix_item_wrapper"
+# How often a caller checks whether another run of the command has finished
+CACHE_LOCK_POLL_INTERVAL = 0.05
 
+# 'label'=value[UOM];[warn];[crit];[min];[max], quotes in a quoted label are doubled
+PERFDATA_ITEM_RE = re.compile(r"('(?:[^']|'')+'|[^\s'=]+)=(\S*)")
+# Characters that make a threshold a range, not a number
+PERFDATA_RANGE_CHARS = ":~@"
+PERFDATA_VALUE_RE = re.compile(r"^([-+]?(?:\d+[.,]?\d*|[.,]\d+)(?:[eE][-+]?\d+)?|U)(\D*)$")
+# UOM -> (normalized UOM, factor). Byte multiples are binary, as graphing tools
+# for Nagios treat them
+UNITS = {
+    "": ("", 1),
+    "s": ("s", 1),
+    "ms": ("s", 1e-3),
+    "us": ("s", 1e-6),
+    "%": ("%", 1),
+    "B": ("B", 1),
+    "KB": ("B", 1024),
+    "MB": ("B", 1024 ** 2),
+    "GB": ("B", 1024 ** 3),
+    "TB": ("B", 1024 ** 4),
+    "c": ("c", 1),
+}
 
-def main(args):
-    completed_proc = subprocess.run(args.original_command, stdout=subprocess.PIPE, encoding="utf-8")
-    status_obj = {"status": completed_proc.returncode}
-    if args.no_text_status:
-        status_obj["status_text"] = completed_proc.stdout.rstrip()
+
+def get_status_obj(status, text, no_text_status):
+    # sys.exit(-1) of a Python plugin is seen as 255
+    if status == 255:
+        status = STATUS_UNKNOWN
+    if no_text_status:
+        return {"status": status, "status_text": text}
+    return {"status": status, "status_text": f"{STATUS_NAMES.get(status, STATUS_NAMES[STATUS_UNKNOWN])} {text}"}
+
+
+def run_command(command, timeout=None, no_text_status=False):
+    # The command runs in its own process group, so that on timeout its children
+    # (e.g. smartctl started by a shell script) are killed too
+    try:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, encoding="utf-8", start_new_session=True)
+    except OSError as e:
+        return get_status_obj(STATUS_UNKNOWN, f"Can't run {command[0]}: {e}", no_text_status)
+    try:
+        stdout, _ = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.communicate()
+        return get_status_obj(STATUS_UNKNOWN, f"Timed out after {timeout:g} second(s)", no_text_status)
+    return get_status_obj(proc.returncode, stdout.rstrip(), no_text_status)
+
+
+def query_server(socket_path, command, timeout=None, no_text_status=False):
+    import socket
+
+    request = {"command": command, "timeout": timeout, "no_text_status": no_text_status}
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Server waits for a free job slot before running the command
+    client_socket.settimeout(None if timeout is None else timeout + 10)
+    try:
+        client_socket.connect(os.path.expanduser(socket_path))
+        client_socket.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        response_data = b""
+        while not response_data.endswith(b"\n"):
+            chunk = client_socket.recv(65536)
+            if not chunk:
+                break
+            response_data += chunk
+    finally:
+        client_socket.close()
+    response = json.loads(response_data.decode("utf-8"))
+    if "error" in response:
+        raise Exception("Check server error: {}".format(response["error"]))
+    return response
+
+
+def run_item(command, timeout=None, no_text_status=False, server_socket=None):
+    if server_socket is not None:
+        try:
+            return query_server(server_socket, command, timeout, no_text_status)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Server is not running, run the command directly
+            pass
+        except Exception as e:
+            # The command may have run already or may still be running, running it
+            # again could take twice the time or repeat its side effects
+            return get_status_obj(STATUS_UNKNOWN, f"Check server has failed: {e}", no_text_status)
+    return run_command(command, timeout, no_text_status)
+
+
+def get_perfdata_text(output):
+    # Perfdata follows "|" on the first line and on one of the long output lines,
+    # every line after that is perfdata too
+    lines = output.split("\n")
+    perfdata = [lines[0].partition("|")[2]]
+    in_perfdata = False
+    for line in lines[1:]:
+        if in_perfdata:
+            perfdata.append(line)
+        elif "|" in line:
+            perfdata.append(line.partition("|")[2])
+            in_perfdata = True
+    return " ".join(perfdata)
+
+
+def get_unit(uom):
+    # Returns (normalized UOM, factor), unknown UOM is kept as is
+    return UNITS.get(uom) or UNITS.get(uom.upper()) or (uom, 1)
+
+
+def parse_perfdata_number(text, factor):
+    # Thresholds and min/max have value's UOM, some plugins repeat it (max=8GB)
+    if not text:
+        return None
+    # Range (10:, 10:20, @10:20, ~:10) is kept as is, "10:" is not the number 10
+    if any(char in text for char in PERFDATA_RANGE_CHARS):
+        return text
+    match = PERFDATA_VALUE_RE.match(text)
+    if (match is None) or (match.group(1) == "U"):
+        return text
+    number, uom = match.groups()
+    return float(number.replace(",", ".")) * (get_unit(uom)[1] if uom else factor)
+
+
+def parse_perfdata(output):
+    # Returns {label: {"value", "uom", "warn", "crit", "min", "max"}}. Invalid
+    # items are skipped
+    metrics = {}
+    for label, data in PERFDATA_ITEM_RE.findall(get_perfdata_text(output)):
+        if label.startswith("'"):
+            label = label[1:-1].replace("''", "'")
+        fields = data.split(";")
+        match = PERFDATA_VALUE_RE.match(fields[0])
+        if match is None:
+            continue
+        uom, factor = get_unit(match.group(2))
+        fields += [None] * (5 - len(fields))
+        metrics[label] = {
+            "value": None if match.group(1) == "U" else parse_perfdata_number(match.group(1), factor),
+            "uom": uom,
+            "warn": parse_perfdata_number(fields[1], factor),
+            "crit": parse_perfdata_number(fields[2], factor),
+            "min": parse_perfdata_number(fields[3], factor),
+            "max": parse_perfdata_number(fields[4], factor),
+        }
+    return metrics
+
+
+def add_metrics(status_obj):
+    status_obj["metrics"] = parse_perfdata(status_obj["status_text"])
+    return status_obj
+
+
+def get_cache_key(command):
+    # Same command line started as "check.sh" from PATH or as "/usr/local/bin/check.sh"
+    # gives the same key
+    executable = shutil.which(command[0]) or command[0]
+    normalized_command = [os.path.realpath(executable)] + list(command[1:])
+    return hashlib.sha256(json.dumps(normalized_command).encode("utf-8")).hexdigest()
+
+
+def read_cache_entry(cache_file_name):
+    try:
+        with open(cache_file_name) as cache_f:
+            return json.load(cache_f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_cache_entry(cache_file_name, command, status_obj):
+    temp_file_name = "{}.{}.tmp".format(cache_file_name, os.getpid())
+    with open(temp_file_name, "w") as cache_f:
+        json.dump({"command": command, "timestamp": time.time(), "result": status_obj}, cache_f)
+    os.replace(temp_file_name, cache_file_name)
+
+
+def get_cached_status_obj(entry, cache_status, no_text_status):
+    status_obj = get_status_obj(entry["result"]["status"], entry["result"]["status_text"], no_text_status)
+    status_obj["cache"] = cache_status
+    status_obj["cache_age"] = max(0, int(time.time() - entry["timestamp"]))
+    return status_obj
+
+
+def is_fresh(entry, max_age):
+    return (entry is not None) and (time.time() - entry["timestamp"] <= max_age)
+
+
+def lock_until(lock_f, deadline):
+    # deadline: time.monotonic() value or None to wait as long as it takes.
+    # Returns False if the lock is still taken at the deadline
+    if deadline is None:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        return True
+    while True:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(CACHE_LOCK_POLL_INTERVAL)
+
+
+def run_cached_item(command, ttl, max_stale=0, timeout=None, no_text_status=False, server_socket=None,
+        cache_dir=CACHE_DIR):
+    # Results are cached without status name, so that callers with and without
+    # --no-text-status share them
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    cache_key = get_cache_key(command)
+    cache_file_name = os.path.join(cache_dir, cache_key + ".json")
+
+    entry = read_cache_entry(cache_file_name)
+    if is_fresh(entry, ttl):
+        return get_cached_status_obj(entry, "hit", no_text_status)
+
+    # Waiting for another run and our own run share the timeout
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with open(os.path.join(cache_dir, cache_key + ".lock"), "a") as lock_f:
+        if is_fresh(entry, ttl + max_stale):
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another caller is refreshing it
+                return get_cached_status_obj(entry, "stale", no_text_status)
+        elif not lock_until(lock_f, deadline):
+            if entry is not None:
+                return get_cached_status_obj(entry, "stale", no_text_status)
+            return get_status_obj(
+                STATUS_UNKNOWN, f"Timed out after {timeout:g} second(s) waiting for another run", no_text_status
+            )
+        # Result may have been refreshed while we were waiting for the lock
+        entry = read_cache_entry(cache_file_name)
+        if is_fresh(entry, ttl):
+            return get_cached_status_obj(entry, "hit", no_text_status)
+        if deadline is not None:
+            timeout = max(0, round(deadline - time.monotonic(), 3))
+        status_obj = run_item(command, timeout, True, server_socket)
+        # The next caller runs the command again instead of getting a failure
+        # for the whole TTL
+        if status_obj["status"] != STATUS_UNKNOWN:
+            write_cache_entry(cache_file_name, command, status_obj)
+    status_obj = get_status_obj(status_obj["status"], status_obj["status_text"], no_text_status)
+    status_obj["cache"] = "miss"
+    status_obj["cache_age"] = 0
+    return status_obj
+
+
+def run_batch_item(item, no_text_status=False, server_socket=None, cache_dir=CACHE_DIR, metrics=False):
+    if item["ttl"] is None:
+        status_obj = run_item(item["command"], item["timeout"], no_text_status, server_socket)
     else:
-        status_obj["status_text"] = (
-            f"{STATUS_NAMES[completed_proc.returncode]} {completed_proc.stdout.rstrip()}"
+        status_obj = run_cached_item(
+            item["command"], item["ttl"], item["max_stale"], item["timeout"], no_text_status, server_socket, cache_dir
         )
-    print(json.dumps(status_obj))
+    return add_metrics(status_obj) if metrics else status_obj
+
+
+def load_batch(batch_f, default_timeout, default_ttl=None, default_max_stale=0):
+    # Returns {item name: {"command", "timeout", "ttl", "max_stale"}}
+    batch = {}
+    for name, item in json.load(batch_f).items():
+        if isinstance(item, list):
+            item = {"command": item}
+        if not item.get("command"):
+            raise ValueError(f"Item '{name}' has no command")
+        batch[name] = {
+            "command": item["command"],
+            "timeout": item.get("timeout", default_timeout),
+            "ttl": item.get("ttl", default_ttl),
+            "max_stale": item.get("max_stale", default_max_stale),
+        }
+    return batch
+
+
+def run_batch(batch, jobs, no_text_status=False, server_socket=None, cache_dir=CACHE_DIR, metrics=False):
+    # Returns {item name: status object} in batch order
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            name: executor.submit(run_batch_item, item, no_text_status, server_socket, cache_dir, metrics)
+            for name, item in batch.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def main(args):
+    if args.batch_file is not None:
+        timeout = args.timeout if args.timeout is not None else DEFAULT_BATCH_TIMEOUT
+        if args.batch_file == "-":
+            batch = load_batch(sys.stdin, timeout, args.cache_ttl, args.cache_max_stale)
+        else:
+            with open(args.batch_file) as batch_f:
+                batch = load_batch(batch_f, timeout, args.cache_ttl, args.cache_max_stale)
+        print(json.dumps(
+            run_batch(batch, args.jobs, args.no_text_status, args.server_socket, args.cache_dir, args.metrics)
+        ))
+        return
+    item = {
+        "command": args.original_command,
+        "timeout": args.timeout,
+        "ttl": args.cache_ttl,
+        "max_stale": args.cache_max_stale,
+    }
+    print(json.dumps(run_batch_item(item, args.no_text_status, args.server_socket, args.cache_dir, args.metrics)))
 
 
 def parse_args():
@@ -39,6 +382,67 @@ def parse_args():
         default=False,
         help="Do not add Nagios code text representation before status text",
     )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        dest="metrics",
+        action="store_true",
+        default=False,
+        help="Add perfdata of the output as 'metrics' with values in base units",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        dest="batch_file",
+        default=None,
+        help="Run commands from a JSON file ('-' for stdin) in parallel, output is keyed by item name",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=DEFAULT_BATCH_JOBS,
+        help="Maximum number of commands running at once in batch mode (default: %(default)d)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=None,
+        help=(
+            "Kill the command and report UNKNOWN after this many seconds "
+            f"(default: no timeout, {DEFAULT_BATCH_TIMEOUT} in batch mode)"
+        ),
+    )
+    parser.add_argument(
+        "-s",
+        "--server-socket",
+        dest="server_socket",
+        default=None,
+        help="Run commands through check_server.py listening on this socket (directly if it is not running)",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        type=float,
+        default=None,
+        help="Return a cached result if it is younger than this many seconds (default: no cache)",
+    )
+    parser.add_argument(
+        "--cache-max-stale",
+        dest="cache_max_stale",
+        type=float,
+        default=0,
+        help="Return a result up to this many seconds past TTL while another caller refreshes it (default: %(default)g)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        default=CACHE_DIR,
+        help="Result cache directory (default: %(default)s)",
+    )
     parser.add_argument("original_command", nargs="*")
 
     return parser.parse_args()
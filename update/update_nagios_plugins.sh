@@ -17,7 +17,14 @@ function echoVerboseMsg () {
 }
 
 function writeStatus () {
-  echo "$(date -Iseconds);$1;$2" >$status_file_path
+  # Write to a temporary file and rename it, so that check_status_file.py never
+  # reads a partially written file. Temporary file is hidden (same naming as
+  # write_status_file.py), so check_status_file.py directory mode skips it
+  local temp_file_path
+  temp_file_path="$(dirname "$status_file_path")/.$(basename "$status_file_path").$$.tmp"
+  if ! { echo "$(date -Iseconds);$1;$2" >"$temp_file_path" && mv -f "$temp_file_path" "$status_file_path"; }; then
+    rm -f "$temp_file_path"
+  fi
 }
 
 function startService () {